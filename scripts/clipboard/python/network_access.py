@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import re, socket, struct, sys
+import bisect, collections, os, re, socket, struct, sys, threading, time
 
 # This is a pristine copy of the access functions that have made their
 #  way into quite a few of my Python network scripts.
@@ -41,14 +41,31 @@ def enable_colours(force = False):
         COLOUR_OFF = ''
 enable_colours()
 
+# Messages
+
+def _print_message(header_colour, header_text, message):
+    print("%s[%s]: %s" % (colour_text(header_text, header_colour), colour_text(os.path.basename(sys.argv[0]), COLOUR_GREEN), message))
+
+def print_notice(message):
+    _print_message(COLOUR_BLUE, "Notice", message)
+
+def print_warning(message):
+    _print_message(COLOUR_YELLOW, "Warning", message)
+
 # Network Access Class
-# Required modules: re, socket, struct, sys
+# Required modules: bisect, collections, os, re, socket, struct, sys, threading, time
 ###
 
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
+    # Basic IPv4 syntax checks
+    REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
     REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
 
+    # Most addresses to remember a verdict for
+    CACHE_SIZE = 4096
+    # Seconds between checks on watched files, if inotify is not available
+    WATCH_INTERVAL = 5
+
     def __init__(self):
         self.errors = []
         self.allowed_addresses = []
@@ -56,9 +73,17 @@ class NetAccess:
         self.denied_addresses = []
         self.denied_networks = []
 
+        # Sorted, non-overlapping ranges of allowed and denied addresses, built from the lists above as needed,
+        #  along with verdicts for recently-checked addresses (oldest first).
+        # Replaced as a whole on reloading, so that is_allowed() never sees half of a change.
+        self.compiled = None
+        # Entries and files in the order that they were added, as (method name, value), for reloading.
+        self.sources = []
+
     def add_access(self, addr_list, net_list, candidate):
         good = True
         candidate = candidate.strip()
+        if not candidate or candidate.startswith('#'): return True # Blank line or comment in a file
         if re.match(self.REGEX_INET4_CIDR, candidate):
             g, n = self.ip_validate_cidr(candidate)
             good = g
@@ -67,16 +92,19 @@ class NetAccess:
                 net_list.append((n, candidate))
         else:
             g, a, astr = self.ip_validate_address(candidate)
-            error = g
+            good = g
             if g:
                 # No error
                 addr_list.append((a, candidate, astr))
+        self.compiled = None
         return good
 
     def add_blacklist(self, candidate):
+        self.sources.append(('add_blacklist', candidate))
         return self.add_access(self.denied_addresses, self.denied_networks, candidate)
 
     def add_whitelist(self, candidate):
+        self.sources.append(('add_whitelist', candidate))
         return self.add_access(self.allowed_addresses, self.allowed_networks, candidate)
 
     def announce_filter_actions(self):
@@ -91,29 +119,49 @@ class NetAccess:
                 else:
                     print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
 
+    def compile(self):
+        # Merge the lists into sorted ranges that can be searched with bisect,
+        #  so that checking an address does not mean going through every entry.
+        self.compiled = (self.compile_ranges(self.allowed_addresses, self.allowed_networks), self.compile_ranges(self.denied_addresses, self.denied_networks), collections.OrderedDict())
+
+    def compile_ranges(self, addr_list, net_list):
+        # Returns a list of range starts, and a list of the matching range ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(a[0], a[0]) for a in addr_list] + [n[0] for n in net_list]):
+            if ends and start <= ends[-1] + 1:
+                # Overlaps or runs into the previous range.
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
-    def ip_make_mask(self, n):
-        # Return a mask of n bits as a long integer
-        return (2<<n-1)-1
+    def ip_in_ranges(self, n, ranges):
+        # Is a numeric address in a list of compiled ranges?
+        starts, ends = ranges
+        i = bisect.bisect_right(starts, n) - 1
+        return i >= 0 and n <= ends[i]
 
     def ip_strton(self, ip):
-        # Convert decimal dotted quad string to long integer
-        return struct.unpack('<L',socket.inet_aton(ip))[0]
+        # Convert decimal dotted quad string to an integer
+        return struct.unpack('!L',socket.inet_aton(ip))[0]
 
-    def ip_network_mask(self, ip, bits):
-        # Convert a network address to a long integer
-        return self.ip_strton(ip) & self.ip_make_mask(int(bits))
-
-    def ip_addrn_in_network(self, ip, net):
-        # Is a numeric address in a network?
-        return ip & net == net
+    def ip_network_range(self, ip, bits):
+        # Convert a network to the first and last addresses in it, as integers
+        host_mask = (1 << (32 - int(bits))) - 1
+        start = self.ip_strton(ip) & ~host_mask
+        return (start, start | host_mask)
 
     def ip_validate_address(self, candidate):
         try:
-            ip = socket.gethostbyname(candidate)
+            # Only look up names. Addresses do not need a trip to DNS.
+            if re.match(self.REGEX_INET4, candidate): ip = candidate
+            else: ip = socket.gethostbyname(candidate)
             return (True, self.ip_strton(ip), ip)
-        except socket.gaierror:
+        except socket.error:
             self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
             return (False, None, None)
 
@@ -121,63 +169,131 @@ class NetAccess:
         a = candidate.split("/")[0]
         m = candidate.split("/")[1]
         try:
-            if socket.gethostbyname(a) and int(m) <= 32:
-                return (True, self.ip_network_mask(a, m))
-        except socket.gaierror:
+            if int(m) <= 32:
+                return (True, self.ip_network_range(a, m))
+        except socket.error:
             pass
         self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
         return (False, None)
 
     def is_allowed(self, address):
         # Blacklist/Whitelist filtering
-        allowed = True
+        if self.compiled is None: self.compile()
+        allowed_ranges, denied_ranges, cache = self.compiled
+        if not allowed_ranges[0] and not denied_ranges[0]: return True
 
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
+        verdict = cache.pop(address, None)
+        if verdict is None:
+            try: n = self.ip_strton(address)
+            except (socket.error, TypeError): n = None # Not an IPv4 address, so no entry can match it.
 
-            if address in [a[2] for a in self.allowed_addresses]:
-                allowed = True
-            else:
-                # Try checking allowed networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.allowed_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
+            # Whitelist processing, address is not allowed until it is cleared.
+            verdict = not allowed_ranges[0] or (n is not None and self.ip_in_ranges(n, allowed_ranges))
             # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
+            if verdict and n is not None and self.ip_in_ranges(n, denied_ranges): verdict = False
 
-            if address in [a[2] for a in self.denied_addresses]:
-                allowed = False
-            else:
-                # Try checking denied networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.denied_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(self, fn, path, header):
+            if len(cache) >= self.CACHE_SIZE: cache.popitem(last = False)
+        cache[address] = verdict
+        return verdict
+
+    def load_access_file(self, addr_list, net_list, path, header):
         if not os.path.isfile(path):
             self.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines():
-                fn(l)
+            for l in f:
+                self.add_access(addr_list, net_list, l)
+        return True
 
     def load_blacklist_file(self, path):
-        return self.load_access_file(self.add_blacklist, path, "blacklist")
+        self.sources.append(('load_blacklist_file', path))
+        return self.load_access_file(self.denied_addresses, self.denied_networks, path, "blacklist")
 
     def load_whitelist_file(self, path):
-        return self.load_access_file(self.add_whitelist, path, "whitelist")
+        self.sources.append(('load_whitelist_file', path))
+        return self.load_access_file(self.allowed_addresses, self.allowed_networks, path, "whitelist")
+
+    def reload(self):
+        # Rebuild everything from scratch, then swap it in.
+        # Checks that are already underway finish against the old lists.
+        if [value for name, value in self.sources if name.endswith('_file') and not os.path.isfile(value)]:
+            # Most likely caught in the middle of being replaced. Keep the current lists until the next change.
+            return False
+
+        fresh = NetAccess()
+        for name, value in self.sources: getattr(fresh, name)(value)
+
+        for error in fresh.errors: print_warning("Reloading access lists: %s" % error)
+        fresh.compile()
+        self.allowed_addresses, self.allowed_networks = fresh.allowed_addresses, fresh.allowed_networks
+        self.denied_addresses, self.denied_networks = fresh.denied_addresses, fresh.denied_networks
+        self.compiled = fresh.compiled
+        return True
+
+    def watch(self):
+        # Reload the lists in the background whenever one of their files changes.
+        # Threads do not survive a fork, so this should be called in the process that will be checking addresses.
+        paths = [os.path.realpath(value) for name, value in self.sources if name.endswith('_file')]
+        if not paths: return False
+
+        t = threading.Thread(target=self.watch_files, args=(paths,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def watch_files(self, paths):
+        try: self.watch_files_inotify(paths)
+        except (ImportError, OSError, AttributeError): self.watch_files_poll(paths)
+
+    def watch_files_inotify(self, paths):
+        # Watch the directories rather than the files, so that files that are replaced
+        #  (written elsewhere and then renamed into place) are still caught.
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        try:
+            names = {}
+            for path in paths:
+                directory, name = os.path.split(path)
+                # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                wd = libc.inotify_add_watch(fd, directory.encode('utf-8'), 0x08 | 0x80 | 0x100)
+                if wd < 0: raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+                names.setdefault(wd, set()).add(name.encode('utf-8'))
+
+            while True:
+                data = os.read(fd, 65536)
+                changed = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                    offset += 16 + length
+                    if name in names.get(wd, ()): changed = True
+
+                if changed:
+                    # Let a burst of changes settle before reading.
+                    time.sleep(0.5)
+                    self.reload()
+        finally: os.close(fd)
+
+    def watch_files_poll(self, paths):
+        def stat(path):
+            try:
+                st = os.stat(path)
+                return (st.st_ino, st.st_size, st.st_mtime)
+            except OSError: return None
+
+        last = [stat(path) for path in paths]
+        while True:
+            time.sleep(self.WATCH_INTERVAL)
+            current = [stat(path) for path in paths]
+            if current != last and self.reload(): last = current
 
 # Demonstration of access-list
 if __name__ == "__main__":
-    print "Main"
+    print("Main")
     acc = NetAccess()
 
     acc.add_whitelist("127.0.0.1")
@@ -189,4 +305,4 @@ if __name__ == "__main__":
             word = "Allowed"
         else:
             word = "Denied"
-        print "Test: %s address %s%s%s" % (word, COLOUR_GREEN, i, COLOUR_OFF)
+        print("Test: %s address %s%s%s" % (word, COLOUR_GREEN, i, COLOUR_OFF))
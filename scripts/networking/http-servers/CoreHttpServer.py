@@ -5,14 +5,14 @@
 #   * https://docs.python.org/2/library/simplehttpserver.html
 
 # Basic includes
-import base64, getopt, getpass, os, mimetypes, posixpath, re, shutil, ssl, socket, struct, sys, time, urllib
+import base64, bisect, collections, errno, getopt, getpass, hashlib, io, json, os, mimetypes, posixpath, re, shutil, ssl, socket, stat, struct, sys, tempfile, threading, time, urllib, zlib
 from random import randint
 
 if sys.version_info[0] == 2:
     from BaseHTTPServer import HTTPServer
     from BaseHTTPServer import BaseHTTPRequestHandler
 
-    from SocketServer import ThreadingMixIn
+    from Queue import Full, Queue
 
     from urllib import unquote
     from urlparse import parse_qs
@@ -28,13 +28,25 @@ else:
     from http.server import HTTPServer
     from http.server import BaseHTTPRequestHandler
 
-    from socketserver import ThreadingMixIn
+    from queue import Full, Queue
 
     from urllib.parse import unquote
     from urllib.parse import parse_qs
 
     from io import StringIO
 
+try:
+    import selectors
+except ImportError:
+    # Python 2, the selector engine is not available.
+    selectors = None
+
+try:
+    import brotli
+except ImportError:
+    # Responses can only be compressed on the fly with gzip, though .br sidecar files are still served.
+    brotli = None
+
 #
 # Common Colours and Message Functions
 ###
@@ -119,7 +131,43 @@ DEFAULT_AUTH_TIMEOUT = 300
 
 DEFAULT_TIMEOUT = 10
 
+DEFAULT_KEEP_ALIVE_TIMEOUT = 5
+DEFAULT_KEEP_ALIVE_REQUESTS = 100
+
+DEFAULT_THREADS = 32
+DEFAULT_QUEUE_SIZE = 128
+DEFAULT_CLIENT_LIMIT = 0
+
+OVERFLOW_REJECT = '503'
+OVERFLOW_QUEUE = 'queue'
+OVERFLOW_POLICIES = [OVERFLOW_REJECT, OVERFLOW_QUEUE]
+DEFAULT_OVERFLOW = OVERFLOW_REJECT
+
+ENGINE_THREADS = 'threads'
+ENGINE_SELECTOR = 'selector'
+DEFAULT_ENGINE = ENGINE_THREADS
+
+SENDFILE_CHUNK = 4*1024*1024
+
+# Largest unread request body to read and throw away to keep a connection open for another request.
+DISCARD_BODY_LIMIT = 64*1024
+
+ENCODING_BROTLI = 'br'
+ENCODING_GZIP = 'gzip'
+# Precompressed files served in place of a static file, in order of preference.
+SIDECARS = [(ENCODING_BROTLI, '.br'), (ENCODING_GZIP, '.gz')]
+# Encodings that responses can be compressed to on the fly, in order of preference.
+COMPRESS_ENCODINGS = [e for e in [ENCODING_BROTLI, ENCODING_GZIP] if e != ENCODING_BROTLI or brotli]
+# Levels that are quick enough to compress as a response is being sent.
+COMPRESS_LEVEL_GZIP = 6
+COMPRESS_LEVEL_BROTLI = 5
+# Types worth compressing. Most other types (images, video, archives) are already compressed.
+COMPRESS_TYPES = ['text/', 'application/javascript', 'application/json', 'application/xml', 'application/xhtml+xml', 'image/svg+xml']
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_COMPRESS_CACHE = 16
+
 DEFAULT_BIND = "0.0.0.0"
+DEFAULT_STATS_BIND = "127.0.0.1"
 DEFAULT_PORT = 8080
 
 REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
@@ -127,6 +175,15 @@ REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
 TITLE_BIND = "bind"
 TITLE_PORT = "port"
 TITLE_TIMEOUT = "timeout"
+TITLE_KEEP_ALIVE_TIMEOUT = "keep-alive timeout"
+TITLE_KEEP_ALIVE_REQUESTS = "keep-alive requests"
+TITLE_ENGINE = "engine"
+TITLE_THREADS = "threads"
+TITLE_QUEUE_SIZE = "queue size"
+TITLE_OVERFLOW = "overflow"
+TITLE_CLIENT_LIMIT = "client limit"
+TITLE_STATS_BIND = "stats bind"
+TITLE_STATS_PORT = "stats port"
 TITLE_VERBOSE="verbose"
 
 TITLE_AUTH_LIMIT = "attempt limit"
@@ -145,6 +202,11 @@ TITLE_DENY_FILE = "deny address/range file"
 
 TITLE_USER_AGENT = "user-agent pattern"
 
+TITLE_NO_SENDFILE = "no sendfile"
+TITLE_NO_COMPRESS = "no compression"
+TITLE_COMPRESS_MIN_SIZE = "compression minimum size"
+TITLE_COMPRESS_CACHE = "compression cache"
+
 AUTH_BAD_NOT_FOUND = 0
 AUTH_BAD_PASSWORD = 1
 AUTH_GOOD_CREDS = 2
@@ -472,6 +534,19 @@ args.add_opt(OPT_TYPE_SHORT, "c", TITLE_SSL_CERT, "SSL certificate file path (PE
 args.add_opt(OPT_TYPE_SHORT, "k", TITLE_SSL_KEY, "SSL key file path (PEM format).")
 
 # Long flags
+args.add_opt(OPT_TYPE_LONG_FLAG, "no-sendfile", TITLE_NO_SENDFILE, "Copy files through userspace buffers instead of using sendfile(2).")
+args.add_opt(OPT_TYPE_LONG_FLAG, "no-compress", TITLE_NO_COMPRESS, "Always send responses uncompressed, and ignore precompressed (.gz/.br) copies of files.")
+args.add_opt(OPT_TYPE_LONG, "compress-min-size", TITLE_COMPRESS_MIN_SIZE, "Smallest response in bytes to compress on the fly.", converter = int, default = DEFAULT_COMPRESS_MIN_SIZE, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "compress-cache", TITLE_COMPRESS_CACHE, "Megabytes of compressed generated pages to keep for reuse (0 to disable).", converter = int, default = DEFAULT_COMPRESS_CACHE, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "keep-alive-timeout", TITLE_KEEP_ALIVE_TIMEOUT, "Seconds to hold an idle connection open for another request (0 to close after each response).", converter = int, default = DEFAULT_KEEP_ALIVE_TIMEOUT, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "keep-alive-requests", TITLE_KEEP_ALIVE_REQUESTS, "Maximum number of requests to serve over one connection (0 for unlimited).", converter = int, default = DEFAULT_KEEP_ALIVE_REQUESTS, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "engine", TITLE_ENGINE, "Server core: '%s' to give each connection a worker thread for as long as it is open, or '%s' to keep connections in an event loop and only use worker threads to run requests." % (ENGINE_THREADS, ENGINE_SELECTOR), default = DEFAULT_ENGINE, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "threads", TITLE_THREADS, "Number of worker threads handling connections.", converter = int, default = DEFAULT_THREADS, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "queue-size", TITLE_QUEUE_SIZE, "Maximum number of accepted connections waiting for a worker thread.", converter = int, default = DEFAULT_QUEUE_SIZE, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "overflow", TITLE_OVERFLOW, "What to do with new connections when the queue is full: '%s' to turn them away with a 503 error, or '%s' to stop accepting until there is room." % (OVERFLOW_REJECT, OVERFLOW_QUEUE), default = DEFAULT_OVERFLOW, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "client-limit", TITLE_CLIENT_LIMIT, "Maximum number of queued or active connections from one client address (0 for unlimited). Connections over the limit get a 503 error.", converter = int, default = DEFAULT_CLIENT_LIMIT, default_announce = True)
+args.add_opt(OPT_TYPE_LONG, "stats-port", TITLE_STATS_PORT, "Serve worker and queue statistics as JSON on this port.", converter = int)
+args.add_opt(OPT_TYPE_LONG, "stats-bind", TITLE_STATS_BIND, "Address to serve statistics on.", default = DEFAULT_STATS_BIND, default_colour = COLOUR_GREEN, default_announce = True)
 args.add_opt(OPT_TYPE_LONG, "user-agent", TITLE_USER_AGENT, "Regular expression to match user agents. When this option is in use, the client must match at least one provided pattern.", multiple = True)
 args.add_opt(OPT_TYPE_LONG, "auth-limit", TITLE_AUTH_LIMIT, "Number of attempts allowed within lockout period (0 for unlimited attempts).", converter = int, default = DEFAULT_AUTH_LIMIT, default_announce = True)
 args.add_opt(OPT_TYPE_LONG, "auth-timeout", TITLE_AUTH_TIMEOUT, "Login attempts timeout in seconds (0 for unlimited).", converter = int, default = DEFAULT_AUTH_TIMEOUT, default_announce = True)
@@ -496,6 +571,32 @@ def validate_common_arguments(self):
     if TITLE_SSL_KEY in self.args and not TITLE_SSL_CERT in self.args:
         errors.append("%s path provided, but no %s path was provided." % (TITLE_SSL_KEY, TITLE_SSL_CERT))
 
+    if self[TITLE_ENGINE] not in ENGINES:
+        errors.append('Invalid engine: %s' % colour_text(self[TITLE_ENGINE]))
+    elif self[TITLE_ENGINE] == ENGINE_SELECTOR and not selectors:
+        errors.append('The %s engine requires Python 3.' % colour_text(ENGINE_SELECTOR))
+    if self[TITLE_THREADS] < 1:
+        errors.append('Must have at least one worker thread.')
+    if self[TITLE_QUEUE_SIZE] < 1:
+        errors.append('Queue size must be at least 1.')
+    if self[TITLE_OVERFLOW] not in OVERFLOW_POLICIES:
+        errors.append('Invalid overflow behavior: %s' % colour_text(self[TITLE_OVERFLOW]))
+    if self[TITLE_CLIENT_LIMIT] < 0:
+        errors.append('Client limit must be greater than or equal to 0.')
+    stats_port = self[TITLE_STATS_PORT]
+    if stats_port is not None and (stats_port <= 0 or stats_port > 65535 or stats_port == port):
+        errors.append("Statistics port must be 1-65535 and different from the server port. Given: %s" % colour_text(stats_port))
+
+    if self[TITLE_KEEP_ALIVE_TIMEOUT] < 0:
+        errors.append('Keep-alive timeout must be greater than or equal to 0.')
+    if self[TITLE_KEEP_ALIVE_REQUESTS] < 0:
+        errors.append('Keep-alive request limit must be greater than or equal to 0.')
+
+    if self[TITLE_COMPRESS_MIN_SIZE] < 0:
+        errors.append('Compression minimum size must be greater than or equal to 0.')
+    if self[TITLE_COMPRESS_CACHE] < 0:
+        errors.append('Compression cache size must be greater than or equal to 0.')
+
     if self[TITLE_AUTH_LIMIT] < 0:
         errors.append('Auth limit must be greater than or equal to 0.')
     if self[TITLE_AUTH_TIMEOUT] < 0:
@@ -521,7 +622,7 @@ def validate_blacklists(self):
     for i in self[TITLE_DENY]:
         access.add_blacklist(i)
     for i in self[TITLE_DENY_FILE]:
-        access.load_whitelist_file(i)
+        access.load_blacklist_file(i)
 
     return access.errors
 args.add_validator(validate_blacklists)
@@ -547,6 +648,21 @@ def announce_common_arguments(verb = "Hosting content"):
     if TITLE_TIMEOUT in args:
         print_notice("Read socket timeout: %s" % colour_text(args[TITLE_TIMEOUT]))
 
+    if not args[TITLE_KEEP_ALIVE_TIMEOUT]:
+        print_notice("Connections will be closed after each response.")
+
+    if args[TITLE_NO_COMPRESS]:
+        print_notice("Responses will not be compressed.")
+    else:
+        print_notice("Compressing responses with: %s" % ", ".join([colour_text(e) for e in COMPRESS_ENCODINGS]))
+
+    print_notice("Server engine: %s" % colour_text(args[TITLE_ENGINE]))
+    print_notice("Worker threads: %s (Queue size: %s)" % (colour_text(args[TITLE_THREADS]), colour_text(args[TITLE_QUEUE_SIZE])))
+    if args[TITLE_CLIENT_LIMIT]:
+        print_notice("Connection limit per client: %s" % colour_text(args[TITLE_CLIENT_LIMIT]))
+    if args[TITLE_STATS_PORT]:
+        print_notice("Serving statistics on %s" % colour_text("%s:%d" % (args[TITLE_STATS_BIND], args[TITLE_STATS_PORT]), COLOUR_GREEN))
+
     for label, title in [("certificate", TITLE_SSL_CERT), ("key", TITLE_SSL_KEY)]:
         path = args[title]
         if path:
@@ -601,17 +717,23 @@ def serve(handler, change_directory = False, data = None):
     server = None
     try:
 
-        server = ThreadedHTTPServer((bind_address, bind_port), handler)
+        server = ENGINES[args[TITLE_ENGINE]]((bind_address, bind_port), handler)
         server.data = data
 
+        if args[TITLE_STATS_PORT]:
+            server.serve_stats((args[TITLE_STATS_BIND], args[TITLE_STATS_PORT]))
+
         if args[TITLE_SSL_CERT]:
-            keyfile = os.path.realpath(args[TITLE_SSL_KEY])
+            keyfile = None
+            if args[TITLE_SSL_KEY]:
+                keyfile = os.path.realpath(args[TITLE_SSL_KEY])
             certfile = os.path.realpath(args[TITLE_SSL_CERT])
-            server.socket = ssl.wrap_socket(server.socket, server_side=True, keyfile=args[TITLE_SSL_KEY], certfile=args[TITLE_SSL_CERT])
+            server.enable_ssl(certfile, keyfile)
 
         if change_directory:
             os.chdir(directory)
 
+        access.watch()
         print_notice("Starting server, use <Ctrl-C> to stop")
         server.serve_forever()
     except KeyboardInterrupt:
@@ -658,8 +780,15 @@ ATTR_COMMAND = 'command'
 class CoreHttpServer(BaseHTTPRequestHandler, object):
 
     server_version = "CoreHttpServer"
+    protocol_version = "HTTP/1.1"
     alive = True
 
+    # Headers and body go out in separate writes, which Nagle's algorithm would hold up on a persistent connection.
+    disable_nagle_algorithm = True
+
+    # Per-request state that must not leak into the next request on a persistent connection.
+    request_attributes = ['_user', '_password', 'body_read', 'response_code', 'response_framed', 'response_connection', 'chunked', 'content_encoding', 'vary_encoding']
+
     # (Kludgy) responses to specific problems without overriding an entire method.
     log_on_send_error = False
 
@@ -671,6 +800,7 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         self.server = server
         self.setup()
         self.request_sane = False
+        self.requests_handled = 0
 
     def check_authentication(self):
 
@@ -724,20 +854,80 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 self.server.attempts[client] = [time.time()]
         return success
 
+    def can_sendfile(self, src, dst):
+        """Check whether src can be copied to dst with sendfile(2) instead of through Python buffers.
+        Only regular files going straight out to a plain-HTTP client qualify.
+        SSL connections need to encrypt in userspace, so they stay on the buffered path."""
+
+        if args[TITLE_NO_SENDFILE] or dst is not self.wfile or getattr(self, 'chunked', False) or isinstance(self.connection, ssl.SSLSocket):
+            return False
+        if not hasattr(self.connection, 'sendfile'):
+            # Python 2
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(src.fileno()).st_mode)
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not backed by a file descriptor (e.g. StringIO content)
+            return False
+
+    def copyobj_sendfile(self, src, offset = 0, count = -1):
+        """Copy count bytes of src to the client starting at offset (-1 to copy through to the end).
+        Sent in chunks so that a dying server can still cut off a large transfer."""
+
+        self.wfile.flush()
+        while self.alive and count:
+            size = SENDFILE_CHUNK
+            if count > 0:
+                size = min(count, size)
+            sent = self.connection.sendfile(src, offset, size)
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+
+    def write_body(self, dst, data):
+        """Write response data to dst, adding chunk framing if it is going out to the client in chunks."""
+
+        data = convert_bytes(data)
+        if dst is self.wfile and getattr(self, 'chunked', False):
+            if not data:
+                # An empty chunk would end the body.
+                return
+            data = convert_bytes('%x\r\n' % len(data)) + data + convert_bytes('\r\n')
+        dst.write(data)
+
+    def compress_file(self, f, mimetype, length):
+        """Compress an opened file on its way to the client, if the client accepts it.
+        Returns the file object to send and its length. Once compressed, the length is None,
+         as it is not known until the whole file has been read."""
+
+        if getattr(self, 'content_encoding', None):
+            # Already a precompressed copy.
+            return f, length
+
+        encoding = self.select_encoding(mimetype, length)
+        if not encoding:
+            return f, length
+
+        self.content_encoding = encoding
+        return CompressedFile(f, encoding), None
+
     def copyobj(self, src, dst, outgoing = True):
         if not src:
             return
 
-        while self.alive:
-            buf = src.read(16*1024)
-            if not (buf and self.alive):
-                break
-            dst.write(convert_bytes(buf))
+        if self.can_sendfile(src, dst):
+            self.copyobj_sendfile(src)
+        else:
+            while self.alive:
+                buf = src.read(16*1024)
+                if not (buf and self.alive):
+                    break
+                self.write_body(dst, buf)
 
         if not outgoing:
             return
 
-        self.alive = False
         src.close()
 
     def invoke(self, method):
@@ -747,8 +937,13 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         try:
             f = method()
             self.copyobj(f, self.wfile)
+            if getattr(self, 'chunked', False):
+                # Last chunk
+                self.wfile.write(convert_bytes('0\r\n\r\n'))
         except Exception as e:
             print_exception(e, colour_text(self.client_address[0], COLOUR_GREEN))
+            # The response may have been left half-written.
+            self.close_connection = 1
             if not f:
                 self.send_error(500)
 
@@ -760,9 +955,91 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         '.h': 'text/plain',
         })
 
+    def end_headers(self):
+        """Finish the response headers, settling how the response body is framed
+        and whether the connection will be kept open for another request."""
+
+        if getattr(self, 'response_code', None) is not None:
+            if args[TITLE_KEEP_ALIVE_REQUESTS] and self.requests_handled >= args[TITLE_KEEP_ALIVE_REQUESTS]:
+                self.close_connection = 1
+            if not self.alive:
+                self.close_connection = 1
+
+            if not self.response_framed and self.response_has_body():
+                if self.request_version >= "HTTP/1.1" and not self.close_connection:
+                    # Length is not known up front, send the body in chunks.
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.chunked = True
+                else:
+                    # The end of the body can only be marked by closing the connection.
+                    self.close_connection = 1
+
+            if not self.response_connection:
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                elif self.request_version < "HTTP/1.1":
+                    self.send_header('Connection', 'keep-alive')
+
+        BaseHTTPRequestHandler.end_headers(self)
+
+    def finish_request_body(self):
+        """Line the connection up with the start of the next request once a response has gone out.
+        Handlers that read the request body set body_read. Otherwise, a small body is read and thrown away,
+         and anything else closes the connection rather than have the body mistaken for the next request."""
+
+        if self.close_connection or getattr(self, 'body_read', False):
+            return
+
+        headers = getattr(self, ATTR_HEADERS, CaselessDict())
+        if headers.get('Transfer-Encoding'):
+            self.close_connection = 1
+            return
+        try:
+            remaining = int(headers.get('Content-Length') or 0)
+        except ValueError:
+            remaining = -1
+        if remaining < 0 or remaining > DISCARD_BODY_LIMIT:
+            self.close_connection = 1
+            return
+
+        while remaining:
+            data = self.rfile.read(remaining)
+            if not data:
+                self.close_connection = 1
+                return
+            remaining -= len(data)
+
     def get_command(self):
         return getattr(self, ATTR_COMMAND, "GET")
 
+    def get_accepted_encodings(self, available):
+        """Narrow the available encodings down to those accepted by the client's Accept-Encoding header, most preferred first.
+        Encodings that the client weighs equally keep the order they were given in."""
+
+        header = getattr(self, ATTR_HEADERS, CaselessDict()).get('Accept-Encoding') or ''
+
+        weights = {}
+        for item in header.split(','):
+            params = item.split(';')
+            name = params[0].strip().lower()
+            weight = 1.0
+            for param in params[1:]:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            if name:
+                weights[name] = weight
+
+        candidates = []
+        for i, encoding in enumerate(available):
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if weight > 0:
+                candidates.append((-weight, i, encoding))
+        return [encoding for weight, i, encoding in sorted(candidates)]
+
     def get_header_dict(self, src):
         d = CaselessDict()
 
@@ -799,14 +1076,39 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         nice upstream spot to put the whitelist/blacklist feature.
         """
 
+        for attr in self.request_attributes:
+            self.__dict__.pop(attr, None)
+        self.request_sane = False
+
+        if not self.alive:
+            self.close_connection = 1
+            return
+
         try:
-            self.raw_requestline = self.rfile.readline(65537)
+            if self.requests_handled:
+                # Idle persistent connection, waiting for another request.
+                if self.server.connections_waiting():
+                    # Do not tie up a worker thread while other connections are queued for one.
+                    self.close_connection = 1
+                    return
+                self.connection.settimeout(args[TITLE_KEEP_ALIVE_TIMEOUT])
+                try:
+                    self.raw_requestline = self.rfile.readline(65537)
+                except socket.timeout:
+                    self.close_connection = 1
+                    return
+            else:
+                self.connection.settimeout(args[TITLE_TIMEOUT])
+                self.raw_requestline = self.rfile.readline(65537)
+            self.connection.settimeout(args[TITLE_TIMEOUT])
+
             if len(self.raw_requestline) > 65536:
                 return self.send_error(414)
             if not self.raw_requestline:
                 self.close_connection = 1
                 return
 
+            self.requests_handled += 1
             if not self.parse_request():
                 # An error code has been sent, just exit
                 return
@@ -834,6 +1136,7 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 self.send_error(501, "Unsupported method (%r)" % self.command)
                 return
             self.invoke(getattr(self, mname))
+            self.finish_request_body()
 
             self.wfile.flush()
         except socket.timeout:
@@ -841,6 +1144,13 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             self.close_connection = 1
             return self.send_error(408, "Data timeout (%s seconds)" % args[TITLE_TIMEOUT])
 
+    def is_compressible_type(self, mimetype):
+        mimetype = (mimetype or '').split(';')[0].strip().lower()
+        for t in COMPRESS_TYPES:
+            if mimetype == t or (t.endswith('/') and mimetype.startswith(t)):
+                return True
+        return False
+
     def log_date_time_string(self):
         """Return the current time formatted for logging."""
         now = time.time()
@@ -976,6 +1286,34 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
     def quote_html(self, html):
         return html.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
+    def open_file(self, path):
+        """Open a file to send as a response body.
+        If a precompressed copy of the file (e.g. foo.gz next to foo) is at least as new as the file itself,
+         and the client accepts its encoding, then the copy is opened instead."""
+
+        if not args[TITLE_NO_COMPRESS]:
+            mtime = os.stat(path).st_mtime
+            sidecars = {}
+            for encoding, extension in SIDECARS:
+                try:
+                    fs = os.stat(path + extension)
+                except OSError:
+                    continue
+                if stat.S_ISREG(fs.st_mode) and fs.st_mtime >= mtime:
+                    sidecars[encoding] = path + extension
+
+            if sidecars:
+                self.vary_encoding = True
+                for encoding in self.get_accepted_encodings([e for e, extension in SIDECARS if e in sidecars]):
+                    try:
+                        f = open(sidecars[encoding], 'rb')
+                    except IOError:
+                        continue
+                    self.content_encoding = encoding
+                    return f
+
+        return open(path, 'rb')
+
     def parse_path(self, raw_path):
         """Translate a /-separated PATH to the local filename syntax.
         Components that mean special things to the local file system
@@ -1042,6 +1380,12 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             self.close_connection = 1
         elif (conntype.lower() == 'keep-alive' and self.protocol_version >= "HTTP/1.1"):
             self.close_connection = 0
+
+        if self.headers.get('Transfer-Encoding'):
+            # Chunked request bodies are not supported, so there is no telling where the next request would start.
+            self.close_connection = 1
+        if not args[TITLE_KEEP_ALIVE_TIMEOUT]:
+            self.close_connection = 1
         return True
 
     def parse_preauth_header_user_authorization(self):
@@ -1081,6 +1425,7 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         error is sent back.
         """
 
+        self.close_connection = 1
         self.requestline = convert_str((getattr(self, ATTR_RAW_RLINE, None) or "").rstrip(convert_bytes('\r\n')))
         words = self.requestline.split()
 
@@ -1187,11 +1532,50 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         finally:
             self.finish()
 
+    def send_header(self, keyword, value):
+        key = keyword.lower()
+        if key in ('content-length', 'transfer-encoding'):
+            self.response_framed = True
+        elif key == 'connection':
+            self.response_connection = True
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def send_response(self, code, message = None):
+        self.reset_response(code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def reset_response(self, code):
+        """Start keeping track of the headers that frame a new response.
+        Only needs to be called directly when writing a status line without send_response()."""
+        self.response_code = code
+        self.response_framed = False
+        self.response_connection = False
+
+    def request_reusable(self):
+        """Check whether the connection can carry on to another request after an error response.
+        Errors may be sent before any request body is read, so only well-formed requests without a body qualify."""
+
+        if not self.request_sane:
+            return False
+        headers = getattr(self, ATTR_HEADERS, CaselessDict())
+        return not (headers.get('Transfer-Encoding') or headers.get('Content-Length', '0').strip() not in ('', '0'))
+
+    def response_has_body(self):
+        return not (self.response_code < 200 or self.response_code in (204, 304) or self.command == 'HEAD')
+
     def send_common_headers(self, mimetype, length):
         encoding = sys.getfilesystemencoding()
         self.send_header("Content-Type", "%s; charset=%s" % (mimetype, encoding))
         self.send_header("Content-Length", str(length))
 
+    def send_encoding_headers(self):
+        """Describe how the response body was encoded. Must be called before end_headers()."""
+
+        if getattr(self, 'content_encoding', None):
+            self.send_header('Content-Encoding', self.content_encoding)
+        if getattr(self, 'vary_encoding', False):
+            self.send_header('Vary', 'Accept-Encoding')
+
     def send_error(self, code, message=None):
         """Send and log an error reply.
         Arguments are the error code, and a detailed message.
@@ -1223,7 +1607,8 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 )):
 
                 self.send_response(code, message)
-                self.send_header('Connection', 'close')
+                if not self.request_reusable():
+                    self.send_header('Connection', 'close')
                 if code == 401:
                     self.send_header('WWW-Authenticate', 'Basic realm="%s"' % message)
 
@@ -1234,7 +1619,9 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
                 self.send_header('Content-Length', str(length))
 
             self.end_headers()
-            self.copyobj(f, self.wfile, False)
+            if f and self.response_has_body():
+                # A body on a HEAD response would be read as the start of the next response on a persistent connection.
+                self.copyobj(f, self.wfile, False)
 
         except IOError:
             # Don't shed too many tears for an error that fails
@@ -1250,22 +1637,49 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
         # redirect browser - doing basically what apache does
         self.send_response(307)
         self.send_header("Location", target)
+        self.send_header("Content-Length", "0")
         self.end_headers()
         return None
 
+    def select_encoding(self, mimetype, length):
+        """Pick an encoding to compress a response body with on the fly, or None to send it as-is."""
+
+        if args[TITLE_NO_COMPRESS] or not self.is_compressible_type(mimetype):
+            return None
+
+        # From here on, the response depends on Accept-Encoding even if it goes out uncompressed.
+        self.vary_encoding = True
+
+        if length < args[TITLE_COMPRESS_MIN_SIZE] or getattr(self, ATTR_HEADERS, CaselessDict()).get('Range'):
+            # Not worth the trouble, or ranges that have to be counted out of the uncompressed content.
+            return None
+
+        encodings = self.get_accepted_encodings(COMPRESS_ENCODINGS)
+        if encodings:
+            return encodings[0]
+        return None
+
     def serve_content(self, content = None, code = 200, mimetype = "text/html"):
 
-        f, length = self.serve_content_prepare(content)
+        f, length = self.serve_content_prepare(content, mimetype)
         self.send_response(code)
         self.send_common_headers(mimetype, length)
+        self.send_encoding_headers()
         self.end_headers()
         return f
 
-    def serve_content_prepare(self, content):
+    def serve_content_prepare(self, content, mimetype = None):
+        """Prepare generated content to be sent. If a mimetype is given, then the content may be compressed."""
 
         if not content:
             return None, 0
 
+        encoding = mimetype and self.select_encoding(mimetype, len(content))
+        if encoding:
+            data = compression_cache.compress(convert_bytes(content), encoding)
+            self.content_encoding = encoding
+            return io.BytesIO(data), len(data)
+
         f = StringIO()
         f.write(content)
         length = f.tell()
@@ -1283,14 +1697,17 @@ class CoreHttpServer(BaseHTTPRequestHandler, object):
             # Always read in binary mode. Opening files in text mode may cause
             # newline translations, making the actual size of the content
             # transmitted *less* than the content-length!
-            f = open(path, 'rb')
-        except IOError:
+            f = self.open_file(path)
+        except (IOError, OSError):
             return self.send_error(404, 'Not Found')
+        fs = os.fstat(f.fileno())
+        f, length = self.compress_file(f, ctype, fs[6])
         self.send_response(200)
         self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
+        if length is not None:
+            self.send_header("Content-Length", str(length))
         self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_encoding_headers()
         self.end_headers()
         return f
 
@@ -1355,10 +1772,86 @@ class CaselessDict(dict):
 
     __getitem__ = get
 
+def get_compressor(encoding):
+    """Start compressing a stream. Returns a function to compress each piece of the stream with, and one to finish it off."""
+
+    if encoding == ENCODING_BROTLI:
+        compressor = brotli.Compressor(quality = COMPRESS_LEVEL_BROTLI)
+        return compressor.process, compressor.finish
+    # A window of 16+MAX_WBITS makes zlib write a gzip header and trailer.
+    compressor = zlib.compressobj(COMPRESS_LEVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+class CompressedFile(object):
+    """Read-only file object that compresses another file as it is read.
+    Memory use stays flat no matter how large the file is, but the compressed length is not known up front."""
+
+    BLOCK_SIZE = 64*1024
+
+    def __init__(self, src, encoding):
+        self.src = src
+        self.compress, self.finish = get_compressor(encoding)
+        self.done = False
+
+    def read(self, size = -1):
+        # The compressor decides how much output each block makes, so size is disregarded.
+        while not self.done:
+            buf = self.src.read(self.BLOCK_SIZE)
+            if buf:
+                data = self.compress(buf)
+            else:
+                data = self.finish()
+                self.done = True
+            if data:
+                return data
+        return b''
+
+    def close(self):
+        self.src.close()
+
+class CompressionCache:
+    """Compressed copies of generated pages (e.g. directory listings),
+     so that a page that has not changed since it was last requested is not compressed all over again.
+    Pages are looked up by a digest of their content, and the least recently used are dropped once the cache is full."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = collections.OrderedDict()
+        self.size = 0
+
+    def compress(self, content, encoding):
+        limit = args[TITLE_COMPRESS_CACHE] * 1024 * 1024
+        key = (encoding, hashlib.sha1(content).digest())
+
+        with self.lock:
+            data = self.pages.pop(key, None)
+            if data is not None:
+                self.pages[key] = data
+                return data
+
+        compress, finish = get_compressor(encoding)
+        data = compress(content) + finish()
+
+        if len(data) <= limit:
+            with self.lock:
+                if key not in self.pages:
+                    self.pages[key] = data
+                    self.size += len(data)
+                while self.size > limit:
+                    old = self.pages.popitem(last = False)[1]
+                    self.size -= len(old)
+        return data
+
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
+    # Basic IPv4 syntax checks
+    REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
     REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
 
+    # Most addresses to remember a verdict for
+    CACHE_SIZE = 4096
+    # Seconds between checks on watched files, if inotify is not available
+    WATCH_INTERVAL = 5
+
     def __init__(self):
         self.errors = []
         self.allowed_addresses = []
@@ -1366,9 +1859,17 @@ class NetAccess:
         self.denied_addresses = []
         self.denied_networks = []
 
+        # Sorted, non-overlapping ranges of allowed and denied addresses, built from the lists above as needed,
+        #  along with verdicts for recently-checked addresses (oldest first).
+        # Replaced as a whole on reloading, so that is_allowed() never sees half of a change.
+        self.compiled = None
+        # Entries and files in the order that they were added, as (method name, value), for reloading.
+        self.sources = []
+
     def add_access(self, addr_list, net_list, candidate):
         good = True
         candidate = candidate.strip()
+        if not candidate or candidate.startswith('#'): return True # Blank line or comment in a file
         if re.match(self.REGEX_INET4_CIDR, candidate):
             g, n = self.ip_validate_cidr(candidate)
             good = g
@@ -1377,16 +1878,19 @@ class NetAccess:
                 net_list.append((n, candidate))
         else:
             g, a, astr = self.ip_validate_address(candidate)
-            error = g
+            good = g
             if g:
                 # No error
                 addr_list.append((a, candidate, astr))
+        self.compiled = None
         return good
 
     def add_blacklist(self, candidate):
+        self.sources.append(('add_blacklist', candidate))
         return self.add_access(self.denied_addresses, self.denied_networks, candidate)
 
     def add_whitelist(self, candidate):
+        self.sources.append(('add_whitelist', candidate))
         return self.add_access(self.allowed_addresses, self.allowed_networks, candidate)
 
     def announce_filter_actions(self):
@@ -1401,29 +1905,49 @@ class NetAccess:
                 else:
                     print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
 
+    def compile(self):
+        # Merge the lists into sorted ranges that can be searched with bisect,
+        #  so that checking an address does not mean going through every entry.
+        self.compiled = (self.compile_ranges(self.allowed_addresses, self.allowed_networks), self.compile_ranges(self.denied_addresses, self.denied_networks), collections.OrderedDict())
+
+    def compile_ranges(self, addr_list, net_list):
+        # Returns a list of range starts, and a list of the matching range ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(a[0], a[0]) for a in addr_list] + [n[0] for n in net_list]):
+            if ends and start <= ends[-1] + 1:
+                # Overlaps or runs into the previous range.
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
-    def ip_make_mask(self, n):
-        # Return a mask of n bits as a long integer
-        return (2<<n-1)-1
+    def ip_in_ranges(self, n, ranges):
+        # Is a numeric address in a list of compiled ranges?
+        starts, ends = ranges
+        i = bisect.bisect_right(starts, n) - 1
+        return i >= 0 and n <= ends[i]
 
     def ip_strton(self, ip):
-        # Convert decimal dotted quad string to long integer
-        return struct.unpack('<L',socket.inet_aton(ip))[0]
+        # Convert decimal dotted quad string to an integer
+        return struct.unpack('!L',socket.inet_aton(ip))[0]
 
-    def ip_network_mask(self, ip, bits):
-        # Convert a network address to a long integer
-        return self.ip_strton(ip) & self.ip_make_mask(int(bits))
-
-    def ip_addrn_in_network(self, ip, net):
-        # Is a numeric address in a network?
-        return ip & net == net
+    def ip_network_range(self, ip, bits):
+        # Convert a network to the first and last addresses in it, as integers
+        host_mask = (1 << (32 - int(bits))) - 1
+        start = self.ip_strton(ip) & ~host_mask
+        return (start, start | host_mask)
 
     def ip_validate_address(self, candidate):
         try:
-            ip = socket.gethostbyname(candidate)
+            # Only look up names. Addresses do not need a trip to DNS.
+            if re.match(self.REGEX_INET4, candidate): ip = candidate
+            else: ip = socket.gethostbyname(candidate)
             return (True, self.ip_strton(ip), ip)
-        except socket.gaierror:
+        except socket.error:
             self.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
             return (False, None, None)
 
@@ -1431,59 +1955,127 @@ class NetAccess:
         a = candidate.split("/")[0]
         m = candidate.split("/")[1]
         try:
-            if socket.gethostbyname(a) and int(m) <= 32:
-                return (True, self.ip_network_mask(a, m))
-        except socket.gaierror:
+            if int(m) <= 32:
+                return (True, self.ip_network_range(a, m))
+        except socket.error:
             pass
         self.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
         return (False, None)
 
     def is_allowed(self, address):
         # Blacklist/Whitelist filtering
-        allowed = True
+        if self.compiled is None: self.compile()
+        allowed_ranges, denied_ranges, cache = self.compiled
+        if not allowed_ranges[0] and not denied_ranges[0]: return True
 
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
+        verdict = cache.pop(address, None)
+        if verdict is None:
+            try: n = self.ip_strton(address)
+            except (socket.error, TypeError): n = None # Not an IPv4 address, so no entry can match it.
 
-            if address in [a[2] for a in self.allowed_addresses]:
-                allowed = True
-            else:
-                # Try checking allowed networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.allowed_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
+            # Whitelist processing, address is not allowed until it is cleared.
+            verdict = not allowed_ranges[0] or (n is not None and self.ip_in_ranges(n, allowed_ranges))
             # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
+            if verdict and n is not None and self.ip_in_ranges(n, denied_ranges): verdict = False
 
-            if address in [a[2] for a in self.denied_addresses]:
-                allowed = False
-            else:
-                # Try checking denied networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.denied_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(self, fn, path, header):
+            if len(cache) >= self.CACHE_SIZE: cache.popitem(last = False)
+        cache[address] = verdict
+        return verdict
+
+    def load_access_file(self, addr_list, net_list, path, header):
         if not os.path.isfile(path):
             self.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines():
-                fn(l)
+            for l in f:
+                self.add_access(addr_list, net_list, l)
+        return True
 
     def load_blacklist_file(self, path):
-        return self.load_access_file(self.add_blacklist, path, "blacklist")
+        self.sources.append(('load_blacklist_file', path))
+        return self.load_access_file(self.denied_addresses, self.denied_networks, path, "blacklist")
 
     def load_whitelist_file(self, path):
-        return self.load_access_file(self.add_whitelist, path, "whitelist")
+        self.sources.append(('load_whitelist_file', path))
+        return self.load_access_file(self.allowed_addresses, self.allowed_networks, path, "whitelist")
+
+    def reload(self):
+        # Rebuild everything from scratch, then swap it in.
+        # Checks that are already underway finish against the old lists.
+        if [value for name, value in self.sources if name.endswith('_file') and not os.path.isfile(value)]:
+            # Most likely caught in the middle of being replaced. Keep the current lists until the next change.
+            return False
+
+        fresh = NetAccess()
+        for name, value in self.sources: getattr(fresh, name)(value)
+
+        for error in fresh.errors: print_warning("Reloading access lists: %s" % error)
+        fresh.compile()
+        self.allowed_addresses, self.allowed_networks = fresh.allowed_addresses, fresh.allowed_networks
+        self.denied_addresses, self.denied_networks = fresh.denied_addresses, fresh.denied_networks
+        self.compiled = fresh.compiled
+        return True
+
+    def watch(self):
+        # Reload the lists in the background whenever one of their files changes.
+        # Threads do not survive a fork, so this should be called in the process that will be checking addresses.
+        paths = [os.path.realpath(value) for name, value in self.sources if name.endswith('_file')]
+        if not paths: return False
+
+        t = threading.Thread(target=self.watch_files, args=(paths,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def watch_files(self, paths):
+        try: self.watch_files_inotify(paths)
+        except (ImportError, OSError, AttributeError): self.watch_files_poll(paths)
+
+    def watch_files_inotify(self, paths):
+        # Watch the directories rather than the files, so that files that are replaced
+        #  (written elsewhere and then renamed into place) are still caught.
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        try:
+            names = {}
+            for path in paths:
+                directory, name = os.path.split(path)
+                # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                wd = libc.inotify_add_watch(fd, directory.encode('utf-8'), 0x08 | 0x80 | 0x100)
+                if wd < 0: raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+                names.setdefault(wd, set()).add(name.encode('utf-8'))
+
+            while True:
+                data = os.read(fd, 65536)
+                changed = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                    offset += 16 + length
+                    if name in names.get(wd, ()): changed = True
+
+                if changed:
+                    # Let a burst of changes settle before reading.
+                    time.sleep(0.5)
+                    self.reload()
+        finally: os.close(fd)
+
+    def watch_files_poll(self, paths):
+        def stat(path):
+            try:
+                st = os.stat(path)
+                return (st.st_ino, st.st_size, st.st_mtime)
+            except OSError: return None
+
+        last = [stat(path) for path in paths]
+        while True:
+            time.sleep(self.WATCH_INTERVAL)
+            current = [stat(path) for path in paths]
+            if current != last and self.reload(): last = current
 
 class SimpleAuthStore:
     def __init__(self, user, password):
@@ -1497,13 +2089,40 @@ class SimpleAuthStore:
             return AUTH_BAD_PASSWORD
         return AUTH_BAD_NOT_FOUND
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+class ThreadedHTTPServer(HTTPServer):
+    """Handle requests with a fixed pool of worker threads.
+    Accepted connections wait in a bounded queue for a free worker."""
 
     attempts = {}
-    requests = {}
     alive = True
 
+    def __init__(self, server_address, handler):
+        HTTPServer.__init__(self, server_address, handler)
+
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.clients = collections.Counter() # Queued or active connections by client address
+        self.queue = Queue(args[TITLE_QUEUE_SIZE])
+        self.busy = 0
+        self.peak_queued = 0
+        self.accepted = 0
+        self.rejected = {'queue': 0, 'client': 0}
+
+        for i in range(args[TITLE_THREADS]):
+            t = threading.Thread(target=self.work)
+            # Idle keep-alive connections should not hold up shutting down.
+            t.daemon = True
+            t.start()
+
+    def connections_waiting(self):
+        """Count connections that are stuck waiting because every worker thread is busy."""
+        if self.busy < args[TITLE_THREADS]:
+            return 0
+        return self.queue.qsize()
+
+    def enable_ssl(self, certfile, keyfile):
+        self.socket = ssl.wrap_socket(self.socket, server_side=True, keyfile=keyfile, certfile=certfile)
+
     def finish_request(self, request, client_address):
         """Finish one request by instantiating RequestHandlerClass."""
 
@@ -1511,17 +2130,683 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
             return
 
         req = self.RequestHandlerClass(request, client_address, self)
-        if sys.version_info[0] == 2:
-            req.rfile._sock.settimeout(args[TITLE_TIMEOUT])
-
-        self.requests[client_address] = req
-        req.run()
-        del self.requests[client_address]
+        with self.lock:
+            self.requests[client_address] = req
+        try:
+            req.run()
+        finally:
+            with self.lock:
+                del self.requests[client_address]
+
+    def get_busy_response(self):
+        content = DEFAULT_ERROR_MESSAGE % {'code': 503, 'message': 'Service Unavailable', 'explain': 'The server is too busy to handle this request.'}
+        return convert_bytes("HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/html\r\nContent-Length: %d\r\nRetry-After: 1\r\nConnection: close\r\n\r\n%s" % (len(content), content))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'threads': args[TITLE_THREADS],
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'queue_size': args[TITLE_QUEUE_SIZE],
+                'peak_queued': self.peak_queued,
+                'accepted': self.accepted,
+                'rejected': dict(self.rejected),
+                'clients': dict(self.clients)
+            }
 
     def kill_requests(self):
         self.alive = False
-        for client_address in list(self.requests.keys()):
-            self.requests[client_address].alive = False
+        with self.lock:
+            for req in self.requests.values():
+                req.alive = False
+
+    def process_request(self, request, client_address):
+        """Hand a new connection off to the worker threads, or turn it away if there is no room."""
+
+        client = client_address[0]
+        limit = args[TITLE_CLIENT_LIMIT]
+        with self.lock:
+            limited = limit and self.clients[client] >= limit
+            if limited:
+                self.rejected['client'] += 1
+            else:
+                self.clients[client] += 1
+        if limited:
+            return self.reject(request, client_address, 'client limit')
+
+        while True:
+            try:
+                # In queue mode, block the accept loop until a worker catches up.
+                # Check in every so often so that a shutdown is not held up.
+                self.queue.put((request, client_address), args[TITLE_OVERFLOW] == OVERFLOW_QUEUE and self.alive, 1)
+                break
+            except Full:
+                if args[TITLE_OVERFLOW] == OVERFLOW_QUEUE and self.alive:
+                    continue
+                with self.lock:
+                    self.release(client)
+                    self.rejected['queue'] += 1
+                return self.reject(request, client_address, 'queue full')
+
+        with self.lock:
+            self.accepted += 1
+            self.peak_queued = max(self.peak_queued, self.queue.qsize())
+
+    def reject(self, request, client_address, reason):
+        """Send a bare-bones 503 error and close the connection.
+        This runs in the accept loop, so do not wait long on a client that is not reading."""
+
+        if args[TITLE_VERBOSE]:
+            print_warning("Turned away %s: %s" % (colour_text(client_address[0], COLOUR_GREEN), reason))
+
+        try:
+            request.settimeout(1)
+            request.sendall(self.get_busy_response())
+        except (socket.error, ssl.SSLError):
+            pass
+        self.shutdown_request(request)
+
+    def release(self, client):
+        # Lock must already be held.
+        self.clients[client] -= 1
+        if self.clients[client] <= 0:
+            del self.clients[client]
+
+    def serve_stats(self, address):
+        server = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = convert_bytes(json.dumps(server.get_stats(), indent=2))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', len(content))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args): pass
+
+        class StatsServer(HTTPServer):
+            def verify_request(self, request, client_address):
+                # Statistics list client addresses, so they are held to the same access lists as the main server.
+                return access.is_allowed(client_address[0])
+
+        stats_server = StatsServer(address, StatsHandler)
+        t = threading.Thread(target=stats_server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def verify_request(self, request, client_address):
+        """Turn away clients that are not allowed by access lists."""
+        return access.is_allowed(client_address[0])
+
+    def work(self):
+        while True:
+            request, client_address = self.queue.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.lock:
+                    self.busy -= 1
+                    self.release(client_address[0])
+
+class SelectorConnection(object):
+    """State for one client connection in the selector engine.
+    Everything here belongs to the event loop except for the output queue,
+    which a worker thread fills while running a request."""
+
+    # Stop reading from a client that has this much unprocessed input (e.g. a long pipeline).
+    INPUT_LIMIT = 1024*1024
+    # Block a worker thread writing a response once this much output is waiting to be sent.
+    # Files queued with sendfile() do not count towards this.
+    OUTPUT_LIMIT = 1024*1024
+    # Request bodies larger than this are spooled to a temporary file.
+    SPOOL_SIZE = 1024*1024
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.sock = sock
+        self.client_address = client_address
+
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+        self.handshake_events = selectors.EVENT_READ
+
+        self.buf = b''
+        self.head = None
+        self.body = None
+        self.body_remaining = 0
+        self.close_after = False
+
+        self.requests = 0
+        self.busy = False
+        self.done = False # Response is complete once the output queue is empty
+        self.worker_done = False
+        self.closed = False
+        self.events = 0
+        self.last_active = time.time()
+
+        self.cond = threading.Condition()
+        self.out = collections.deque() # bytes, or [fd, offset, count] for sendfile() segments
+        self.out_bytes = 0
+
+    def queue_file(self, f, offset, count):
+        """Queue count bytes of f at offset to be sent from the event loop.
+        The descriptor is duplicated so that the handler is free to close f."""
+
+        with self.cond:
+            if self.closed:
+                raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+            last = self.out and self.out[-1]
+            if isinstance(last, list) and last[3] is f and last[1] + last[2] == offset:
+                # Continuing on from the last segment
+                last[2] += count
+            else:
+                self.out.append([os.dup(f.fileno()), offset, count, f])
+        self.server.wake(self)
+
+    def write(self, data):
+        """Queue data to be sent from the event loop, waiting for the client to catch up if too much is already queued."""
+
+        with self.cond:
+            while self.out_bytes >= self.OUTPUT_LIMIT and not self.closed:
+                self.cond.wait(1)
+            if self.closed:
+                raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+            self.out.append(bytes(data))
+            self.out_bytes += len(data)
+        self.server.wake(self)
+
+    def finish(self, close):
+        # Called by the worker thread once the handler is done with a request.
+        with self.cond:
+            self.worker_done = True
+            self.close_after = self.close_after or close
+        self.server.wake(self)
+
+class SelectorRequest(object):
+    """Stand-in for the client socket that is given to request handlers in the selector engine.
+    Reads come from the request that the event loop has already buffered, and
+    writes are queued up for the event loop to send."""
+
+    def __init__(self, conn, rfile):
+        self.conn = conn
+        self.rfile = rfile
+
+    def makefile(self, mode = 'r', bufsize = -1):
+        if 'r' in mode:
+            return self.rfile
+        return self
+
+    def sendall(self, data):
+        self.conn.write(data)
+
+    def write(self, data):
+        self.conn.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def sendfile(self, f, offset = 0, count = None):
+        """Queue up a section of a regular file, to be sent with sendfile(2) by the event loop.
+        Returns the number of bytes queued, which is 0 once offset reaches the end of the file."""
+        remaining = os.fstat(f.fileno()).st_size - offset
+        if count is None or count < 0 or count > remaining:
+            count = remaining
+        if count <= 0:
+            return 0
+        self.conn.queue_file(f, offset, count)
+        return count
+
+    def settimeout(self, timeout):
+        # Timeouts are enforced by the event loop.
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+class SelectorHTTPServer(ThreadedHTTPServer):
+    """Keep connections in a selector event loop instead of giving each one a worker thread.
+
+    The event loop accepts connections, waits on idle keep-alive connections, buffers each request,
+    and sends responses out as the client is able to take them (using sendfile(2) for files).
+    Only complete requests are handed to the worker threads, which run the same request handlers
+    as the threaded engine against a SelectorRequest stand-in for the client socket."""
+
+    request_queue_size = 1024
+
+    def __init__(self, server_address, handler):
+        ThreadedHTTPServer.__init__(self, server_address, handler)
+
+        self.ssl_context = None
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.accepting = True
+
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.woken = collections.deque()
+
+        self.connections = {}
+        self.pending = collections.deque() # Connections with a complete request waiting for a worker thread
+        self.dispatched = 0
+
+    def connections_waiting(self):
+        # Workers never wait on idle connections in this engine.
+        return 0
+
+    def enable_ssl(self, certfile, keyfile):
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile, keyfile)
+
+    def get_stats(self):
+        stats = ThreadedHTTPServer.get_stats(self)
+        stats['queued'] = len(self.pending)
+        stats['connections'] = len(self.connections)
+        return stats
+
+    def wake(self, conn):
+        """Have the event loop look at a connection again. Called from worker threads."""
+        self.woken.append(conn)
+        try:
+            self.wakeup_w.send(b'\0')
+        except socket.error:
+            # Buffer is full, so the loop is already due to wake up.
+            pass
+
+    def serve_forever(self, poll_interval = 1):
+        last_sweep = time.time()
+        while self.alive:
+            for key, mask in self.selector.select(poll_interval):
+                if key.fileobj is self.socket:
+                    self.accept()
+                elif key.fileobj is self.wakeup_r:
+                    self.handle_wakeups()
+                else:
+                    conn = key.data
+                    if conn.handshaking:
+                        self.handshake(conn)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.send(conn)
+                    if mask & selectors.EVENT_READ and not conn.closed:
+                        self.receive(conn)
+
+            now = time.time()
+            if now - last_sweep >= 1:
+                last_sweep = now
+                self.sweep(now)
+
+    def accept(self):
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error:
+                return
+
+            if not self.verify_request(sock, client_address):
+                sock.close()
+                continue
+
+            client = client_address[0]
+            limit = args[TITLE_CLIENT_LIMIT]
+            with self.lock:
+                limited = limit and self.clients[client] >= limit
+                if limited:
+                    self.rejected['client'] += 1
+                else:
+                    self.clients[client] += 1
+                    self.accepted += 1
+            if limited:
+                self.reject(sock, client_address, 'client limit')
+                continue
+
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.ssl_context:
+                try:
+                    sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+                except (ssl.SSLError, socket.error):
+                    sock.close()
+                    with self.lock:
+                        self.release(client)
+                    continue
+
+            conn = SelectorConnection(self, sock, client_address)
+            self.connections[sock.fileno()] = conn
+            self.update(conn)
+
+    def close(self, conn):
+        if conn.closed:
+            return
+        with conn.cond:
+            conn.closed = True
+            for item in conn.out:
+                if isinstance(item, list):
+                    os.close(item[0])
+            conn.out.clear()
+            conn.out_bytes = 0
+            # Wake up a worker waiting for room to write.
+            conn.cond.notify_all()
+
+        self.connections.pop(conn.sock.fileno(), None)
+        if conn.events:
+            self.selector.unregister(conn.sock)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        if conn.body:
+            conn.body.close()
+        if conn in self.pending:
+            self.pending.remove(conn)
+        with self.lock:
+            self.release(conn.client_address[0])
+
+    def dispatch(self):
+        while self.pending and self.dispatched < args[TITLE_THREADS]:
+            conn = self.pending.popleft()
+            self.dispatched += 1
+
+            if conn.body:
+                rfile = conn.body
+                rfile.seek(0)
+                conn.body = None
+            else:
+                rfile = io.BytesIO(conn.head)
+            conn.head = None
+            self.queue.put((conn, rfile))
+
+        if not self.accepting and len(self.pending) < args[TITLE_QUEUE_SIZE]:
+            self.accepting = True
+            self.selector.register(self.socket, selectors.EVENT_READ)
+
+    def handle_wakeups(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+        while self.woken:
+            conn = self.woken.popleft()
+            if conn.worker_done:
+                # A worker thread is free again, whatever became of the connection.
+                conn.worker_done = False
+                self.dispatched -= 1
+                self.dispatch()
+                if conn.closed:
+                    continue
+                conn.done = True
+                if not conn.out:
+                    self.finish(conn)
+                    continue
+            if not conn.closed:
+                self.update(conn)
+
+    def finish(self, conn):
+        """Wrap up a request once its whole response has been sent."""
+
+        conn.done = False
+        conn.busy = False
+        conn.last_active = time.time()
+        if conn.close_after:
+            return self.close(conn)
+        self.parse(conn)
+        if not conn.closed:
+            self.update(conn)
+
+    def handshake(self, conn):
+        try:
+            conn.sock.do_handshake()
+            conn.handshaking = False
+        except ssl.SSLWantReadError:
+            conn.handshake_events = selectors.EVENT_READ
+        except ssl.SSLWantWriteError:
+            conn.handshake_events = selectors.EVENT_WRITE
+        except (ssl.SSLError, socket.error):
+            return self.close(conn)
+        conn.last_active = time.time()
+        self.update(conn)
+
+    def parse(self, conn):
+        """Look for a complete request in the input buffer, and queue it up for a worker thread if there is one."""
+
+        if conn.busy or conn.closed:
+            return
+
+        if conn.head is None:
+            end = conn.buf.find(b'\r\n\r\n')
+            if end < 0:
+                line_end = conn.buf.find(b'\n')
+                if line_end >= 0 and len(conn.buf[:line_end].split()) == 2:
+                    # HTTP/0.9 request, no headers to follow.
+                    end = line_end - 3
+                elif len(conn.buf) > 65536 + 65536:
+                    # Let the handler complain about the oversized request line or headers.
+                    end = len(conn.buf) - 4
+                    conn.close_after = True
+                else:
+                    return
+
+            conn.head, conn.buf = conn.buf[:end+4], conn.buf[end+4:]
+            conn.body_remaining = 0
+            match = re.search(br'(?im)^content-length:[ \t]*(\d+)[ \t]*\r?$', conn.head)
+            if match:
+                conn.body_remaining = int(match.group(1))
+            if re.search(br'(?im)^transfer-encoding:', conn.head):
+                # Chunked request bodies are not supported, and the handler will close the connection.
+                conn.close_after = True
+            if conn.body_remaining and re.search(br'(?im)^expect:[ \t]*100-continue', conn.head):
+                conn.out.append(b'HTTP/1.1 100 Continue\r\n\r\n')
+                conn.out_bytes += 25
+            if conn.body_remaining > conn.SPOOL_SIZE:
+                conn.body = tempfile.TemporaryFile()
+                conn.body.write(conn.head)
+
+        if conn.body_remaining:
+            chunk, conn.buf = conn.buf[:conn.body_remaining], conn.buf[conn.body_remaining:]
+            conn.body_remaining -= len(chunk)
+            if conn.body:
+                conn.body.write(chunk)
+            else:
+                conn.head += chunk
+            if conn.body_remaining:
+                return
+
+        conn.busy = True
+        conn.requests += 1
+        if len(self.pending) >= args[TITLE_QUEUE_SIZE]:
+            if args[TITLE_OVERFLOW] == OVERFLOW_REJECT:
+                with self.lock:
+                    self.rejected['queue'] += 1
+                return self.reject_connection(conn)
+            # Stop taking on new connections until the queue drains.
+            if self.accepting:
+                self.accepting = False
+                self.selector.unregister(self.socket)
+
+        self.pending.append(conn)
+        with self.lock:
+            self.peak_queued = max(self.peak_queued, len(self.pending))
+        self.dispatch()
+
+    def receive(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+            while data and conn.handshaking is False and isinstance(conn.sock, ssl.SSLSocket) and conn.sock.pending():
+                data += conn.sock.recv(conn.sock.pending())
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            return self.close(conn)
+
+        if not data:
+            # Client has hung up, or at least stopped sending.
+            # Anything short of a complete request is not going anywhere, but let a running request finish.
+            conn.close_after = True
+            if not conn.busy:
+                return self.close(conn)
+            return self.update(conn)
+
+        conn.last_active = time.time()
+        conn.buf += data
+        self.parse(conn)
+        if not conn.closed:
+            self.update(conn)
+
+    def reject_connection(self, conn):
+        if args[TITLE_VERBOSE]:
+            print_warning("Turned away %s: %s" % (colour_text(conn.client_address[0], COLOUR_GREEN), 'queue full'))
+
+        response = self.get_busy_response()
+        conn.out.append(response)
+        conn.out_bytes += len(response)
+        conn.close_after = True
+        conn.done = True
+        self.update(conn)
+
+    def run_request(self, conn, rfile):
+        """Run one request through the handler in a worker thread.
+        Returns True if the connection should be closed afterwards."""
+
+        req = self.RequestHandlerClass(SelectorRequest(conn, rfile), conn.client_address, self)
+        req.requests_handled = conn.requests - 1
+        req.close_connection = 1
+        with self.lock:
+            self.requests[id(req)] = req
+        try:
+            req.handle_one_request()
+            req.wfile.flush()
+        finally:
+            with self.lock:
+                del self.requests[id(req)]
+            rfile.close()
+        return req.close_connection
+
+    def send(self, conn):
+        """Send as much of the queued response as the client will take."""
+
+        try:
+            while conn.out:
+                with conn.cond:
+                    item = conn.out[0]
+                    # Gather up small writes (e.g. headers and a short body) into one packet.
+                    while isinstance(item, bytes) and len(item) < 65536 and len(conn.out) > 1 and isinstance(conn.out[1], bytes):
+                        conn.out.popleft()
+                        item = conn.out[0] = item + conn.out[0]
+
+                if isinstance(item, list):
+                    fd, offset, count = item[:3]
+                    size = min(count, SENDFILE_CHUNK)
+                    if isinstance(conn.sock, ssl.SSLSocket):
+                        # Has to be encrypted in userspace.
+                        sent = conn.sock.send(os.pread(fd, min(size, 65536), offset))
+                    else:
+                        sent = os.sendfile(conn.sock.fileno(), fd, offset, size)
+                    if not sent:
+                        # File shrank underneath us, the response can not be completed.
+                        return self.close(conn)
+                    with conn.cond:
+                        item[1] += sent
+                        item[2] -= sent
+                        if not item[2]:
+                            os.close(fd)
+                            conn.out.popleft()
+                else:
+                    sent = conn.sock.send(item)
+                    with conn.cond:
+                        if sent < len(item):
+                            conn.out[0] = item[sent:]
+                        else:
+                            conn.out.popleft()
+                        conn.out_bytes -= sent
+                        conn.cond.notify_all()
+                conn.last_active = time.time()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError, InterruptedError):
+            pass
+        except socket.error:
+            return self.close(conn)
+
+        if not conn.out and conn.done:
+            self.finish(conn)
+        elif not conn.closed:
+            self.update(conn)
+
+    def sweep(self, now):
+        """Close connections that have gone quiet for too long."""
+
+        for conn in list(self.connections.values()):
+            idle = now - conn.last_active
+            if conn.busy and not conn.out:
+                # Waiting on a worker thread, not the client.
+                continue
+            if conn.out or conn.buf or conn.head is not None or conn.handshaking or not conn.requests:
+                timeout = args[TITLE_TIMEOUT]
+            else:
+                timeout = args[TITLE_KEEP_ALIVE_TIMEOUT]
+            if idle >= timeout:
+                self.close(conn)
+
+    def update(self, conn):
+        """Register for the events that the connection is waiting on."""
+
+        if conn.closed:
+            return
+        if conn.handshaking:
+            events = conn.handshake_events
+        else:
+            events = 0
+            if len(conn.buf) < conn.INPUT_LIMIT and not conn.close_after:
+                events |= selectors.EVENT_READ
+            if conn.out:
+                events |= selectors.EVENT_WRITE
+
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def work(self):
+        while True:
+            conn, rfile = self.queue.get()
+            if conn.closed:
+                rfile.close()
+                conn.finish(True)
+                continue
+            with self.lock:
+                self.busy += 1
+            close = True
+            try:
+                close = self.run_request(conn, rfile)
+            except Exception:
+                self.handle_error(conn.sock, conn.client_address)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                conn.finish(close)
+
+ENGINES = {ENGINE_THREADS: ThreadedHTTPServer, ENGINE_SELECTOR: SelectorHTTPServer}
 
 access = NetAccess()
+compression_cache = CompressionCache()
 authentication_stores = []
@@ -12,6 +12,8 @@ else:
     from urllib.error import URLError
     from urllib.parse import quote, urlsplit
 
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade')
+
 TITLE_TARGET = "proxy target"
 TITLE_MAX_LENGTH = "max-length"
 common.local_files.append(os.path.realpath(__file__))
@@ -110,6 +112,7 @@ class Proxy(common.CoreHttpServer):
                 # Will have to fix later, but for now this creates potential problems if large files are being uploaded.
                 # This is a good part of the reason why the --max-length flag exists.
                 data = self.rfile.read(l)
+                self.body_read = True
                 # Intentionally not bothering to catch socket.timeout exception. Let it bubble up.
 
 
@@ -132,9 +135,12 @@ class Proxy(common.CoreHttpServer):
 
         if getattr(self, common.ATTR_REQUEST_VERSION, self.default_request_version) != 'HTTP/0.9':
             self.wfile.write(common.convert_bytes("%s %s %s\r\n" % (self.protocol_version, code, getattr(self,common.ATTR_PATH, "/"))))
+        self.reset_response(int(code))
         for key in resp_headers:
             # Write response headers
-            if resp_headers[key]:
+            # Hop-by-hop headers describe the connection to the target rather than to the client.
+            # In particular, urllib has already undone any chunked encoding.
+            if resp_headers[key] and key.lower() not in HOP_BY_HOP_HEADERS:
                 self.send_header(key, resp_headers[key])
         self.end_headers()
 
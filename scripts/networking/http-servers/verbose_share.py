@@ -56,6 +56,8 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
     server_version = "CoreHttpServer (Content Serving)"
 
+    request_attributes = common.CoreHttpServer.request_attributes + ['clip']
+
     suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 
     def __init__(self, request, client_address, server):
@@ -83,10 +85,12 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
                 # Parsed properly, but some joker put in a negative number.
                 raise ValueError()
         except ValueError:
+            self.close_connection = 1 # Cannot tell where the body ends.
             return self.serve_content("Illegal Content-Length header value: %s" % self.headers.get('content-length', 0), 400)
 
         m = args[TITLE_MAX_LENGTH]
         if m and l > m:
+            self.close_connection = 1 # The body is not read.
             return self.serve_content('Maximum length: %d' % m, code = 413)
 
         form = cgi.FieldStorage(
@@ -97,6 +101,7 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
                 'CONTENT_TYPE':self.headers['Content-Type'],
             }
         )
+        self.body_read = True
 
         if 'file' not in form:
             return self.serve_content('No file provided.', 400)
@@ -139,24 +144,27 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
         if getattr(self, 'clip', False):
             start, end = self.ranges[0]
             remaining = end - start + 1 # Account for zero-indexing
-        if start:
-            src.seek(start)
 
-        while self.alive and remaining:
-            buflen = 16*1024
-            if remaining > 0:
-                buflen = min(remaining, buflen)
+        if self.can_sendfile(src, dst):
+            self.copyobj_sendfile(src, start, remaining)
+        else:
+            if start:
+                src.seek(start)
+
+            while self.alive and remaining:
+                buflen = 16*1024
+                if remaining > 0:
+                    buflen = min(remaining, buflen)
 
-            buf = src.read(buflen)
-            if not (buf and self.alive):
-                break
-            remaining -= len(buf)
-            dst.write(common.convert_bytes(buf))
+                buf = src.read(buflen)
+                if not (buf and self.alive):
+                    break
+                remaining -= len(buf)
+                self.write_body(dst, buf)
 
         if not outgoing:
             return
 
-        self.alive = False
         src.close()
 
     def do_GET(self):
@@ -594,12 +602,16 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
     def serve_content(self, content = None, code = 200, mimetype = "text/html"):
 
-        f, length = self.serve_content_prepare(content)
+        f, length = self.serve_content_prepare(content, mimetype)
 
         if self.ranges:
 
             start, end = self.ranges[0]
-            if end >= length:
+            if not end:
+                # Open-ended range, runs through to the end of the content.
+                end = length - 1
+                self.ranges[0] = (start, end)
+            if start >= length or end >= length:
                 return self.send_error(416)
 
             if code == 200:
@@ -624,6 +636,7 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
             self.send_header('Content-Range', 'bytes %(start)d-%(end)d/%(total)d' % display_values)
 
+        self.send_encoding_headers()
         self.end_headers()
         return f
 
@@ -637,24 +650,36 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
             # Always read in binary mode. Opening files in text mode may cause
             # newline translations, making the actual size of the content
             # transmitted *less* than the content-length!
-            f = open(path, 'rb')
+            # Ranges of a precompressed copy are counted out of the copy.
+            f = self.open_file(path)
             fs = os.fstat(f.fileno())
             length = fs[6]
             if self.ranges:
                 start, end = self.ranges[0]
+                if not end:
+                    # Open-ended range, runs through to the end of the file.
+                    end = length - 1
+                    self.ranges[0] = (start, end)
 
-                if end >= length:
+                if start >= length or end >= length:
+                    f.close()
                     return self.send_error(416)
 
                 self.clip = True
                 length_total = length
                 length = end - start + 1 # Account for zero-indexing
-        except IOError:
+            else:
+                f, length = self.compress_file(f, ctype, length)
+        except (IOError, OSError):
             return self.send_error(404, 'Not Found')
 
-        self.send_response(200)
+        if getattr(self, 'clip', False):
+            self.send_response(206)
+        else:
+            self.send_response(200)
         self.send_header("Content-Type", ctype)
-        self.send_header("Content-Length", str(length))
+        if length is not None:
+            self.send_header("Content-Length", str(length))
 
         if getattr(self, 'clip', False):
 
@@ -668,6 +693,7 @@ class SimpleHTTPVerboseReqeustHandler(common.CoreHttpServer):
 
             self.send_header('Content-Range', 'bytes %(start)d-%(end)d/%(total)d' % display_values)
         self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_encoding_headers()
         self.end_headers()
         return f
 
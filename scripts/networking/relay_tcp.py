@@ -2,9 +2,10 @@
 
 from __future__ import print_function
 # General
-import getopt, os, random, re, sys
+import collections, getopt, os, random, re, signal, sys, threading
 # Networking
-import errno, fcntl, select, socket, ssl, struct, time
+import asyncio, bisect, errno, fcntl, json, math, select, socket, ssl, struct, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from ssl import SSLError, SSLWantReadError, SSLWantWriteError
 from select import EPOLLIN, EPOLLET, EPOLLERR, EPOLLHUP, EPOLLONESHOT, EPOLLOUT, EPOLLPRI
 
@@ -50,6 +51,10 @@ def colour_text(text, colour = None):
     # A useful shorthand for applying a colour to a string.
     return "%s%s%s" % (colour, text, COLOUR_OFF)
 
+def describe_error(e):
+    # Some errors (e.g. a reset during an SSL handshake) come without a message.
+    return str(e) or type(e).__name__
+
 def enable_colours(force = False):
     global COLOUR_PURPLE
     global COLOUR_RED
@@ -367,9 +372,15 @@ class OptArg:
 ###
 
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
+    # Basic IPv4 syntax checks
+    REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
     REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
 
+    # Most addresses to remember a verdict for
+    CACHE_SIZE = 4096
+    # Seconds between checks on watched files, if inotify is not available
+    WATCH_INTERVAL = 5
+
     def __init__(s):
         s.errors = []
         s.allowed_addresses = []
@@ -377,20 +388,39 @@ class NetAccess:
         s.denied_addresses = []
         s.denied_networks = []
 
+        # Sorted, non-overlapping ranges of allowed and denied addresses, built from the lists above as needed,
+        #  along with verdicts for recently-checked addresses (oldest first).
+        # Replaced as a whole on reloading, so that is_allowed() never sees half of a change.
+        s.compiled = None
+        # Entries and files in the order that they were added, as (method name, value), for reloading.
+        s.sources = []
+
     def add_access(s, addr_list, net_list, candidate):
         good = True
         candidate = candidate.strip()
+        if not candidate or candidate.startswith('#'): return True # Blank line or comment in a file
         if re.match(s.REGEX_INET4_CIDR, candidate):
             g, n = s.ip_validate_cidr(candidate)
-            if g: net_list.append((n, candidate))
+            good = g
+            if g:
+                # No error
+                net_list.append((n, candidate))
         else:
             g, a, astr = s.ip_validate_address(candidate)
-            if g: addr_list.append((a, candidate, astr))
-        return g
+            good = g
+            if g:
+                # No error
+                addr_list.append((a, candidate, astr))
+        s.compiled = None
+        return good
 
-    add_blacklist = lambda s, c: s.add_access(s.denied_addresses, s.denied_networks, c)
+    def add_blacklist(s, candidate):
+        s.sources.append(('add_blacklist', candidate))
+        return s.add_access(s.denied_addresses, s.denied_networks, candidate)
 
-    add_whitelist = lambda s, c: s.add_access(s.allowed_addresses, s.allowed_networks, c)
+    def add_whitelist(s, candidate):
+        s.sources.append(('add_whitelist', candidate))
+        return s.add_access(s.allowed_addresses, s.allowed_networks, candidate)
 
     def announce_filter_actions(self):
         for action, address_list, network_list in [("Allowing", self.allowed_addresses, self.allowed_networks), ("Denying", self.denied_addresses, self.denied_networks)]:
@@ -399,30 +429,54 @@ class NetAccess:
             l.extend([("network", s, s) for n, s in network_list])
 
             for title, ip, address in l:
-                if ip == address: print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
-                else: print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+                if ip == address:
+                    print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
+                else:
+                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+
+    def compile(s):
+        # Merge the lists into sorted ranges that can be searched with bisect,
+        #  so that checking an address does not mean going through every entry.
+        s.compiled = (s.compile_ranges(s.allowed_addresses, s.allowed_networks), s.compile_ranges(s.denied_addresses, s.denied_networks), collections.OrderedDict())
+
+    def compile_ranges(s, addr_list, net_list):
+        # Returns a list of range starts, and a list of the matching range ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(a[0], a[0]) for a in addr_list] + [n[0] for n in net_list]):
+            if ends and start <= ends[-1] + 1:
+                # Overlaps or runs into the previous range.
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
 
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
-    # Return a mask of n bits as a long integer
-    ip_make_mask = lambda s, n: (2<<n-1)-1
-
-    # Convert decimal dotted quad string to long integer
-    def ip_strton(s, ip): return struct.unpack('<L',socket.inet_aton(ip))[0]
+    def ip_in_ranges(s, n, ranges):
+        # Is a numeric address in a list of compiled ranges?
+        starts, ends = ranges
+        i = bisect.bisect_right(starts, n) - 1
+        return i >= 0 and n <= ends[i]
 
-    def ip_network_mask(s, ip, bits):
-        # Convert a network address to a long integer
-        return s.ip_strton(ip) & s.ip_make_mask(int(bits))
+    def ip_strton(s, ip):
+        # Convert decimal dotted quad string to an integer
+        return struct.unpack('!L',socket.inet_aton(ip))[0]
 
-    def ip_addrn_in_network(s, ip, net):
-        # Is a numeric address in a network?
-        return ip & net == net
+    def ip_network_range(s, ip, bits):
+        # Convert a network to the first and last addresses in it, as integers
+        host_mask = (1 << (32 - int(bits))) - 1
+        start = s.ip_strton(ip) & ~host_mask
+        return (start, start | host_mask)
 
     def ip_validate_address(s, candidate):
         try:
-            ip = socket.gethostbyname(candidate)
+            # Only look up names. Addresses do not need a trip to DNS.
+            if re.match(s.REGEX_INET4, candidate): ip = candidate
+            else: ip = socket.gethostbyname(candidate)
             return (True, s.ip_strton(ip), ip)
-        except socket.gaierror:
+        except socket.error:
             s.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
             return (False, None, None)
 
@@ -430,62 +484,157 @@ class NetAccess:
         a = candidate.split("/")[0]
         m = candidate.split("/")[1]
         try:
-            if socket.gethostbyname(a) and int(m) <= 32: return (True, self.ip_network_mask(a, m))
-        except socket.gaierror: pass
-
+            if int(m) <= 32:
+                return (True, s.ip_network_range(a, m))
+        except socket.error:
+            pass
         s.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
         return (False, None)
 
-    def is_allowed(self, address):
+    def is_allowed(s, address):
         # Blacklist/Whitelist filtering
-        allowed = True
+        if s.compiled is None: s.compile()
+        allowed_ranges, denied_ranges, cache = s.compiled
+        if not allowed_ranges[0] and not denied_ranges[0]: return True
 
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
+        verdict = cache.pop(address, None)
+        if verdict is None:
+            try: n = s.ip_strton(address)
+            except (socket.error, TypeError): n = None # Not an IPv4 address, so no entry can match it.
 
-            if address in [a[2] for a in self.allowed_addresses]: allowed = True
-            else:
-                # Try checking allowed networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.allowed_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
+            # Whitelist processing, address is not allowed until it is cleared.
+            verdict = not allowed_ranges[0] or (n is not None and s.ip_in_ranges(n, allowed_ranges))
             # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
+            if verdict and n is not None and s.ip_in_ranges(n, denied_ranges): verdict = False
 
-            if address in [a[2] for a in self.denied_addresses]: allowed = False
-            else:
-                # Try checking denied networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.denied_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(s, fn, path, header):
+            if len(cache) >= s.CACHE_SIZE: cache.popitem(last = False)
+        cache[address] = verdict
+        return verdict
+
+    def load_access_file(s, addr_list, net_list, path, header):
         if not os.path.isfile(path):
             s.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines(): fn(l)
+            for l in f:
+                s.add_access(addr_list, net_list, l)
+        return True
+
+    def load_blacklist_file(s, path):
+        s.sources.append(('load_blacklist_file', path))
+        return s.load_access_file(s.denied_addresses, s.denied_networks, path, "blacklist")
+
+    def load_whitelist_file(s, path):
+        s.sources.append(('load_whitelist_file', path))
+        return s.load_access_file(s.allowed_addresses, s.allowed_networks, path, "whitelist")
+
+    def reload(s):
+        # Rebuild everything from scratch, then swap it in.
+        # Checks that are already underway finish against the old lists.
+        if [value for name, value in s.sources if name.endswith('_file') and not os.path.isfile(value)]:
+            # Most likely caught in the middle of being replaced. Keep the current lists until the next change.
+            return False
 
-    def load_blacklist_file(s, path): return s.load_access_file(s.add_blacklist, path, "blacklist")
+        fresh = NetAccess()
+        for name, value in s.sources: getattr(fresh, name)(value)
+
+        for error in fresh.errors: print_warning("Reloading access lists: %s" % error)
+        fresh.compile()
+        s.allowed_addresses, s.allowed_networks = fresh.allowed_addresses, fresh.allowed_networks
+        s.denied_addresses, s.denied_networks = fresh.denied_addresses, fresh.denied_networks
+        s.compiled = fresh.compiled
+        return True
+
+    def watch(s):
+        # Reload the lists in the background whenever one of their files changes.
+        # Threads do not survive a fork, so this should be called in the process that will be checking addresses.
+        paths = [os.path.realpath(value) for name, value in s.sources if name.endswith('_file')]
+        if not paths: return False
+
+        t = threading.Thread(target=s.watch_files, args=(paths,))
+        t.daemon = True
+        t.start()
+        return True
 
-    def load_whitelist_file(s, path): return s.load_access_file(s.add_whitelist, path, "whitelist")
+    def watch_files(s, paths):
+        try: s.watch_files_inotify(paths)
+        except (ImportError, OSError, AttributeError): s.watch_files_poll(paths)
+
+    def watch_files_inotify(s, paths):
+        # Watch the directories rather than the files, so that files that are replaced
+        #  (written elsewhere and then renamed into place) are still caught.
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        try:
+            names = {}
+            for path in paths:
+                directory, name = os.path.split(path)
+                # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                wd = libc.inotify_add_watch(fd, directory.encode('utf-8'), 0x08 | 0x80 | 0x100)
+                if wd < 0: raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+                names.setdefault(wd, set()).add(name.encode('utf-8'))
+
+            while True:
+                data = os.read(fd, 65536)
+                changed = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                    offset += 16 + length
+                    if name in names.get(wd, ()): changed = True
+
+                if changed:
+                    # Let a burst of changes settle before reading.
+                    time.sleep(0.5)
+                    s.reload()
+        finally: os.close(fd)
+
+    def watch_files_poll(s, paths):
+        def stat(path):
+            try:
+                st = os.stat(path)
+                return (st.st_ino, st.st_size, st.st_mtime)
+            except OSError: return None
+
+        last = [stat(path) for path in paths]
+        while True:
+            time.sleep(s.WATCH_INTERVAL)
+            current = [stat(path) for path in paths]
+            if current != last and s.reload(): last = current
 
 # Script Classes
 
+TITLE_ACCEPT_BATCH = "accept-batch"
+TITLE_ACCEPT_RATE = "accept-rate"
+TITLE_ACCEPT_RATE_PER_IP = "accept-rate-per-ip"
 TITLE_BIND = "bind"
+TITLE_BUFFER_SIZE = "buffer-size"
+TITLE_CONNECT_TIMEOUT = "connect-timeout"
+TITLE_ENGINE = "engine"
+TITLE_HANDSHAKE_TIMEOUT = "handshake-timeout"
+TITLE_HIGH_WATERMARK = "high-watermark"
+TITLE_IDLE_TIMEOUT = "idle-timeout"
+TITLE_LOW_WATERMARK = "low-watermark"
+TITLE_NO_SPLICE = "no-splice"
+TITLE_POOL_MAX_IDLE = "pool-max-idle"
+TITLE_POOL_SIZE = "pool-size"
 TITLE_PORT = "port"
+TITLE_PROXY_PROTOCOL = "proxy-protocol"
+TITLE_PROXY_PROTOCOL_ACCEPT = "proxy-protocol-accept"
+TITLE_STATS_BIND = "stats-bind"
+TITLE_STATS_PORT = "stats-port"
 TITLE_VERBOSE="verbose"
+TITLE_WORKERS = "workers"
 
+TITLE_BALANCE_LATENCY = "lowest-latency-target"
+TITLE_BALANCE_LEAST_CONNECTIONS = "least-connections-target"
 TITLE_BALANCE_RANDOM = "random-target"
 TITLE_BALANCE_ROUND_ROBIN = "round-robin-target"
+TITLE_HEALTH_CHECK = "health-check"
 
 TITLE_TARGET_PORT = "target-port"
 TITLE_TARGET_SSL = "target-ssl"
@@ -494,6 +643,10 @@ TITLE_TARGET_SSL_INSECURE = "target-ssl-insecure"
 TITLE_SSL_CERT = "SSL certfile"
 TITLE_SSL_KEY = "SSL keyfile"
 
+ENGINE_ASYNCIO = "asyncio"
+ENGINE_EPOLL = "epoll"
+ENGINES = [ENGINE_EPOLL, ENGINE_ASYNCIO]
+
 TITLE_ALLOW = "allow address/range"
 TITLE_ALLOW_FILE = "allow address/range file"
 TITLE_DENY = "deny address/range"
@@ -501,9 +654,24 @@ TITLE_DENY_FILE = "deny address/range file"
 
 class TcpRelayServer:
 
+    DEFAULT_ACCEPT_BATCH = 32
     DEFAULT_BIND = "0.0.0.0"
+    DEFAULT_BUFFER_SIZE = 65536
+    DEFAULT_CONNECT_TIMEOUT = 10
+    DEFAULT_ENGINE = ENGINE_EPOLL
+    DEFAULT_HANDSHAKE_TIMEOUT = 10
+    DEFAULT_HIGH_WATERMARK = 262144
+    DEFAULT_IDLE_TIMEOUT = 3600
+    DEFAULT_LOW_WATERMARK = 65536
+    DEFAULT_POOL_MAX_IDLE = 30
     DEFAULT_PORT = 4444
     DEFAULT_TARGET_PORT = 4444
+    DEFAULT_WORKERS = 1
+
+    # Workers that die this soon after being started are assumed to be unable to start at all.
+    WORKER_STARTUP_GRACE = 1
+    # Seconds between sweeps of per-address rate limits for addresses that have gone quiet.
+    RATE_PRUNE_INTERVAL = 60
 
     def __init__(self):
 
@@ -521,12 +689,35 @@ class TcpRelayServer:
 
         args.add_opt(OPT_TYPE_SHORT, "b", TITLE_BIND, "Address to bind to.", default = self.DEFAULT_BIND, default_announce = True, default_colour = COLOUR_GREEN)
         args.add_opt(OPT_TYPE_SHORT, "p", TITLE_PORT, "Specify server bind port.", converter = int, default = self.DEFAULT_PORT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_ENGINE, TITLE_ENGINE, 'Relay engine to use (%s). The asyncio engine will run on uvloop if it is installed.' % ', '.join(ENGINES), default = self.DEFAULT_ENGINE, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_WORKERS, TITLE_WORKERS, 'Number of worker processes to relay with. Each worker binds the port with SO_REUSEPORT.', converter = int, default = self.DEFAULT_WORKERS, default_announce = True)
         args.add_opt(OPT_TYPE_LONG, TITLE_TARGET_PORT, TITLE_TARGET_PORT, 'Specify default target port.', default = self.DEFAULT_TARGET_PORT, default_announce = True)
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_TARGET_SSL, TITLE_TARGET_SSL, 'Indicate that the target is SSL-secured.')
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_TARGET_SSL_INSECURE, TITLE_TARGET_SSL_INSECURE, 'Indicate that the target is SSL-secured, and that the relay should ignore certificate verification errors.')
 
+        args.add_opt(OPT_TYPE_LONG, TITLE_ACCEPT_BATCH, TITLE_ACCEPT_BATCH, 'Most new connections to accept before going back to existing sessions (epoll engine).', converter = int, default = self.DEFAULT_ACCEPT_BATCH, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_ACCEPT_RATE, TITLE_ACCEPT_RATE, 'Most new sessions per second, overall. Applies to each worker process. 0 for no limit.', converter = float, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_ACCEPT_RATE_PER_IP, TITLE_ACCEPT_RATE_PER_IP, 'Most new sessions per second from a single address. Applies to each worker process. 0 for no limit.', converter = float, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_PROXY_PROTOCOL, TITLE_PROXY_PROTOCOL, 'Send a PROXY protocol header of this version (1 or 2) to targets with the address of the original client. 0 to disable.', converter = int, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_PROXY_PROTOCOL_ACCEPT, TITLE_PROXY_PROTOCOL_ACCEPT, 'Expect each client connection to start with a PROXY protocol header (version 1 or 2), and filter and log by the address in the header. Only use this behind trusted relays.')
+
+        args.add_opt(OPT_TYPE_LONG, TITLE_BUFFER_SIZE, TITLE_BUFFER_SIZE, 'Size of the read buffer allocated for each session, in bytes.', converter = int, default = self.DEFAULT_BUFFER_SIZE, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_HIGH_WATERMARK, TITLE_HIGH_WATERMARK, 'Stop reading from one side of a session once this many bytes are waiting to be written to the other side.', converter = int, default = self.DEFAULT_HIGH_WATERMARK, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_LOW_WATERMARK, TITLE_LOW_WATERMARK, 'Resume reading once the bytes waiting to be written have drained to this amount.', converter = int, default = self.DEFAULT_LOW_WATERMARK, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_CONNECT_TIMEOUT, TITLE_CONNECT_TIMEOUT, 'Seconds to wait on a connection to a target before moving on to the next one. 0 to disable.', converter = float, default = self.DEFAULT_CONNECT_TIMEOUT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_HANDSHAKE_TIMEOUT, TITLE_HANDSHAKE_TIMEOUT, 'Seconds to wait on an SSL handshake with a client or target before closing the session. 0 to disable.', converter = float, default = self.DEFAULT_HANDSHAKE_TIMEOUT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_IDLE_TIMEOUT, TITLE_IDLE_TIMEOUT, 'Close sessions that have not had any traffic for this many seconds. 0 to disable.', converter = float, default = self.DEFAULT_IDLE_TIMEOUT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_NO_SPLICE, TITLE_NO_SPLICE, 'Copy data through the relay process instead of using splice(2) for non-SSL relaying.')
+
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_RANDOM, TITLE_BALANCE_RANDOM, 'Select between multiple targets at random.')
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_ROUND_ROBIN, TITLE_BALANCE_ROUND_ROBIN, 'Rotate between targets (default).')
+        args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_LEAST_CONNECTIONS, TITLE_BALANCE_LEAST_CONNECTIONS, 'Select the target with the fewest active sessions.')
+        args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_LATENCY, TITLE_BALANCE_LATENCY, 'Select targets by their average connect time, weighted by their active sessions.')
+        args.add_opt(OPT_TYPE_LONG, TITLE_POOL_SIZE, TITLE_POOL_SIZE, 'Number of connections to keep open to each target ahead of clients arriving. With the epoll engine, SSL targets are also handshaked ahead of time.', converter = int, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_POOL_MAX_IDLE, TITLE_POOL_MAX_IDLE, 'Seconds that a pooled connection may sit unused before it is replaced.', converter = float, default = self.DEFAULT_POOL_MAX_IDLE, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_STATS_PORT, TITLE_STATS_PORT, 'Serve traffic statistics over HTTP on this port (/ for JSON, /metrics for Prometheus). Worker processes each use the next port up. 0 to disable.', converter = int, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_STATS_BIND, TITLE_STATS_BIND, 'Address to serve statistics on.', default = '127.0.0.1', default_announce = True, default_colour = COLOUR_GREEN)
+        args.add_opt(OPT_TYPE_LONG, TITLE_HEALTH_CHECK, TITLE_HEALTH_CHECK, 'Probe targets with a TCP connection every this many seconds. Targets that fail are not used until they pass again. 0 to disable.', converter = float, default = 0, default_announce = True)
 
         args.add_opt(OPT_TYPE_SHORT, "a", TITLE_ALLOW, "Add network address or CIDR range to whitelist.", multiple = True)
         args.add_opt(OPT_TYPE_SHORT, "A", TITLE_ALLOW_FILE, "Add addresses or CIDR ranges in file to whitelist.", multiple = True)
@@ -546,38 +737,84 @@ class TcpRelayServer:
         self.sessions = {}
         self.targets = []
 
-    def get_target_round_robin(s):
-        s._round_robin_index = (getattr(s, '_round_robin_index', -1) + 1) % len(s.targets)
-        return s.targets[s._round_robin_index]
+        # Statistics. Sessions that are still open are tallied up when the statistics are read.
+        self.live_sessions = set()
+        self.sessions_total = 0
+        self.closed_traffic = [0, 0, 0, 0] # bytes in, bytes out, reads in, reads out
+        self.client_handshake_histogram = TcpRelayHistogram()
+
+    def get_target_candidates(s, exclude):
+        candidates = [t for t in s.targets if t.healthy and t not in exclude]
+        # If every target has been ejected, trying one of them anyway beats turning the client away.
+        return candidates or [t for t in s.targets if t not in exclude]
+
+    def get_target_latency(s, exclude = []):
+        candidates = s.get_target_candidates(exclude)
+        # Targets that have not been measured yet are tried first so that they get a measurement.
+        if candidates: return min(candidates, key=lambda t: (t.latency or 0) * (t.active + 1))
+
+    def get_target_least_connections(s, exclude = []):
+        candidates = s.get_target_candidates(exclude)
+        if candidates: return min(candidates, key=lambda t: t.active)
+
+    def get_target_random(s, exclude = []):
+        candidates = s.get_target_candidates(exclude)
+        if candidates: return random.choice(candidates)
+
+    def get_target_round_robin(s, exclude = []):
+        candidates = s.get_target_candidates(exclude)
+        for i in range(len(s.targets)):
+            s._round_robin_index = (getattr(s, '_round_robin_index', -1) + 1) % len(s.targets)
+            if s.targets[s._round_robin_index] in candidates: return s.targets[s._round_robin_index]
+
+    def get_target_single(s, exclude = []):
+        if s.targets[0] not in exclude: return s.targets[0]
 
     def init_server(self):
         self.server_socket = self.new_socket()
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        if self.args[TITLE_SSL_CERT]:
-            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            ctx.load_cert_chain(self.args[TITLE_SSL_CERT], keyfile=self.args[TITLE_SSL_KEY])
+        if self.workers > 1:
+            # Let the kernel spread incoming connections across each worker's own listening socket.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.server_ctx:
             self.init_socket(self.server_socket)
-            self.server_socket = ctx.wrap_socket(self.server_socket, server_side=True, do_handshake_on_connect=False)
-
-        self.client_ctx = None
-        if self.args[TITLE_TARGET_SSL] or self.args[TITLE_TARGET_SSL_INSECURE]:
-            self.client_ctx = ssl.create_default_context()
-            if self.args[TITLE_TARGET_SSL_INSECURE]:
-                self.client_ctx.check_hostname = False
-                self.client_ctx.verify_mode = ssl.CERT_NONE
+            self.server_socket = self.server_ctx.wrap_socket(self.server_socket, server_side=True, do_handshake_on_connect=False)
 
         self.server_socket.bind((self.args[TITLE_BIND], self.port))
         self.server_socket.listen(50)
 
         self.epoll_socket = select.epoll()
-        self.register_socket(self.server_socket, EPOLLIN | EPOLLET)
+        # Level-triggered, so that clients left over after a batch of accepts will wake up the next poll.
+        self.register_socket(self.server_socket, EPOLLIN)
 
         return True
 
+    def count_handshake(s, side, sock):
+        if sock.session_reused: s.handshake_counts[side][1] += 1
+        else: s.handshake_counts[side][0] += 1
+        return sock.session_reused
+
+    def init_ssl(self):
+        # Handshakes by side, as [full, resumed]
+        self.handshake_counts = {'client': [0, 0], 'target': [0, 0]}
+
+        self.server_ctx = None
+        if self.args[TITLE_SSL_CERT]:
+            self.server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.server_ctx.load_cert_chain(self.args[TITLE_SSL_CERT], keyfile=self.args[TITLE_SSL_KEY])
+            # Session tickets (on by default) let returning clients skip the full handshake.
+            # The ticket keys belong to the context, so building it before workers are forked lets
+            #  a ticket from one worker be accepted by any of the others.
+
+        self.client_ctx = None
+        if self.args[TITLE_TARGET_SSL] or self.args[TITLE_TARGET_SSL_INSECURE]:
+            self.client_ctx = ssl.create_default_context()
+            if self.args[TITLE_TARGET_SSL_INSECURE]:
+                self.client_ctx.check_hostname = False
+                self.client_ctx.verify_mode = ssl.CERT_NONE
+
     def init_socket(s, so):
-        os.set_blocking(so.fileno(), False)
         so.setblocking(False)
-        fcntl.fcntl(so, fcntl.F_SETFL, os.O_NONBLOCK) # Redundant, but to be absolutely sure...
 
     def is_loop(s, target_addr, server_addr):
         if target_addr[1] != server_addr[1]:
@@ -613,7 +850,7 @@ class TcpRelayServer:
         if s.verbose: print_notice('Additional information shall be printed.')
 
         if len(s.targets) == 1:
-            s.get_target = lambda: s.targets[0]
+            s.get_target = s.get_target_single
 
             t = s.get_target()
             print_notice('Relaying TCP connections on %s to %s' % (colour_addr(s.args[TITLE_BIND], s.port), t))
@@ -622,9 +859,24 @@ class TcpRelayServer:
             print_notice('Relaying TCP connections on %s to the following hosts:' % colour_addr(s.args[TITLE_BIND], s.port))
             for t in s.targets: print_notice('  * %s' % t)
 
-            if s.args[TITLE_BALANCE_RANDOM]: s.get_target = lambda: s.targets[random.randint(0, len(s.targets)-1)]
+            if s.args[TITLE_BALANCE_RANDOM]: s.get_target = s.get_target_random
+            elif s.args[TITLE_BALANCE_LEAST_CONNECTIONS]: s.get_target = s.get_target_least_connections
+            elif s.args[TITLE_BALANCE_LATENCY]: s.get_target = s.get_target_latency
             else: s.get_target = s.get_target_round_robin
 
+        if s.accept_rate: print_notice('Accepting at most %s new sessions per second.' % colour_text(s.accept_rate))
+        if s.accept_rate_per_ip: print_notice('Accepting at most %s new sessions per second from each address.' % colour_text(s.accept_rate_per_ip))
+        if s.proxy_protocol: print_notice('Sending PROXY protocol v%s headers to targets.' % colour_text(s.proxy_protocol))
+        if s.proxy_protocol_accept: print_notice('Reading client addresses from PROXY protocol headers.')
+        if s.health_check: print_notice('Probing targets every %s seconds.' % colour_text(s.health_check))
+        if s.pool_size: print_notice('Keeping %s connection(s) ready for each target.' % colour_text(s.pool_size))
+        if s.stats_port:
+            if s.workers > 1: print_notice('Serving statistics on %s through %s' % (colour_addr(s.args[TITLE_STATS_BIND], s.stats_port), colour_text(s.stats_port + s.workers - 1)))
+            else: print_notice('Serving statistics on %s' % colour_addr(s.args[TITLE_STATS_BIND], s.stats_port))
+
+        if s.engine != ENGINE_EPOLL: print_notice('Relaying with the %s engine.' % colour_text(s.engine))
+        if s.workers > 1: print_notice('Relaying with %s worker processes.' % colour_text(s.workers))
+
         if s.args[TITLE_SSL_CERT]:
             print_notice('SSL-encrypting incoming data with certificate: %s' % colour_green(s.args[TITLE_SSL_CERT]))
             if s.args[TITLE_SSL_KEY]: print_notice('SSL key file: %s' % colour_green(s.args[TITLE_SSL_KEY]))
@@ -633,6 +885,13 @@ class TcpRelayServer:
             print_notice('Target(s) are assumed to be SSL-secured')
             if s.args[TITLE_TARGET_SSL_INSECURE]: print_notice('SSL certificate verification is disabled.')
 
+        # SSL data has to pass through the relay process to be encrypted/decrypted,
+        #  but plain connections can be stitched together within the kernel.
+        s.flow_class = TcpRelayFlow
+        if s.engine == ENGINE_EPOLL and hasattr(os, 'splice') and not (s.args[TITLE_NO_SPLICE] or s.args[TITLE_SSL_CERT] or s.args[TITLE_TARGET_SSL] or s.args[TITLE_TARGET_SSL_INSECURE]):
+            s.flow_class = TcpRelaySpliceFlow
+            if s.verbose: print_notice('Forwarding data with splice(2).')
+
     def register_session(s, session):
         if session.src not in s.sessions: s.sessions[session.src.fileno()] = session
         if session.dst not in s.sessions: s.sessions[session.dst.fileno()] = session
@@ -658,31 +917,279 @@ class TcpRelayServer:
         except socket.gaierror: return None, value, "Unable to resolve: %s" % colour_text(value, COLOUR_BLUE)
         return ip, value, None
 
+    def print_handshake_counts(s):
+        for side, label in [('client', 'Client'), ('target', 'Target')]:
+            full, resumed = s.handshake_counts[side]
+            if full or resumed: print_notice('%s SSL handshakes: %s full, %s resumed' % (label, colour_text(full), colour_text(resumed)))
+
     def run(self):
         self.args.process(sys.argv)
         self.print_summary()
+        self.init_ssl()
+        if self.workers > 1: return self.run_supervisor()
+        return self.run_worker()
+
+    def run_supervisor(self):
+        # Workers are forked after argument processing,
+        #  so they each inherit the same access rules and targets.
+        workers = {}
+
+        def spawn(index):
+            pid = os.fork()
+            if pid:
+                workers[pid] = (index, time.time())
+                if self.verbose: print_notice('Started worker %s (PID %s)' % (colour_text(index), colour_text(pid)))
+                return
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try: code = self.run_worker(index)
+            except KeyboardInterrupt: code = 130
+            except Exception as e: print_exception(e, 'worker %s' % index)
+            finally: os._exit(code)
+
+        # Let a terminated supervisor clean up its workers on the way out.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            for i in range(self.workers): spawn(i)
+
+            while workers:
+                pid, status = os.wait()
+                if pid not in workers: continue
+                index, started = workers.pop(pid)
+
+                if time.time() - started < self.WORKER_STARTUP_GRACE:
+                    log_error('Worker %s (PID %s) failed to start. Shutting down.' % (colour_text(index), colour_text(pid)))
+                    return 1
+
+                log_error('Worker %s (PID %s) exited unexpectedly (status %s). Restarting.' % (colour_text(index), colour_text(pid), colour_text(status)))
+                spawn(index)
+        finally:
+            for pid in workers:
+                try: os.kill(pid, signal.SIGTERM)
+                except OSError: pass
+            for pid in workers:
+                try: os.waitpid(pid, 0)
+                except OSError: pass
+        return 0
+
+    def run_asyncio(self):
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            if self.verbose: print_notice('Running asyncio engine on %s.' % colour_text('uvloop'))
+        except ImportError: pass
+
+        try: asyncio.run(self.serve_asyncio())
+        except KeyboardInterrupt: pass
+        finally: self.print_handshake_counts()
+        return 0
+
+    async def serve_asyncio(self):
+        # Client SSL is negotiated by each session after its access check, so the listener itself is plain.
+        server = await asyncio.start_server(self.handle_asyncio_connection, self.args[TITLE_BIND], self.port, limit=self.buffer_size, backlog=50, reuse_address=True, reuse_port=self.workers > 1)
+        async with server: await server.serve_forever()
+
+    async def handle_asyncio_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.proxy_protocol_accept:
+            try: addr = await asyncio.wait_for(read_proxy_header(reader), self.handshake_timeout or None) or addr
+            except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, OSError) as e:
+                if self.verbose: log_error('Bad PROXY header from %s: %s' % (colour_addr(addr[0], addr[1]), e))
+                writer.transport.abort()
+                return
+        if not (self.accept_bucket is None or self.accept_bucket.take(time.time())) or not self.admit(addr[0], time.time()):
+            writer.transport.abort()
+            return
+        await TcpRelayAsyncSession(self, reader, writer, addr).run()
+
+    def run_health_checks(self):
+        timeout = min(self.health_check, TcpRelayTarget.PROBE_TIMEOUT)
+        while True:
+            for t in self.targets: t.probe(timeout)
+            time.sleep(self.health_check)
+
+    def run_pools(self):
+        # The asyncio engine does its own SSL, so only hand it plain connections.
+        # A PROXY header has to go out ahead of the SSL handshake, which cannot happen before the client shows up.
+        ctx = None
+        if self.engine == ENGINE_EPOLL and not self.proxy_protocol: ctx = self.client_ctx
+
+        interval = min(self.pool_max_idle / 2, 1)
+        while True:
+            for t in self.targets:
+                if t.healthy: t.pool.fill(ctx)
+            self.pool_event.wait(interval)
+            self.pool_event.clear()
+
+    def accept_connections(self):
+        # Accept a limited batch of clients, so that a flood of new connections cannot hold up existing sessions.
+        # The listening socket is level-triggered, so anything still waiting gets picked up on the next pass.
+        for i in range(self.accept_batch):
+            if self.accept_bucket and not self.accept_bucket.take(self.now):
+                # Stop listening until there is room for another session, leaving clients in the kernel's backlog.
+                self.epoll_socket.modify(self.server_socket.fileno(), 0)
+                self.timers.schedule(self.accept_timer, self.now + self.accept_bucket.get_wait())
+                return
+
+            try: sock, addr = self.server_socket.accept()
+            except (BlockingIOError, socket.error) as e:
+                if self.accept_bucket: self.accept_bucket.refund()
+                return
+            self.init_socket(sock)
+
+            # Behind another proxy, the real address is not known until the PROXY header has been read.
+            if not self.proxy_protocol_accept and not self.admit(addr[0], self.now):
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+                continue
+
+            session = TcpRelaySession(self, sock, addr)
+            session.handle_connection()
+
+    def admit(s, ip, now):
+        # Check a client's address against access lists and the per-address rate limit.
+        if not s.access.is_allowed(ip): return False
+        if not s.accept_rate_per_ip: return True
+
+        if now - s.rate_pruned >= s.RATE_PRUNE_INTERVAL:
+            # Forget addresses that have had enough time to earn back all of their tokens.
+            s.rate_pruned = now
+            for key in [k for k, bucket in s.ip_buckets.items() if bucket.is_full(now)]: del s.ip_buckets[key]
+
+        bucket = s.ip_buckets.get(ip)
+        if not bucket: bucket = s.ip_buckets[ip] = TcpRelayTokenBucket(s.accept_rate_per_ip, now)
+        if bucket.take(now): return True
+        if s.verbose: log_notice('Rate-limited: %s' % colour_text(ip, COLOUR_BLUE))
+        return False
+
+    def close_session(s, session):
+        s.live_sessions.discard(session)
+        traffic = session.get_traffic()
+        for i in range(len(traffic)): s.closed_traffic[i] += traffic[i]
+        if session.target:
+            session.target.bytes_in += traffic[0]
+            session.target.bytes_out += traffic[1]
+
+    def get_stats(s):
+        sessions = list(s.live_sessions)
+        traffic = list(s.closed_traffic)
+        for session in sessions:
+            for i, value in enumerate(session.get_traffic()): traffic[i] += value
+
+        now = time.time()
+        return {
+            'sessions': {'active': len(sessions), 'total': s.sessions_total},
+            'bytes': {'in': traffic[0], 'out': traffic[1]},
+            'reads': {'in': traffic[2], 'out': traffic[3]},
+            'handshakes': dict([(side, {'full': full, 'resumed': resumed}) for side, (full, resumed) in s.handshake_counts.items()]),
+            'client_handshake_seconds': s.client_handshake_histogram.to_dict(),
+            'targets': [t.get_stats() for t in s.targets],
+            'active_sessions': [session.get_stats(now) for session in sessions]
+        }
+
+    def get_stats_prometheus(s):
+        stats = s.get_stats()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            if kind:
+                lines.append('# HELP relay_tcp_%s %s' % (name, help_text))
+                lines.append('# TYPE relay_tcp_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join(['%s="%s"' % (k, v) for k, v in labels])
+                if label_text: label_text = '{%s}' % label_text
+                lines.append('relay_tcp_%s%s %s' % (name, label_text, value))
+
+        def histogram(name, help_text, items):
+            samples = []
+            for labels, hist in items:
+                for le, count in hist['buckets']: samples.append((labels + [('le', le)], count))
+            metric(name, 'histogram', help_text, [])
+            metric(name + '_bucket', None, None, samples)
+            metric(name + '_sum', None, None, [(labels, hist['sum']) for labels, hist in items])
+            metric(name + '_count', None, None, [(labels, hist['count']) for labels, hist in items])
+
+        metric('sessions_active', 'gauge', 'Sessions currently open.', [([], stats['sessions']['active'])])
+        metric('sessions_total', 'counter', 'Sessions accepted.', [([], stats['sessions']['total'])])
+        metric('bytes_total', 'counter', 'Bytes relayed (in: client to target, out: target to client).', [([('direction', d)], stats['bytes'][d]) for d in ['in', 'out']])
+        metric('reads_total', 'counter', 'Successful reads.', [([('direction', d)], stats['reads'][d]) for d in ['in', 'out']])
+        metric('handshakes_total', 'counter', 'SSL handshakes.', [([('side', side), ('type', kind)], stats['handshakes'][side][kind]) for side in sorted(stats['handshakes']) for kind in ['full', 'resumed']])
+        histogram('client_handshake_seconds', 'Time from accepting a client to completing its SSL handshake.', [([], stats['client_handshake_seconds'])])
+
+        targets = [([('target', t['address'])], t) for t in stats['targets']]
+        metric('target_up', 'gauge', 'Whether the target is in rotation.', [(labels, int(t['healthy'])) for labels, t in targets])
+        metric('target_sessions_active', 'gauge', 'Sessions currently open to the target.', [(labels, t['sessions_active']) for labels, t in targets])
+        metric('target_bytes_total', 'counter', 'Bytes relayed through closed sessions to/from the target.', [(labels + [('direction', d)], t['bytes'][d]) for labels, t in targets for d in ['in', 'out']])
+        histogram('target_connect_seconds', 'Time to establish a TCP connection to the target.', [(labels, t['connect_seconds']) for labels, t in targets])
+        histogram('target_handshake_seconds', 'Time to complete an SSL handshake with the target.', [(labels, t['handshake_seconds']) for labels, t in targets])
+
+        return '\n'.join(lines) + '\n'
+
+    def run_stats(self, port):
+        server = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    content = server.get_stats_prometheus()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    content = json.dumps(server.get_stats(), indent=2)
+                    content_type = 'application/json'
+
+                content = content.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', len(content))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args): pass
+
+        HTTPServer((self.args[TITLE_STATS_BIND], port), StatsHandler).serve_forever()
+
+    def run_worker(self, index = 0):
+        self.access.watch()
+
+        # Probes and pools only flip flags on targets or hand over finished connections,
+        #  so they can run in threads alongside either engine's loop.
+        threads = []
+        if self.health_check: threads.append(self.run_health_checks)
+        if self.stats_port: threads.append(lambda: self.run_stats(self.stats_port + index))
+        if self.pool_size:
+            self.pool_event = threading.Event()
+            for target in self.targets: target.pool = TcpRelayPool(target, self.pool_size, self.pool_max_idle, self.pool_event)
+            threads.append(self.run_pools)
+        for fn in threads:
+            t = threading.Thread(target=fn)
+            t.daemon = True
+            t.start()
+
+        # Rate limits are per worker process.
+        self.accept_bucket = None
+        if self.accept_rate: self.accept_bucket = TcpRelayTokenBucket(self.accept_rate, time.time())
+        self.ip_buckets = {}
+        self.rate_pruned = time.time()
+
+        if self.engine == ENGINE_ASYNCIO: return self.run_asyncio()
         if not self.init_server(): return 1
 
+        self.now = time.time()
+        self.timers = TcpRelayTimerWheel(self.now)
+        self.accept_timer = TcpRelayTimer(lambda: self.epoll_socket.modify(self.server_socket.fileno(), EPOLLIN))
         try:
             while True:
-                events = self.epoll_socket.poll(1)
+                # Wake up for every tick of the timer wheel while anything is waiting on it.
+                events = self.epoll_socket.poll(self.timers.resolution if self.timers.count else 1)
+                self.now = time.time()
+                for timer in self.timers.advance(self.now): timer.callback()
+
                 for fd, event in events:
 
                     if fd == self.server_socket.fileno():
-                        try:
-                            while True:
-                                sock, addr = self.server_socket.accept()
-                                self.init_socket(sock)
-
-                                if not self.access.is_allowed(addr[0]):
-                                    sock.shutdown(socket.SHUT_RDWR)
-                                    sock.close()
-                                    continue
-
-                                session = TcpRelaySession(self, sock, addr)
-                                session.handle_connection()
-
-                        except (BlockingIOError, socket.error) as e: pass
+                        self.accept_connections()
                         continue
 
                     session = self.sessions.get(fd)
@@ -695,6 +1202,7 @@ class TcpRelayServer:
         for i in list(s.active_fds): s.unregister_descriptor(i)
         s.epoll_socket.close()
         s.server_socket.close()
+        s.print_handshake_counts()
 
     def unregister_descriptor(s, fd):
         s.epoll_socket.unregister(fd)
@@ -708,7 +1216,7 @@ class TcpRelayServer:
         for i in args[TITLE_ALLOW]: a.add_whitelist(i)
         for i in args[TITLE_ALLOW_FILE]: a.load_whitelist_file(i)
         for i in args[TITLE_DENY]: a.add_blacklist(i)
-        for i in args[TITLE_DENY_FILE]: a.load_whitelist_file(i)
+        for i in args[TITLE_DENY_FILE]: a.load_blacklist_file(i)
         return a.errors
 
     def validate_common_arguments(self, args):
@@ -718,6 +1226,70 @@ class TcpRelayServer:
         self.port, port_error = self.resolve_port(args[TITLE_PORT], 'Bind port')
         if port_error: errors.append(port_error)
 
+        self.engine = args[TITLE_ENGINE]
+        if self.engine not in ENGINES:
+            errors.append('Unknown engine: %s (Options: %s)' % (colour_text(self.engine), ', '.join([colour_text(e) for e in ENGINES])))
+        elif self.engine == ENGINE_ASYNCIO and sys.version_info < (3, 12):
+            # StreamWriter.start_tls() first appeared in 3.11, but server-side handshakes through it reset the connection until 3.12.
+            errors.append('The %s engine requires Python 3.12 or newer.' % colour_text(self.engine))
+
+        self.health_check = args[TITLE_HEALTH_CHECK]
+        if self.health_check is not None and self.health_check < 0:
+            errors.append('Health check interval cannot be negative. Given: %s' % colour_text(self.health_check))
+
+        self.pool_size = args[TITLE_POOL_SIZE]
+        self.pool_max_idle = args[TITLE_POOL_MAX_IDLE]
+        if self.pool_size is not None and self.pool_size < 0:
+            errors.append('Pool size cannot be negative. Given: %s' % colour_text(self.pool_size))
+        if self.pool_max_idle is not None and self.pool_max_idle <= 0:
+            errors.append('Pool idle time must be a positive number of seconds. Given: %s' % colour_text(self.pool_max_idle))
+
+        self.workers = args[TITLE_WORKERS]
+        if self.workers is not None:
+            if self.workers < 1:
+                errors.append('Must have at least one worker. Given: %s' % colour_text(self.workers))
+            elif self.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+                errors.append('Multiple workers require SO_REUSEPORT, which is not available on this system.')
+
+        self.stats_port, port_error = self.resolve_port(args[TITLE_STATS_PORT], 'Statistics port')
+        if port_error: errors.append(port_error)
+        elif self.stats_port and self.workers and self.stats_port + self.workers - 1 > 65535:
+            errors.append('Not enough ports above %s for each worker to serve statistics.' % colour_text(self.stats_port))
+
+        self.connect_timeout = args[TITLE_CONNECT_TIMEOUT]
+        self.handshake_timeout = args[TITLE_HANDSHAKE_TIMEOUT]
+        self.idle_timeout = args[TITLE_IDLE_TIMEOUT]
+        for title, value in [(TITLE_CONNECT_TIMEOUT, self.connect_timeout), (TITLE_HANDSHAKE_TIMEOUT, self.handshake_timeout), (TITLE_IDLE_TIMEOUT, self.idle_timeout)]:
+            if value is not None and value < 0: errors.append('Value for %s cannot be negative. Given: %s' % (colour_text(title), colour_text(value)))
+
+        self.accept_batch = args[TITLE_ACCEPT_BATCH]
+        if self.accept_batch is not None and self.accept_batch < 1:
+            errors.append('Must accept at least one connection at a time. Given: %s' % colour_text(self.accept_batch))
+        self.accept_rate = args[TITLE_ACCEPT_RATE]
+        self.accept_rate_per_ip = args[TITLE_ACCEPT_RATE_PER_IP]
+        for title, value in [(TITLE_ACCEPT_RATE, self.accept_rate), (TITLE_ACCEPT_RATE_PER_IP, self.accept_rate_per_ip)]:
+            if value is not None and value < 0: errors.append('Value for %s cannot be negative. Given: %s' % (colour_text(title), colour_text(value)))
+
+        self.proxy_protocol = args[TITLE_PROXY_PROTOCOL]
+        self.proxy_protocol_accept = args[TITLE_PROXY_PROTOCOL_ACCEPT]
+        if self.proxy_protocol not in [None, 0, 1, 2]:
+            errors.append('Unsupported PROXY protocol version: %s (Options: 1, 2)' % colour_text(self.proxy_protocol))
+        if self.proxy_protocol_accept and self.engine == ENGINE_ASYNCIO and args[TITLE_SSL_CERT]:
+            # Anything that the client sends after the header would already be sitting in the stream
+            #  where the SSL layer cannot see it.
+            errors.append('The %s engine cannot accept PROXY protocol headers on SSL connections.' % colour_text(self.engine))
+
+        self.buffer_size = args[TITLE_BUFFER_SIZE]
+        if self.buffer_size is not None and self.buffer_size <= 0:
+            errors.append('Buffer size must be a positive number of bytes. Given: %s' % colour_text(self.buffer_size))
+
+        self.high_watermark = args[TITLE_HIGH_WATERMARK]
+        self.low_watermark = args[TITLE_LOW_WATERMARK]
+        if self.high_watermark is not None and self.high_watermark <= 0:
+            errors.append('High watermark must be a positive number of bytes. Given: %s' % colour_text(self.high_watermark))
+        elif self.low_watermark is not None and self.high_watermark is not None and not 0 <= self.low_watermark < self.high_watermark:
+            errors.append('Low watermark must be at least 0 and less than the high watermark (%s). Given: %s' % (colour_text(self.high_watermark), colour_text(self.low_watermark)))
+
         for target_items in [t.split(':') for t in self.args.operands]:
 
             target_ip, target_addr, target_err = self.resolve_target_address(target_items[0])
@@ -742,7 +1314,7 @@ class TcpRelayServer:
 
         if not self.targets: errors.append('No relay target specified.')
         else:
-            num_rotation_options = len([i for i in [TITLE_BALANCE_RANDOM, TITLE_BALANCE_ROUND_ROBIN] if args[i]])
+            num_rotation_options = len([i for i in [TITLE_BALANCE_RANDOM, TITLE_BALANCE_ROUND_ROBIN, TITLE_BALANCE_LEAST_CONNECTIONS, TITLE_BALANCE_LATENCY] if args[i]])
             if num_rotation_options > 1:
                 if len(self.targets) > 1: errors.append('Must only select one rotation type when using multiple targets.')
                 # If there was only one target, let the user off with a warning.
@@ -787,6 +1359,62 @@ class TcpRelayServer:
 STATE_UNCONNECTED = 1
 STATE_UNINITIALIZED = 2
 STATE_CONNECTED = 3
+STATE_PROXY_HEADER = 4 # Waiting on the client's PROXY protocol header
+
+PROXY_V1_MAX_LENGTH = 107
+PROXY_V2_SIGNATURE = b'\r\n\r\n\x00\r\nQUIT\n'
+
+def build_proxy_header(version, source, dest):
+    # source and dest are (ip, port) pairs for the client and the address that it connected to.
+    same_family = (':' in source[0]) == (':' in dest[0])
+    if version == 1:
+        if not same_family: return b'PROXY UNKNOWN\r\n'
+        return ('PROXY %s %s %s %d %d\r\n' % ('TCP6' if ':' in source[0] else 'TCP4', source[0], dest[0], source[1], dest[1])).encode('ascii')
+
+    if not same_family:
+        # Family 0 (AF_UNSPEC): the target should fall back to the addresses of the connection itself.
+        return PROXY_V2_SIGNATURE + struct.pack('!BBH', 0x21, 0x00, 0)
+    family, code = (socket.AF_INET6, 0x21) if ':' in source[0] else (socket.AF_INET, 0x11)
+    body = socket.inet_pton(family, source[0]) + socket.inet_pton(family, dest[0]) + struct.pack('!HH', source[1], dest[1])
+    return PROXY_V2_SIGNATURE + struct.pack('!BBH', 0x21, code, len(body)) + body
+
+def parse_proxy_header(data):
+    # Returns (length, address). The length is that of the header, or the number of bytes that are needed
+    #  to read it if 'data' is too short. The address is None for headers that do not carry one.
+    # Raises ValueError if 'data' does not start with a PROXY header.
+    if len(data) < 16 and PROXY_V2_SIGNATURE.startswith(data[:12]): return 16, None
+    if data[:12] == PROXY_V2_SIGNATURE:
+        command, family, length = struct.unpack('!BBH', data[12:16])
+        if command >> 4 != 2: raise ValueError('Unsupported PROXY protocol version: %d' % (command >> 4))
+        length += 16
+        if len(data) < length: return length, None
+        if command & 0x0F == 0: return length, None # LOCAL (e.g. a health check from the proxy itself)
+
+        if family >> 4 == 1 and length >= 28: return length, (socket.inet_ntop(socket.AF_INET, data[16:20]), struct.unpack('!H', data[24:26])[0])
+        if family >> 4 == 2 and length >= 52: return length, (socket.inet_ntop(socket.AF_INET6, data[16:32]), struct.unpack('!H', data[48:50])[0])
+        return length, None
+
+    if not data.startswith(b'PROXY ') and not b'PROXY '.startswith(data): raise ValueError('No PROXY header')
+    end = data.find(b'\r\n')
+    if end < 0:
+        if len(data) >= PROXY_V1_MAX_LENGTH: raise ValueError('PROXY header is too long')
+        return len(data) + 1, None
+
+    fields = data[:end].decode('ascii', 'replace').split(' ')
+    if fields[1:2] == ['UNKNOWN']: return end + 2, None
+    if len(fields) != 6 or fields[1] not in ['TCP4', 'TCP6']: raise ValueError('Malformed PROXY header')
+    try: socket.inet_pton(socket.AF_INET6 if fields[1] == 'TCP6' else socket.AF_INET, fields[2])
+    except OSError: raise ValueError('Bad address in PROXY header: %s' % fields[2])
+    return end + 2, (fields[2], int(fields[4]))
+
+async def read_proxy_header(reader):
+    # Read a PROXY header off of an asyncio stream, taking only the bytes that belong to the header.
+    data = await reader.readexactly(len(PROXY_V2_SIGNATURE))
+    if data == PROXY_V2_SIGNATURE: data += await reader.readexactly(4)
+    else: data += await reader.readuntil(b'\n')
+    length, addr = parse_proxy_header(data)
+    if length > len(data): data += await reader.readexactly(length - len(data))
+    return parse_proxy_header(data)[1]
 
 class TcpRelaySession:
 
@@ -795,31 +1423,64 @@ class TcpRelaySession:
     def __init__(s, srv, src_sock, addr):
         s.server = srv
         s.verbose = srv.verbose
-        s.target = srv.get_target()
+        s.target = None
+        s.tried = []
 
         s.running = True
         s.src = src_sock
         s.addr = addr
 
-        if s.server.args[TITLE_SSL_CERT]:
+        if s.server.proxy_protocol_accept:
+            s.state_client = STATE_PROXY_HEADER
+            s.proxy_data = b''
+        elif s.server.args[TITLE_SSL_CERT]:
             s.state_client = STATE_UNINITIALIZED
         else: s.state_client = STATE_CONNECTED
         s.state_server = STATE_UNCONNECTED
 
-        s.dst = srv.new_socket()
+        # Flows (keyed by the file descriptor that they read from) are set up once both sides are connected.
+        s.flows = {}
+        s.armed = {}
+        s.upstream = s.downstream = None
+
+        s.started = time.time()
+        s.connect_latency = None
+        s.handshake_latency = {}
+        srv.live_sessions.add(s)
+        srv.sessions_total += 1
+
+        # Connect, handshake, and idle deadlines share one timer. See update_timer().
+        s.last_activity = s.started
+        s.timer = TcpRelayTimer(s.handle_timeout)
+
+        s.set_target(srv.get_target())
+        s.dst = s.target.pool and s.target.pool.take()
+        s.pooled = bool(s.dst)
+        if s.dst:
+            # A pooled connection that still needs a PROXY header goes through the connect steps,
+            #  where connect() will report that it is already connected.
+            if not srv.proxy_protocol: s.state_server = STATE_CONNECTED
+            if s.verbose: print_notice('Using pooled connection: %s' % s.get_arrow_string())
+        else: s.dst = srv.new_socket()
         srv.register_session(s)
 
     get_arrow_string = lambda s: '%s->%s' % (colour_addr(s.addr[0], s.addr[1]), s.target)
 
     def handle_connection(self):
 
-        if self.state_client != STATE_CONNECTED:
+        if self.state_client == STATE_PROXY_HEADER and not self.read_proxy_header():
+            self.update_timer()
+            return
+
+        if self.state_client == STATE_UNINITIALIZED:
 
             try:
                 self.src.do_handshake()
                 self.state_client = STATE_CONNECTED
+                self.record_handshake('client', self.started)
 
-                if self.verbose: print_notice('Client SSL initialized for %s' % self.get_arrow_string())
+                resumed = self.server.count_handshake('client', self.src)
+                if self.verbose: print_notice('Client SSL %s for %s' % (['initialized', 'resumed'][resumed], self.get_arrow_string()))
             except (SSLWantReadError, SSLWantWriteError, BlockingIOError) as e:
                 self.re_arm(self.src, EPOLLIN | EPOLLET | EPOLLRDHUP | EPOLLONESHOT)
             except (SSLError, OSError) as e:
@@ -840,16 +1501,24 @@ class TcpRelaySession:
                     #   this immediate connection attempt.
                     if e.errno != errno.EISCONN: raise
                 rearm_server = True
+                if not self.pooled:
+                    self.connect_latency = time.time() - self.connect_started
+                    self.target.record_latency(self.connect_latency)
+                    if self.verbose: print_notice('Completed TCP connection: %s' % self.get_arrow_string())
 
-                if self.verbose: print_notice('Completed TCP connection: %s' % self.get_arrow_string())
+                if self.server.proxy_protocol:
+                    # The header is tiny, and the socket has not had anything else written to it.
+                    self.dst.sendall(build_proxy_header(self.server.proxy_protocol, self.addr, self.src.getsockname()))
 
                 if self.server.client_ctx:
                     self.dst = self.server.client_ctx.wrap_socket(
                         self.dst,
                         server_hostname=self.target.hostname,
-                        do_handshake_on_connect=False
+                        do_handshake_on_connect=False,
+                        session=self.target.ssl_session
                     )
 
+                    self.handshake_started = time.time()
                     self.state_server = STATE_UNINITIALIZED
                 else:
                     self.state_server = STATE_CONNECTED
@@ -861,7 +1530,9 @@ class TcpRelaySession:
             except (ConnectionError, OSError) as e:
                 # ConnectionError: Likely a reset connection (target not listening?)
                 # OSError: Possibly a timeout, or no route to host.
-                if self.verbose: log_error('Connection %s: %s' % (self.get_arrow_string(), e))
+                if self.verbose: log_error('Connection %s: %s' % (self.get_arrow_string(), describe_error(e)))
+                self.target.record_failure(self.server.health_check)
+                if self.retry(): return self.handle_connection()
                 self.shutdown()
 
         if self.running and self.state_server == STATE_UNINITIALIZED:
@@ -873,9 +1544,12 @@ class TcpRelaySession:
                 rearm_server = True
 
                 self.state_server = STATE_CONNECTED
-                self.register_socket(self.src, TcpRelaySession.CLIENT_FLAGS)
+                self.server.register_socket(self.src, TcpRelaySession.CLIENT_FLAGS)
+                self.record_handshake('target', self.handshake_started)
 
-                if self.verbose: print_notice('Server SSL initialized for %s' % self.get_arrow_string())
+                resumed = self.server.count_handshake('target', self.dst)
+                self.target.remember_session(self.dst)
+                if self.verbose: print_notice('Server SSL %s for %s' % (['initialized', 'resumed'][resumed], self.get_arrow_string()))
             except (SSLWantReadError, SSLWantWriteError, BlockingIOError) as e:
                 self.re_arm(self.dst, TcpRelaySession.CLIENT_FLAGS)
             except ssl.SSLCertVerificationError as e:
@@ -885,62 +1559,240 @@ class TcpRelaySession:
                 if self.verbose: print_error('SSL handshake error error for %s: %s' % (self.get_arrow_string(), e))
                 self.shutdown()
 
+        if self.running and self.state_client == STATE_CONNECTED and self.state_server == STATE_CONNECTED and self.dst.fileno() not in self.server.active_fds:
+            # Pooled connection, which was ready before the client even arrived.
+            rearm_server = True
+            self.re_arm(self.src)
+
         if rearm_server: self.re_arm(self.dst)
+        self.update_timer()
 
     def handle_data(self, fd, event):
 
-        if fd == self.src.fileno():
+        from_client = fd == self.src.fileno()
+        attempts = len(self.tried)
+        self.last_activity = self.server.now
+
+        if from_client:
+            if (event & EPOLLIN and self.state_client in [STATE_PROXY_HEADER, STATE_UNINITIALIZED]): self.handle_connection()
+        else:
+            if (event & EPOLLOUT and self.state_server == STATE_UNCONNECTED) or (event & EPOLLIN and self.state_server == STATE_UNINITIALIZED):
+                self.handle_connection() # Update on pending connection. Try again.
+
+        if not self.running: return
+
+        # Sockets are looked up after handling the connection, since SSL-wrapping replaces the target socket.
+        if from_client:
             sock_in = self.src
             sock_out = self.dst
-
-            if (event & EPOLLIN and self.state_client == STATE_UNINITIALIZED): self.handle_connection()
+        elif attempts != len(self.tried):
+            # The event was for a target that failed and has been replaced by another.
+            #  The new target socket has already been registered.
+            return
         else:
             sock_in = self.dst
             sock_out = self.src
 
-            if (event & EPOLLOUT and self.state_server == STATE_UNCONNECTED) or (event & EPOLLIN and self.state_server == STATE_UNINITIALIZED):
-                self.handle_connection() # Update on pending connection. Try again.
-
         if not (self.state_client == STATE_CONNECTED and self.state_server == STATE_CONNECTED):
             self.re_arm(sock_in)
             return
 
-        # Check for closing messages
-        closing = event & (EPOLLHUP | EPOLLRDHUP)
-        data = None
-        force_rearm = False
+        if not self.flows:
+            sizes = (self.server.buffer_size, self.server.high_watermark, self.server.low_watermark)
+            self.upstream = self.flows[self.src.fileno()] = self.server.flow_class(self.src, self.dst, *sizes)
+            self.downstream = self.flows[self.dst.fileno()] = self.server.flow_class(self.dst, self.src, *sizes)
+
+        flow_out = self.flows[fd] # Data read from this socket
+        flow_in = self.flows[sock_out.fileno()] # Data written to this socket
+        read = 0
 
         if event & EPOLLPRI: sock_out.send(sock_in.read(1, socket.MSG_OOB), socket.MSG_OOB)
 
-        if event & EPOLLIN:
-            try:
-                # Note: Originally, I had a 'while True' loop inside of this try/catch
-                #        that broke when no data was read. This worked fine for vanilla
-                #        connections, but it did not play nice with calling SSLSocket.recv()
-                #        with a client->relay connection using SSL.
-                #       The solution seems to be to only read data once per invocation of epoll.poll()/handle_data()
+        try:
+            if event & EPOLLOUT:
+                paused = flow_in.paused
+                flow_in.flush()
+                if paused and not flow_in.paused:
+                    # The other socket was being held back until this one caught up.
+                    # Read from it directly rather than waiting on epoll, which will not
+                    #  know about any bytes already decrypted and held by an SSL socket.
+                    flow_in.pump()
+
+            # Note: Originally, I had a 'while True' loop around a single recv() call
+            #        that broke when no data was read. This worked fine for vanilla
+            #        connections, but it did not play nice with calling SSLSocket.recv()
+            #        with a client->relay connection using SSL.
+            #       TcpRelayFlow.pump() instead reads until the socket says that it would block,
+            #        which is how an SSL socket says that it has nothing left (pending or otherwise).
+            if event & EPOLLIN: read = flow_out.pump()
+        except (SSLError, OSError) as e:
+            print_exception(e, self)
+            self.shutdown()
+            return
+
+        if (flow_out.eof and not flow_out.pending) or (flow_in.eof and not flow_in.pending) or (event & (EPOLLERR | EPOLLHUP) and not read):
+            self.shutdown()
+        else:
+            self.re_arm(sock_in) # Re-arm socket
+            self.re_arm(sock_out, changed_only = True)
 
-                data = sock_in.recv(1024)
-                if data: sock_out.send(data)
-            except (SSLWantReadError, SSLWantWriteError): force_rearm = True
-            except socket.error as e: print_exception(e, self)
+    def get_flags(s, sock):
+        if not s.flows: return s.CLIENT_FLAGS
 
-        if closing and not (data or force_rearm): self.shutdown() # Double-check that no data was read
-        else: self.re_arm(sock_in) # Re-arm socket
+        flags = EPOLLET | EPOLLONESHOT | EPOLLPRI | EPOLLRDHUP
+        fd = sock.fileno()
+        for flow in s.flows.values():
+            # Stop reading from a socket while too much of what was read from it is still waiting to go out.
+            if flow.source.fileno() == fd and not flow.paused: flags |= EPOLLIN
+            if flow.sink.fileno() == fd and flow.pending: flags |= EPOLLOUT
+        return flags
+
+    def get_deadlines(s):
+        # Returns (connect, handshake, idle) deadlines that currently apply to the session, with None for any that do not.
+        srv = s.server
+        connect = handshake = idle = None
+        if srv.connect_timeout and s.state_server == STATE_UNCONNECTED and s.state_client != STATE_PROXY_HEADER:
+            connect = s.connect_started + srv.connect_timeout
+        if srv.handshake_timeout:
+            if s.state_server == STATE_UNINITIALIZED: handshake = s.handshake_started + srv.handshake_timeout
+            elif s.state_client in [STATE_PROXY_HEADER, STATE_UNINITIALIZED]: handshake = s.started + srv.handshake_timeout
+        if srv.idle_timeout and s.state_client == STATE_CONNECTED and s.state_server == STATE_CONNECTED:
+            idle = s.last_activity + srv.idle_timeout
+        return connect, handshake, idle
+
+    def get_stats(s, now):
+        traffic = s.get_traffic()
+        return {
+            'client': '%s:%d' % s.addr[:2],
+            'target': '%s:%d' % (s.target.ip, s.target.port) if s.target else None,
+            'age': now - s.started,
+            'bytes': {'in': traffic[0], 'out': traffic[1]},
+            'reads': {'in': traffic[2], 'out': traffic[3]},
+            'connect_seconds': s.connect_latency,
+            'handshake_seconds': s.handshake_latency
+        }
+
+    def get_traffic(s):
+        # Bytes client->target, bytes target->client, and the reads that it took for each.
+        if not s.upstream: return [0, 0, 0, 0]
+        return [s.upstream.bytes, s.downstream.bytes, s.upstream.reads, s.downstream.reads]
+
+    def handle_timeout(s):
+        if not s.running: return
+        connect, handshake, idle = s.get_deadlines()
+        now = s.server.now
+
+        if connect and now >= connect:
+            if s.verbose: log_error('Timed out connecting: %s' % s.get_arrow_string())
+            s.target.record_failure(s.server.health_check)
+            if s.retry(): s.handle_connection()
+            else: s.shutdown()
+        elif handshake and now >= handshake:
+            if s.verbose: log_error('Timed out on SSL handshake: %s' % s.get_arrow_string())
+            s.shutdown()
+        elif idle and now >= idle:
+            if s.verbose: log_notice('Idle for %s seconds: %s' % (colour_text(s.server.idle_timeout), s.get_arrow_string()))
+            s.shutdown()
+        else:
+            # Activity since the timer was set pushed the deadline back.
+            s.update_timer()
+
+    def read_proxy_header(s):
+        # Take the client's PROXY header off of the socket without reading any further.
+        # Bytes are peeked at, and only the ones that are known to be a part of the header are consumed.
+        #  The raw socket is read from, since an SSL client's handshake comes after the header.
+        # Returns True once the whole header has been read.
+        try:
+            data = socket.socket.recv(s.src, 256, socket.MSG_PEEK)
+            if not data: raise ValueError('Connection closed')
+            length, addr = parse_proxy_header(s.proxy_data + data)
+            s.proxy_data += socket.socket.recv(s.src, min(length - len(s.proxy_data), len(data)))
+        except BlockingIOError: length = len(s.proxy_data) + 1
+        except (ValueError, OSError) as e:
+            if s.verbose: log_error('Bad PROXY header from %s: %s' % (colour_addr(s.addr[0], s.addr[1]), e))
+            s.shutdown()
+            return False
 
-    def re_arm(s, sock, flags = 0):
-        if s.running and sock.fileno() > 0: s.server.epoll_socket.modify(sock.fileno(), flags or s.CLIENT_FLAGS)
+        if len(s.proxy_data) < length:
+            s.re_arm(s.src, EPOLLIN | EPOLLET | EPOLLRDHUP | EPOLLONESHOT)
+            return False
+
+        if addr: s.addr = addr
+        if not s.server.admit(s.addr[0], s.server.now):
+            if s.verbose: log_notice('Denied by address: %s' % s.get_arrow_string())
+            s.shutdown()
+            return False
+
+        if s.server.args[TITLE_SSL_CERT]: s.state_client = STATE_UNINITIALIZED
+        else: s.state_client = STATE_CONNECTED
+        s.connect_started = time.time()
+        return True
+
+    def record_handshake(s, side, started):
+        latency = s.handshake_latency[side] = time.time() - started
+        if side == 'client': s.server.client_handshake_histogram.observe(latency)
+        else: s.target.handshake_histogram.observe(latency)
+
+    def retry(s):
+        # Move on to the next target after a failed connection attempt.
+        # Returns False if there are no targets left to try.
+        target = s.server.get_target(exclude = s.tried)
+        if not target: return False
+
+        fd = s.dst.fileno()
+        del s.server.sessions[fd]
+        if fd in s.server.active_fds: s.server.unregister_socket(s.dst)
+        s.armed.pop(fd, None)
+        s.dst.close()
+
+        s.dst = s.server.new_socket()
+        s.server.register_session(s)
+        s.set_target(target)
+        return True
+
+    def re_arm(s, sock, flags = 0, changed_only = False):
+        fd = sock.fileno()
+        if not s.running or fd < 0: return
+
+        flags = flags or s.get_flags(sock)
+        if changed_only and s.armed.get(fd) == flags: return
+        s.armed[fd] = flags
+
+        # A client socket that is still mid-handshake has not been registered yet.
+        if fd in s.server.active_fds: s.server.epoll_socket.modify(fd, flags)
+        else: s.server.register_socket(sock, flags)
+
+    def update_timer(s):
+        # Activity does not move the timer, or else every read would touch the timer wheel.
+        # Instead, an idle timer that goes off early checks the last activity and sets itself again.
+        if not s.running: return
+        deadlines = [d for d in s.get_deadlines() if d]
+        if deadlines: s.server.timers.schedule(s.timer, min(deadlines))
+        else: s.server.timers.cancel(s.timer)
+
+    def set_target(s, target):
+        if s.target: s.target.active -= 1
+        s.target = target
+        s.tried.append(target)
+        target.active += 1
+        s.connect_started = time.time()
 
     def shutdown(s):
         if not s.running: return
         if s.verbose: log_notice('Closing: %s' % s.get_arrow_string())
 
-        subjects = [(s.state_server, s.dst, True), (s.state_client, s.src, s.state_server == STATE_CONNECTED)]
-        for state, sock, do_deregister in subjects:
+        s.target.active -= 1
+        # TLS 1.3 session tickets arrive after the handshake, so check again on the way out.
+        s.target.remember_session(s.dst)
+        s.server.close_session(s)
+        s.server.timers.cancel(s.timer)
+        for flow in s.flows.values(): flow.close()
+
+        for sock in [s.dst, s.src]:
             fd = sock.fileno()
             del s.server.sessions[fd]
 
-            if do_deregister:
+            if fd in s.server.active_fds:
                 s.server.unregister_socket(sock)
 
             try: sock.shutdown(socket.SHUT_RDWR)
@@ -949,11 +1801,524 @@ class TcpRelaySession:
 
         s.running = False
 
+class TcpRelayAsyncSession:
+    # Session for the asyncio engine.
+    # Each direction is a coroutine that reads from one stream and writes to the other.
+    #   StreamWriter.drain() pauses reading once the watermarks are hit, the same as TcpRelayFlow.
+
+    def __init__(s, srv, reader, writer, addr):
+        s.server = srv
+        s.verbose = srv.verbose
+        s.target = None
+
+        s.addr = addr
+        s.src_reader = reader
+        s.src_writer = writer
+        s.dst_writer = None
+
+        s.traffic = [0, 0, 0, 0]
+        s.started = s.last_activity = time.time()
+        s.idle_handle = None
+        s.connect_latency = None
+        s.handshake_latency = {}
+        srv.live_sessions.add(s)
+        srv.sessions_total += 1
+
+    # The client's SSL handshake happens before a target has been picked.
+    get_arrow_string = lambda s: '%s->%s' % (colour_addr(s.addr[0], s.addr[1]), s.target or colour_text('*'))
+
+    get_stats = TcpRelaySession.get_stats
+    get_traffic = lambda s: s.traffic
+    record_handshake = TcpRelaySession.record_handshake
+
+    async def pipe(s, reader, writer, direction):
+        # direction: 0 for client->target, 1 for target->client
+        size = s.server.buffer_size
+        try:
+            while True:
+                data = await reader.read(size)
+                if not data: break
+                s.traffic[direction] += len(data)
+                s.traffic[direction + 2] += 1
+                s.last_activity = time.time()
+                writer.write(data)
+                await writer.drain()
+        except (SSLError, OSError) as e:
+            if s.verbose: log_error('Connection %s: %s' % (s.get_arrow_string(), describe_error(e)))
+
+    async def run(s):
+        srv = s.server
+        try:
+            if srv.server_ctx:
+                # StreamWriter.start_tls() is a wrapper around loop.start_tls()
+                await asyncio.wait_for(s.src_writer.start_tls(srv.server_ctx), srv.handshake_timeout or None)
+                s.record_handshake('client', s.started)
+                resumed = srv.count_handshake('client', s.src_writer.get_extra_info('ssl_object'))
+                if s.verbose: print_notice('Client SSL %s for %s' % (['initialized', 'resumed'][resumed], s.get_arrow_string()))
+
+            dst_reader = await s.connect()
+            if not dst_reader: return
+
+            for writer in [s.src_writer, s.dst_writer]:
+                writer.transport.set_write_buffer_limits(high=srv.high_watermark, low=srv.low_watermark)
+
+            # As with the epoll engine, the session ends as soon as either side closes.
+            directions = [asyncio.ensure_future(s.pipe(s.src_reader, s.dst_writer, 0)), asyncio.ensure_future(s.pipe(dst_reader, s.src_writer, 1))]
+            if srv.idle_timeout: s.watch_idle(directions)
+            done, pending = await asyncio.wait(directions, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending: task.cancel()
+        except ssl.SSLCertVerificationError as e:
+            if s.verbose: print_error('Failed to verify SSL certificate for %s in %s: %s' % (colour_blue(s.target.hostname), s.get_arrow_string(), e))
+        except asyncio.TimeoutError:
+            if s.verbose: log_error('Timed out on SSL handshake: %s' % s.get_arrow_string())
+        except (SSLError, OSError) as e:
+            if s.verbose: log_error('Connection %s: %s' % (s.get_arrow_string(), describe_error(e)))
+        finally: s.shutdown()
+
+    def watch_idle(s, directions):
+        # The event loop keeps its own timers, so idle sessions are checked on with call_later()
+        #  rather than with TcpRelayTimerWheel. As with the epoll engine, the timer is not moved on every read.
+        idle = time.time() - s.last_activity
+        if idle >= s.server.idle_timeout:
+            if s.verbose: log_notice('Idle for %s seconds: %s' % (colour_text(s.server.idle_timeout), s.get_arrow_string()))
+            for task in directions: task.cancel()
+        else: s.idle_handle = asyncio.get_running_loop().call_later(s.server.idle_timeout - idle, s.watch_idle, directions)
+
+    async def connect(s):
+        # Work through targets until one accepts a connection.
+        srv = s.server
+        tried = []
+        while True:
+            target = srv.get_target(exclude = tried)
+            if not target: return None
+
+            if s.target: s.target.active -= 1
+            s.target = target
+            tried.append(target)
+            target.active += 1
+
+            if s.verbose: log_notice('Attempting: %s' % s.get_arrow_string())
+            server_hostname = None
+            if srv.client_ctx: server_hostname = target.hostname
+
+            started = time.time()
+            pooled = target.pool and target.pool.take()
+            try:
+                dst_reader, s.dst_writer = await asyncio.wait_for(s.open_target(target, pooled, server_hostname), srv.connect_timeout or None)
+            except ssl.SSLCertVerificationError: raise
+            except asyncio.TimeoutError:
+                if s.verbose: log_error('Timed out connecting: %s' % s.get_arrow_string())
+                target.record_failure(srv.health_check)
+                continue
+            except (ConnectionError, OSError) as e:
+                if s.verbose: log_error('Connection %s: %s' % (s.get_arrow_string(), describe_error(e)))
+                target.record_failure(srv.health_check)
+                continue
+
+            if srv.client_ctx:
+                # asyncio has no way to offer a cached session, so these will always be full handshakes.
+                # The TCP connection and the handshake are made in one call, so connect time includes the handshake.
+                srv.count_handshake('target', s.dst_writer.get_extra_info('ssl_object'))
+
+            if pooled:
+                if s.verbose: print_notice('Using pooled connection: %s' % s.get_arrow_string())
+            else:
+                s.connect_latency = time.time() - started
+                target.record_latency(s.connect_latency)
+                if s.verbose: print_notice('Completed TCP connection: %s' % s.get_arrow_string())
+            return dst_reader
+
+    async def open_target(s, target, sock, server_hostname):
+        srv = s.server
+        if srv.proxy_protocol:
+            # The header has to go out ahead of any SSL handshake, so connect the socket by hand.
+            loop = asyncio.get_running_loop()
+            try:
+                if not sock:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    await loop.sock_connect(sock, (target.ip, target.port))
+                await loop.sock_sendall(sock, build_proxy_header(srv.proxy_protocol, s.addr, s.src_writer.get_extra_info('sockname')))
+            except:
+                sock.close()
+                raise
+
+        if sock: return await asyncio.open_connection(sock=sock, ssl=srv.client_ctx, server_hostname=server_hostname, limit=srv.buffer_size)
+        return await asyncio.open_connection(target.ip, target.port, ssl=srv.client_ctx, server_hostname=server_hostname, limit=srv.buffer_size)
+
+    def shutdown(s):
+        if s.verbose: log_notice('Closing: %s' % s.get_arrow_string())
+        if s.target: s.target.active -= 1
+        if s.idle_handle: s.idle_handle.cancel()
+        s.server.close_session(s)
+        for writer in [s.dst_writer, s.src_writer]:
+            if writer: writer.close()
+
+class TcpRelayFlow(object):
+    # One direction of a session: data read from the source socket is written to the sink socket.
+    # Reads land in a buffer that is allocated once, and whatever the sink will not immediately
+    #   accept is queued up in 'pending'. Once the queue reaches the high watermark, the source
+    #   is paused until the sink has drained the queue down to the low watermark.
+
+    def __init__(s, source, sink, size, high, low):
+        s.source = source
+        s.sink = sink
+        s.buffer = bytearray(size)
+        s.view = memoryview(s.buffer)
+        s.high = high
+        s.low = low
+
+        s.pending = bytearray()
+        s.paused = False
+        s.eof = False
+
+        s.bytes = 0
+        s.reads = 0
+
+    def close(s): pass
+
+    def flush(s):
+        try:
+            while s.pending:
+                # Deleting from the front of a bytearray does not shift the remaining bytes.
+                del s.pending[:s.sink.send(s.pending)]
+        except (BlockingIOError, SSLWantReadError, SSLWantWriteError): pass
+
+        if s.paused and len(s.pending) <= s.low: s.paused = False
+
+    def pump(s):
+        # Read until the source would block, the source closes, or the sink backs up.
+        read = 0
+        while not s.paused:
+            try: length = s.source.recv_into(s.buffer)
+            except (BlockingIOError, SSLWantReadError, SSLWantWriteError): break
+            if not length:
+                s.eof = True
+                break
+            read += length
+            s.bytes += length
+            s.reads += 1
+
+            chunk = s.view[:length]
+            if not s.pending:
+                # Nothing is queued up, so try to write straight out of the read buffer.
+                try: chunk = chunk[s.sink.send(chunk):]
+                except (BlockingIOError, SSLWantReadError, SSLWantWriteError): pass
+            if chunk: s.pending += chunk
+
+            if len(s.pending) >= s.high: s.paused = True
+        return read
+
+class TcpRelaySpliceFlow(TcpRelayFlow):
+    # Zero-copy variant of TcpRelayFlow for plain sockets.
+    # Data is spliced from the source socket into a pipe, and then from the pipe into the sink,
+    #   so it never has to be copied into the relay process. The pipe stands in for both the read
+    #   buffer and the queue, and 'pending' becomes a count of the bytes waiting in it.
+
+    SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+    def __init__(s, source, sink, size, high, low):
+        s.source = source
+        s.sink = sink
+        s.size = size
+
+        s.pending = 0
+        s.paused = False
+        s.eof = False
+
+        s.bytes = 0
+        s.reads = 0
+
+        s.pipe_r, s.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(s.pipe_w, fcntl.F_SETPIPE_SZ, high + size)
+            capacity = fcntl.fcntl(s.pipe_w, fcntl.F_GETPIPE_SZ)
+        except (AttributeError, OSError): capacity = 65536 # Stick with the default pipe size
+
+        # A full pipe would be indistinguishable from a drained socket, so never let the queue fill the pipe.
+        s.capacity = capacity
+        s.high = min(high, capacity)
+        s.low = min(low, s.high - 1)
+
+    def close(s):
+        os.close(s.pipe_r)
+        os.close(s.pipe_w)
+
+    def flush(s):
+        try:
+            while s.pending:
+                s.pending -= os.splice(s.pipe_r, s.sink.fileno(), s.pending, flags=s.SPLICE_FLAGS)
+        except BlockingIOError: pass
+
+        if s.paused and s.pending <= s.low: s.paused = False
+
+    def pump(s):
+        read = 0
+        while not s.paused:
+            try: length = os.splice(s.source.fileno(), s.pipe_w, min(s.size, s.capacity - s.pending), flags=s.SPLICE_FLAGS)
+            except BlockingIOError: break
+            if not length:
+                s.eof = True
+                break
+            read += length
+            s.bytes += length
+            s.reads += 1
+            s.pending += length
+
+            s.flush()
+            if s.pending >= s.high: s.paused = True
+        return read
+
+class TcpRelayHistogram(object):
+    # Cumulative latency histogram, in the shape that Prometheus expects.
+
+    BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+    def __init__(s):
+        s.counts = [0] * (len(s.BUCKETS) + 1) # The last slot is for anything over the largest bucket.
+        s.count = 0
+        s.sum = 0
+        s.lock = threading.Lock() # Probe and pool threads record latency as well.
+
+    def observe(s, value):
+        with s.lock:
+            s.counts[bisect.bisect_left(s.BUCKETS, value)] += 1
+            s.count += 1
+            s.sum += value
+
+    def to_dict(s):
+        with s.lock:
+            buckets = []
+            total = 0
+            for le, count in zip(s.BUCKETS + ['+Inf'], s.counts):
+                total += count
+                buckets.append((str(le), total))
+            return {'buckets': buckets, 'count': s.count, 'sum': s.sum}
+
+class TcpRelayTokenBucket(object):
+    # Allows 'rate' events per second, with bursts of up to a second's worth.
+
+    def __init__(s, rate, now):
+        s.rate = rate
+        s.capacity = max(rate, 1)
+        s.tokens = s.capacity
+        s.updated = now
+
+    def get_wait(s):
+        # Seconds until the next token
+        return max(0, 1 - s.tokens) / s.rate
+
+    def is_full(s, now):
+        s.refill(now)
+        return s.tokens >= s.capacity
+
+    def refill(s, now):
+        s.tokens = min(s.capacity, s.tokens + (now - s.updated) * s.rate)
+        s.updated = now
+
+    def refund(s): s.tokens += 1
+
+    def take(s, now):
+        s.refill(now)
+        if s.tokens < 1: return False
+        s.tokens -= 1
+        return True
+
+class TcpRelayTimer(object):
+    # An entry in TcpRelayTimerWheel.
+
+    def __init__(s, callback):
+        s.callback = callback
+        s.slot = None # Set that holds the timer while it is scheduled.
+        s.tick = None
+
+class TcpRelayTimerWheel(object):
+    # Hierarchical timer wheel.
+    # Each level is a ring of slots. A slot on the first level covers one tick, and a slot on each level
+    #   after that covers a full turn of the level below it. Timers are placed on the lowest level that can
+    #   reach them, and are moved down a level each time the level below them comes back around to their slot.
+    # Scheduling, cancelling, and expiring are all O(1), no matter how many sessions are waiting on a timer.
+
+    def __init__(s, now, resolution = 0.1, slots = 256, levels = 3):
+        s.resolution = resolution
+        s.slots = slots
+        s.wheels = [[set() for i in range(slots)] for level in range(levels)]
+        s.span = slots ** levels # Ticks that the wheel can reach
+
+        s.current = int(now / resolution)
+        s.count = 0
+
+    def advance(s, now):
+        # Returns timers that expired between the last call and 'now'.
+        expired = []
+        target = int(now / s.resolution)
+        while s.current < target:
+            s.current += 1
+
+            # Cascade from the top down so that timers can drop more than one level in a single tick.
+            for level in range(len(s.wheels) - 1, 0, -1):
+                unit = s.slots ** level
+                if s.current % unit: continue
+                slot = s.wheels[level][(s.current // unit) % s.slots]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers: s.place(timer)
+
+            slot = s.wheels[0][s.current % s.slots]
+            for timer in slot: timer.slot = None
+            s.count -= len(slot)
+            expired.extend(slot)
+            slot.clear()
+        return expired
+
+    def cancel(s, timer):
+        if timer.slot is None: return
+        timer.slot.discard(timer)
+        timer.slot = None
+        s.count -= 1
+
+    def place(s, timer):
+        delta = timer.tick - s.current
+        unit = 1
+        for wheel in s.wheels:
+            if delta < unit * s.slots or wheel is s.wheels[-1]: break
+            unit *= s.slots
+        timer.slot = wheel[(timer.tick // unit) % s.slots]
+        timer.slot.add(timer)
+
+    def schedule(s, timer, deadline):
+        s.cancel(timer)
+        # Timers beyond the reach of the wheel go off early. Their owners are expected to check the time and set them again.
+        tick = int(math.ceil(deadline / s.resolution))
+        timer.tick = max(s.current + 1, min(tick, s.current + s.span - 1))
+        s.place(timer)
+        s.count += 1
+
+class TcpRelayPool(object):
+    # Connections to a target that are opened (and SSL-initialized) by a background thread
+    #   so that a new session does not have to wait on them.
+
+    def __init__(s, target, size, max_idle, event):
+        s.target = target
+        s.size = size
+        s.max_idle = max_idle
+        s.event = event
+
+        s.lock = threading.Lock()
+        s.sockets = [] # (socket, time opened)
+
+    def fill(s, ctx):
+        with s.lock:
+            fresh = [(sock, opened) for sock, opened in s.sockets if s.is_usable(sock, opened)]
+            for sock, opened in s.sockets:
+                if (sock, opened) not in fresh: sock.close()
+            s.sockets = fresh
+            needed = s.size - len(s.sockets)
+
+        for i in range(needed):
+            started = time.time()
+            try:
+                sock = socket.create_connection((s.target.ip, s.target.port), TcpRelayTarget.PROBE_TIMEOUT)
+                if ctx:
+                    sock = ctx.wrap_socket(sock, server_hostname=s.target.hostname, session=s.target.ssl_session)
+                    s.target.remember_session(sock)
+                sock.setblocking(False)
+            except (SSLError, OSError) as e:
+                s.target.record_failure(False)
+                return
+
+            s.target.record_latency(time.time() - started)
+            with s.lock: s.sockets.append((sock, time.time()))
+
+    def is_usable(s, sock, opened):
+        if time.time() - opened > s.max_idle: return False
+        try:
+            # Peek at the raw socket, beneath any SSL layer.
+            # Data is fine (the target may speak first), but an empty read means that the target hung up.
+            return socket.socket.recv(sock, 1, socket.MSG_PEEK) != b''
+        except BlockingIOError: return True
+        except OSError: return False
+
+    def take(s):
+        with s.lock:
+            while s.sockets:
+                sock, opened = s.sockets.pop(0)
+                if s.is_usable(sock, opened): break
+                sock.close()
+            else: sock = None
+        s.event.set() # Top the pool back up
+        return sock
+
 class TcpRelayTarget(object):
+
+    # Consecutive failed sessions before a target is ejected without waiting on a probe.
+    FAILURE_THRESHOLD = 3
+    # Weight given to the newest connect time in the running average.
+    LATENCY_WEIGHT = 0.3
+    PROBE_TIMEOUT = 2
+
     def __init__(s, t_ip, t_port, t_host):
         s.ip = t_ip
         s.port = t_port
         s.hostname = t_host
+
+        s.active = 0
+        s.failures = 0
+        s.healthy = True
+        s.latency = None
+        s.pool = None
+        s.ssl_session = None
+
+        # Statistics
+        s.bytes_in = 0
+        s.bytes_out = 0
+        s.connect_histogram = TcpRelayHistogram()
+        s.handshake_histogram = TcpRelayHistogram()
+
+    def get_stats(s):
+        return {
+            'address': '%s:%d' % (s.ip, s.port),
+            'hostname': s.hostname,
+            'healthy': s.healthy,
+            'failures': s.failures,
+            'latency': s.latency,
+            'sessions_active': s.active,
+            'pooled': len(s.pool.sockets) if s.pool else 0,
+            'bytes': {'in': s.bytes_in, 'out': s.bytes_out},
+            'connect_seconds': s.connect_histogram.to_dict(),
+            'handshake_seconds': s.handshake_histogram.to_dict()
+        }
+
+    def probe(s, timeout):
+        started = time.time()
+        try: socket.create_connection((s.ip, s.port), timeout).close()
+        except (socket.error, socket.timeout) as e:
+            if s.healthy: log_error('Ejecting target %s: %s' % (s, e))
+            s.healthy = False
+            return False
+
+        s.record_latency(time.time() - started)
+        if not s.healthy: log_notice('Restoring target: %s' % s)
+        s.healthy = True
+        return True
+
+    def remember_session(s, sock):
+        # Keep the most recent resumable SSL session to offer on the next connection.
+        session = getattr(sock, 'session', None)
+        if session and (session.has_ticket or session.id): s.ssl_session = session
+
+    def record_failure(s, eject):
+        # Without health checks, there would be nothing to restore an ejected target.
+        s.failures += 1
+        if eject and s.healthy and s.failures >= s.FAILURE_THRESHOLD:
+            log_error('Ejecting target %s after %s failed connections.' % (s, colour_text(s.failures)))
+            s.healthy = False
+
+    def record_latency(s, latency):
+        s.failures = 0
+        s.connect_histogram.observe(latency)
+        if s.latency is None: s.latency = latency
+        else: s.latency += s.LATENCY_WEIGHT * (latency - s.latency)
     __str__ = lambda s: colour_addr(s.ip, s.port, s.hostname)
 
 # Run
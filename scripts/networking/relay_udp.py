@@ -2,9 +2,10 @@
 
 from __future__ import print_function
 # General
-import getopt, os, random, re, sys, time
+import bisect, collections, getopt, heapq, itertools, os, random, re, signal, sys, threading, time
 # Networking
-import fcntl, select, socket, struct
+import fcntl, json, select, socket, struct
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from select import EPOLLIN, EPOLLET, EPOLLONESHOT, EPOLLOUT
 
 #
@@ -344,9 +345,15 @@ class OptArg:
 ###
 
 class NetAccess:
-    # Basic IPv4 CIDR syntax check
+    # Basic IPv4 syntax checks
+    REGEX_INET4='^(([0-9]){1,3}\.){3}([0-9]{1,3})$'
     REGEX_INET4_CIDR='^(([0-9]){1,3}\.){3}([0-9]{1,3})\/[0-9]{1,2}$'
 
+    # Most addresses to remember a verdict for
+    CACHE_SIZE = 4096
+    # Seconds between checks on watched files, if inotify is not available
+    WATCH_INTERVAL = 5
+
     def __init__(s):
         s.errors = []
         s.allowed_addresses = []
@@ -354,20 +361,39 @@ class NetAccess:
         s.denied_addresses = []
         s.denied_networks = []
 
+        # Sorted, non-overlapping ranges of allowed and denied addresses, built from the lists above as needed,
+        #  along with verdicts for recently-checked addresses (oldest first).
+        # Replaced as a whole on reloading, so that is_allowed() never sees half of a change.
+        s.compiled = None
+        # Entries and files in the order that they were added, as (method name, value), for reloading.
+        s.sources = []
+
     def add_access(s, addr_list, net_list, candidate):
         good = True
         candidate = candidate.strip()
+        if not candidate or candidate.startswith('#'): return True # Blank line or comment in a file
         if re.match(s.REGEX_INET4_CIDR, candidate):
             g, n = s.ip_validate_cidr(candidate)
-            if g: net_list.append((n, candidate))
+            good = g
+            if g:
+                # No error
+                net_list.append((n, candidate))
         else:
             g, a, astr = s.ip_validate_address(candidate)
-            if g: addr_list.append((a, candidate, astr))
-        return g
+            good = g
+            if g:
+                # No error
+                addr_list.append((a, candidate, astr))
+        s.compiled = None
+        return good
 
-    add_blacklist = lambda s, c: s.add_access(s.denied_addresses, s.denied_networks, c)
+    def add_blacklist(s, candidate):
+        s.sources.append(('add_blacklist', candidate))
+        return s.add_access(s.denied_addresses, s.denied_networks, candidate)
 
-    add_whitelist = lambda s, c: s.add_access(s.allowed_addresses, s.allowed_networks, c)
+    def add_whitelist(s, candidate):
+        s.sources.append(('add_whitelist', candidate))
+        return s.add_access(s.allowed_addresses, s.allowed_networks, candidate)
 
     def announce_filter_actions(self):
         for action, address_list, network_list in [("Allowing", self.allowed_addresses, self.allowed_networks), ("Denying", self.denied_addresses, self.denied_networks)]:
@@ -376,30 +402,54 @@ class NetAccess:
             l.extend([("network", s, s) for n, s in network_list])
 
             for title, ip, address in l:
-                if ip == address: print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
-                else: print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+                if ip == address:
+                    print_notice("%s %s: %s" % (action, title, colour_text(address, COLOUR_GREEN)))
+                else:
+                    print_notice("%s %s: %s (%s)" % (action, title, colour_text(address, COLOUR_GREEN), colour_text(ip, COLOUR_GREEN)))
+
+    def compile(s):
+        # Merge the lists into sorted ranges that can be searched with bisect,
+        #  so that checking an address does not mean going through every entry.
+        s.compiled = (s.compile_ranges(s.allowed_addresses, s.allowed_networks), s.compile_ranges(s.denied_addresses, s.denied_networks), collections.OrderedDict())
+
+    def compile_ranges(s, addr_list, net_list):
+        # Returns a list of range starts, and a list of the matching range ends.
+        starts = []
+        ends = []
+        for start, end in sorted([(a[0], a[0]) for a in addr_list] + [n[0] for n in net_list]):
+            if ends and start <= ends[-1] + 1:
+                # Overlaps or runs into the previous range.
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
 
     # Credit for initial IP functions: http://code.activestate.com/recipes/66517/
 
-    # Return a mask of n bits as a long integer
-    ip_make_mask = lambda s, n: (2<<n-1)-1
-
-    # Convert decimal dotted quad string to long integer
-    def ip_strton(s, ip): return struct.unpack('<L',socket.inet_aton(ip))[0]
+    def ip_in_ranges(s, n, ranges):
+        # Is a numeric address in a list of compiled ranges?
+        starts, ends = ranges
+        i = bisect.bisect_right(starts, n) - 1
+        return i >= 0 and n <= ends[i]
 
-    def ip_network_mask(s, ip, bits):
-        # Convert a network address to a long integer
-        return s.ip_strton(ip) & s.ip_make_mask(int(bits))
+    def ip_strton(s, ip):
+        # Convert decimal dotted quad string to an integer
+        return struct.unpack('!L',socket.inet_aton(ip))[0]
 
-    def ip_addrn_in_network(s, ip, net):
-        # Is a numeric address in a network?
-        return ip & net == net
+    def ip_network_range(s, ip, bits):
+        # Convert a network to the first and last addresses in it, as integers
+        host_mask = (1 << (32 - int(bits))) - 1
+        start = s.ip_strton(ip) & ~host_mask
+        return (start, start | host_mask)
 
     def ip_validate_address(s, candidate):
         try:
-            ip = socket.gethostbyname(candidate)
+            # Only look up names. Addresses do not need a trip to DNS.
+            if re.match(s.REGEX_INET4, candidate): ip = candidate
+            else: ip = socket.gethostbyname(candidate)
             return (True, s.ip_strton(ip), ip)
-        except socket.gaierror:
+        except socket.error:
             s.errors.append("Unable to resolve: %s" % colour_text(candidate, COLOUR_GREEN))
             return (False, None, None)
 
@@ -407,66 +457,158 @@ class NetAccess:
         a = candidate.split("/")[0]
         m = candidate.split("/")[1]
         try:
-            if socket.gethostbyname(a) and int(m) <= 32: return (True, self.ip_network_mask(a, m))
-        except socket.gaierror: pass
-
+            if int(m) <= 32:
+                return (True, s.ip_network_range(a, m))
+        except socket.error:
+            pass
         s.errors.append("Invalid CIDR address: %s" % colour_text(candidate, COLOUR_GREEN))
         return (False, None)
 
-    def is_allowed(self, address):
+    def is_allowed(s, address):
         # Blacklist/Whitelist filtering
-        allowed = True
+        if s.compiled is None: s.compile()
+        allowed_ranges, denied_ranges, cache = s.compiled
+        if not allowed_ranges[0] and not denied_ranges[0]: return True
 
-        if len(self.allowed_addresses) or len(self.allowed_networks):
-            # Whitelist processing, address is not allowed until it is cleared.
-            allowed = False
+        verdict = cache.pop(address, None)
+        if verdict is None:
+            try: n = s.ip_strton(address)
+            except (socket.error, TypeError): n = None # Not an IPv4 address, so no entry can match it.
 
-            if address in [a[2] for a in self.allowed_addresses]: allowed = True
-            else:
-                # Try checking allowed networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.allowed_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = True
-                        break
-
-        if allowed and len(self.denied_addresses) or len(self.denied_networks):
+            # Whitelist processing, address is not allowed until it is cleared.
+            verdict = not allowed_ranges[0] or (n is not None and s.ip_in_ranges(n, allowed_ranges))
             # Blacklist processing. A blacklist argument one-ups a whitelist argument in the event of a conflict
-            # Do not bother to check the blacklist if the address is already denied.
+            if verdict and n is not None and s.ip_in_ranges(n, denied_ranges): verdict = False
 
-            if address in [a[2] for a in self.denied_addresses]: allowed = False
-            else:
-                # Try checking denied networks
-                cn = self.ip_strton(address)
-                for n in [n[0] for n in self.denied_networks]:
-                    if self.ip_addrn_in_network(cn, n):
-                        allowed = False
-                        break
-        return allowed
-
-    def load_access_file(s, fn, path, header):
+            if len(cache) >= s.CACHE_SIZE: cache.popitem(last = False)
+        cache[address] = verdict
+        return verdict
+
+    def load_access_file(s, addr_list, net_list, path, header):
         if not os.path.isfile(path):
             s.errors.append("Path to %s file does not exist: %s" % (header, colour_text(path, COLOUR_GREEN)))
             return False
         with open(path) as f:
-            for l in f.readlines(): fn(l)
+            for l in f:
+                s.add_access(addr_list, net_list, l)
+        return True
 
-    def load_blacklist_file(s, path): return s.load_access_file(s.add_blacklist, path, "blacklist")
+    def load_blacklist_file(s, path):
+        s.sources.append(('load_blacklist_file', path))
+        return s.load_access_file(s.denied_addresses, s.denied_networks, path, "blacklist")
 
-    def load_whitelist_file(s, path): return s.load_access_file(s.add_whitelist, path, "whitelist")
+    def load_whitelist_file(s, path):
+        s.sources.append(('load_whitelist_file', path))
+        return s.load_access_file(s.allowed_addresses, s.allowed_networks, path, "whitelist")
+
+    def reload(s):
+        # Rebuild everything from scratch, then swap it in.
+        # Checks that are already underway finish against the old lists.
+        if [value for name, value in s.sources if name.endswith('_file') and not os.path.isfile(value)]:
+            # Most likely caught in the middle of being replaced. Keep the current lists until the next change.
+            return False
+
+        fresh = NetAccess()
+        for name, value in s.sources: getattr(fresh, name)(value)
+
+        for error in fresh.errors: print_warning("Reloading access lists: %s" % error)
+        fresh.compile()
+        s.allowed_addresses, s.allowed_networks = fresh.allowed_addresses, fresh.allowed_networks
+        s.denied_addresses, s.denied_networks = fresh.denied_addresses, fresh.denied_networks
+        s.compiled = fresh.compiled
+        return True
+
+    def watch(s):
+        # Reload the lists in the background whenever one of their files changes.
+        # Threads do not survive a fork, so this should be called in the process that will be checking addresses.
+        paths = [os.path.realpath(value) for name, value in s.sources if name.endswith('_file')]
+        if not paths: return False
+
+        t = threading.Thread(target=s.watch_files, args=(paths,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def watch_files(s, paths):
+        try: s.watch_files_inotify(paths)
+        except (ImportError, OSError, AttributeError): s.watch_files_poll(paths)
+
+    def watch_files_inotify(s, paths):
+        # Watch the directories rather than the files, so that files that are replaced
+        #  (written elsewhere and then renamed into place) are still caught.
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        try:
+            names = {}
+            for path in paths:
+                directory, name = os.path.split(path)
+                # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                wd = libc.inotify_add_watch(fd, directory.encode('utf-8'), 0x08 | 0x80 | 0x100)
+                if wd < 0: raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % directory)
+                names.setdefault(wd, set()).add(name.encode('utf-8'))
+
+            while True:
+                data = os.read(fd, 65536)
+                changed = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                    offset += 16 + length
+                    if name in names.get(wd, ()): changed = True
+
+                if changed:
+                    # Let a burst of changes settle before reading.
+                    time.sleep(0.5)
+                    s.reload()
+        finally: os.close(fd)
+
+    def watch_files_poll(s, paths):
+        def stat(path):
+            try:
+                st = os.stat(path)
+                return (st.st_ino, st.st_size, st.st_mtime)
+            except OSError: return None
+
+        last = [stat(path) for path in paths]
+        while True:
+            time.sleep(s.WATCH_INTERVAL)
+            current = [stat(path) for path in paths]
+            if current != last and s.reload(): last = current
 
 # Script Classes
 
+TITLE_BACKLOG_MAX_AGE = "backlog-max-age"
+TITLE_BACKLOG_SIZE = "backlog-size"
+TITLE_BATCH_SIZE = "batch-size"
 TITLE_BIND = "bind"
+TITLE_DEMUX = "demux"
+TITLE_DROP_POLICY = "drop-policy"
+TITLE_IDLE_TIMEOUT = "idle-timeout"
 TITLE_PORT = "port"
+TITLE_STATS_BIND = "stats-bind"
+TITLE_STATS_PORT = "stats-port"
 TITLE_VERBOSE="verbose"
+TITLE_WORKERS = "workers"
 
 TITLE_BALANCE_RANDOM = "random-target"
 TITLE_BALANCE_ROUND_ROBIN = "round-robin-target"
 
 TITLE_MULTIPLY = 'multiply'
 TITLE_NO_RESPONSE = 'no-reply'
+TITLE_RACE_FRACTION = 'race-fraction'
 TITLE_TARGET_PORT = 'target-port'
+TITLE_UPSTREAM_SOCKETS = 'upstream-sockets'
+
+DEMUX_DNS = 'dns'
+DEMUX_PORT = 'port'
+
+DROP_AGE = 'age'
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
 
 TITLE_ALLOW = 'allow address/range'
 TITLE_ALLOW_FILE = 'allow address/range file'
@@ -475,11 +617,21 @@ TITLE_DENY_FILE = 'deny address/range file'
 
 class UdpRelayServer:
 
+    DEFAULT_BACKLOG_MAX_AGE = 1
+    DEFAULT_BACKLOG_SIZE = 1024
+    DEFAULT_BATCH_SIZE = 32
     DEFAULT_BIND = "0.0.0.0"
+    DEFAULT_IDLE_TIMEOUT = 60
     DEFAULT_PORT = 4444
+    DEFAULT_RACE_FRACTION = 0.1
     DEFAULT_TARGET_PORT = 4444
+    DEFAULT_WORKERS = 1
 
     FLAGS = EPOLLET | EPOLLIN | EPOLLONESHOT
+    # Largest datagram that will be relayed. Anything larger is truncated.
+    MAX_DATAGRAM = 10240
+    # A worker that exits this soon after starting is assumed to be unable to run at all.
+    WORKER_STARTUP_GRACE = 2
 
     def __init__(self):
 
@@ -498,11 +650,22 @@ class UdpRelayServer:
         args.add_opt(OPT_TYPE_SHORT, "b", TITLE_BIND, "Address to bind to.", default = self.DEFAULT_BIND, default_announce = True, default_colour = COLOUR_GREEN)
         args.add_opt(OPT_TYPE_SHORT, "p", TITLE_PORT, "Specify server bind port.", converter = int, default = self.DEFAULT_PORT, default_announce = True)
         args.add_opt(OPT_TYPE_LONG, TITLE_TARGET_PORT, TITLE_TARGET_PORT, 'Specify default target port.', default = self.DEFAULT_TARGET_PORT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_IDLE_TIMEOUT, TITLE_IDLE_TIMEOUT, 'Close sessions that have not had any traffic for this many seconds.', converter = float, default = self.DEFAULT_IDLE_TIMEOUT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_UPSTREAM_SOCKETS, TITLE_UPSTREAM_SOCKETS, 'Share this many sockets between all clients for talking to targets, instead of opening one for each client. 0 to disable.', converter = int, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_DEMUX, TITLE_DEMUX, 'How to tell replies for different clients apart on shared upstream sockets. "%s": each socket carries one client per target at a time. "%s": clients are told apart by DNS transaction IDs, so any number of clients can share a socket.' % (DEMUX_PORT, DEMUX_DNS), default = DEMUX_PORT, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_BACKLOG_SIZE, TITLE_BACKLOG_SIZE, 'Most datagrams to hold for a socket that is not ready to send them.', converter = int, default = self.DEFAULT_BACKLOG_SIZE, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_DROP_POLICY, TITLE_DROP_POLICY, 'Which datagrams to drop when a backlog is full. "%s": the datagram that does not fit. "%s": the longest-waiting datagram. "%s": datagrams that have waited for longer than --%s, then the longest-waiting datagram.' % (DROP_NEWEST, DROP_OLDEST, DROP_AGE, TITLE_BACKLOG_MAX_AGE), default = DROP_NEWEST, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_BACKLOG_MAX_AGE, TITLE_BACKLOG_MAX_AGE, 'Seconds that a datagram can wait in a backlog under the "%s" drop policy.' % DROP_AGE, converter = float, default = self.DEFAULT_BACKLOG_MAX_AGE, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_WORKERS, TITLE_WORKERS, 'Number of worker processes to relay with. Each worker binds the port with SO_REUSEPORT, and each client is always handled by the same worker.', converter = int, default = self.DEFAULT_WORKERS, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_STATS_PORT, TITLE_STATS_PORT, 'Serve session statistics over HTTP on this port (/ for JSON, /metrics for Prometheus). Worker processes each use the next port up. 0 to disable.', converter = int, default = 0, default_announce = True)
+        args.add_opt(OPT_TYPE_LONG, TITLE_STATS_BIND, TITLE_STATS_BIND, 'Address to serve statistics on.', default = '127.0.0.1', default_announce = True, default_colour = COLOUR_GREEN)
+        args.add_opt(OPT_TYPE_LONG, TITLE_BATCH_SIZE, TITLE_BATCH_SIZE, 'Most datagrams to move in one system call with recvmmsg(2)/sendmmsg(2). 1 to use recvfrom(2)/sendto(2).', converter = int, default = self.DEFAULT_BATCH_SIZE, default_announce = True)
 
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_RANDOM, TITLE_BALANCE_RANDOM, 'Select between multiple targets at random.')
         args.add_opt(OPT_TYPE_LONG_FLAG, TITLE_BALANCE_ROUND_ROBIN, TITLE_BALANCE_ROUND_ROBIN, 'Rotate between targets (default).')
 
         args.add_opt(OPT_TYPE_FLAG, 'm', TITLE_MULTIPLY, 'Broadcast message to all targets at once. Only responses from the first responding target will bet forwarded to the clinet.')
+        args.add_opt(OPT_TYPE_LONG, TITLE_RACE_FRACTION, TITLE_RACE_FRACTION, 'In multiply mode, the fraction of new sessions to send to all targets. The rest go to the target that has been quickest to reply. 1 to always send to all targets.', converter = float, default = self.DEFAULT_RACE_FRACTION, default_announce = True)
         args.add_opt(OPT_TYPE_FLAG, 'n', TITLE_NO_RESPONSE, 'Do not listen for any response from the target servers.')
 
         args.add_opt(OPT_TYPE_SHORT, "a", TITLE_ALLOW, "Add network address or CIDR range to whitelist.", multiple = True)
@@ -519,18 +682,39 @@ class UdpRelayServer:
         self.sessions = {}
         self.targets = []
 
+        # Datagrams dropped from full or stale backlogs ('in': client to target, 'out': target to client),
+        #  including those for sessions that have since closed.
+        self.dropped = {'in': 0, 'out': 0}
+        self.sessions_total = 0
+
     def get_target_round_robin(s):
         s._round_robin_index = (getattr(s, '_round_robin_index', -1) + 1) % len(s.targets)
         return s.targets[s._round_robin_index]
 
-    def init_server(self):
-        self.server_socket = self.new_socket()
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.args[TITLE_BIND], self.port))
+    def init_io(self):
+        self.io = None
+        if self.batch_size > 1:
+            try: self.io = UdpRelayBatchIO(self.batch_size, self.MAX_DATAGRAM)
+            except (ImportError, OSError, AttributeError) as e:
+                print_warning('Batched datagram I/O is not available, falling back to one datagram per system call: %s' % e)
+        if not self.io: self.io = UdpRelayIO(self.MAX_DATAGRAM)
+        elif self.verbose: print_notice('Moving up to %s datagrams per system call.' % colour_text(self.batch_size))
+
+    def init_server(self, server_socket = None):
+        # Workers are handed a server socket that was bound by the supervisor.
+        self.server_socket = server_socket or self.new_server_socket()
 
         self.epoll_socket = select.epoll()
         self.epoll_socket.register(self.server_socket, EPOLLET | EPOLLIN | EPOLLONESHOT)
 
+        self.pool = None
+        if self.upstream_sockets:
+            if self.demux == DEMUX_DNS: demux = UdpRelayDnsDemux(self.idle_timeout)
+            else: demux = UdpRelayDemux()
+            self.pool = UdpRelayUpstreamPool(self, [self.new_socket() for i in range(self.upstream_sockets)], demux)
+            if not self.no_reply:
+                for fd in self.pool.sockets: self.epoll_socket.register(fd, self.FLAGS)
+
         return True
 
     def is_loop(s, target_addr, server_addr):
@@ -557,6 +741,13 @@ class UdpRelayServer:
         # Run through all options, not a loop.
         return False
 
+    def new_server_socket(self):
+        s = self.new_socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1: s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((self.args[TITLE_BIND], self.port))
+        return s
+
     def new_socket(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -571,11 +762,21 @@ class UdpRelayServer:
         if s.verbose: print_notice('Additional information shall be printed.')
 
         if s.multiply:
-            print_notice('Relaying to all targets at once.')
+            if s.no_reply or s.race_fraction >= 1: print_notice('Relaying to all targets at once.')
+            else: print_notice('Relaying %s of new sessions to all targets at once, and the rest to the quickest target.' % colour_text('%g%%' % (s.race_fraction * 100)))
 
         if s.no_reply:
             print_notice('Not expecting or relaying any replies from target server(s).')
 
+        if s.workers > 1: print_notice('Relaying with %s worker processes.' % colour_text(s.workers))
+
+        if s.stats_port:
+            if s.workers > 1: print_notice('Serving statistics on %s through %s' % (colour_addr(s.args[TITLE_STATS_BIND], s.stats_port), colour_text(s.stats_port + s.workers - 1)))
+            else: print_notice('Serving statistics on %s' % colour_addr(s.args[TITLE_STATS_BIND], s.stats_port))
+
+        if s.upstream_sockets:
+            print_notice('Sharing %s upstream socket(s) between clients, told apart by %s.' % (colour_text(s.upstream_sockets), colour_text(s.demux)))
+
         if len(s.targets) == 1:
             s.get_target = lambda: s.targets[0]
 
@@ -588,6 +789,49 @@ class UdpRelayServer:
             if s.args[TITLE_BALANCE_RANDOM]: s.get_target = lambda: s.targets[random.randint(0, len(s.targets)-1)]
             else: s.get_target = s.get_target_round_robin
 
+    def get_quickest_target(s):
+        # Choose a target for a new session in multiply mode, or None to send to all of them.
+        # Sessions sent to all targets are a race between them, which keeps their latency estimates fresh.
+        if s.no_reply or random.random() < s.race_fraction: return None
+        candidates = [t for t in s.targets if t.latency is not None and t.is_healthy()]
+        if not candidates: return None
+        return min(candidates, key = lambda t: t.latency)
+
+    def get_stats(s):
+        sessions = list(s.sessions.values())
+        now = time.time()
+        return {
+            'sessions': {'active': len(sessions), 'total': s.sessions_total},
+            'dropped': dict(s.dropped),
+            'targets': [t.get_stats() for t in s.targets],
+            'active_sessions': [session.get_stats(now) for session in sessions]
+        }
+
+    def get_stats_prometheus(s):
+        stats = s.get_stats()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP relay_udp_%s %s' % (name, help_text))
+            lines.append('# TYPE relay_udp_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join(['%s="%s"' % (k, v) for k, v in labels])
+                if label_text: label_text = '{%s}' % label_text
+                lines.append('relay_udp_%s%s %s' % (name, label_text, value))
+
+        directions = ['in', 'out']
+        metric('sessions_active', 'gauge', 'Sessions currently open.', [([], stats['sessions']['active'])])
+        metric('sessions_total', 'counter', 'Sessions started.', [([], stats['sessions']['total'])])
+        metric('dropped_total', 'counter', 'Datagrams dropped from full or stale backlogs (in: client to target, out: target to client).', [([('direction', d)], stats['dropped'][d]) for d in directions])
+        metric('session_dropped_total', 'counter', 'Datagrams dropped from backlogs for each open session.', [([('client', session['client']), ('direction', d)], session['dropped'][d]) for session in stats['active_sessions'] for d in directions])
+        metric('session_backlog', 'gauge', 'Datagrams waiting to be sent to targets for each open session.', [([('client', session['client'])], session['backlog']) for session in stats['active_sessions']])
+
+        targets = [([('target', t['address'])], t) for t in stats['targets']]
+        metric('target_up', 'gauge', 'Whether the target has been replying to sessions.', [(labels, int(t['healthy'])) for labels, t in targets])
+        metric('target_latency_seconds', 'gauge', 'Moving average of the time for the target to reply to a new session.', [(labels, t['latency']) for labels, t in targets if t['latency'] is not None])
+
+        return '\n'.join(lines) + '\n'
+
     def resolve_port(s, value, label):
         try:
             port = int(value)
@@ -603,20 +847,118 @@ class UdpRelayServer:
     def run(self):
         self.args.process(sys.argv)
         self.print_summary()
-        if not self.init_server(): return 1
+        self.init_io()
+        if self.workers > 1: return self.run_supervisor()
+        return self.run_worker()
+
+    def run_supervisor(self):
+        # The supervisor binds a socket for each worker up front, and holds on to all of them.
+        # The kernel picks a socket for each datagram out of a group that never changes, so a client
+        #  always lands on the same worker, and on its sessions (and --multiply choice of target).
+        # A worker that is restarted takes over the same socket, and picks up datagrams that
+        #  queued on it in the meantime rather than having its clients moved to other workers.
+        sockets = [self.new_server_socket() for i in range(self.workers)]
+        attach_reuseport_hash(sockets[0], self.workers)
+        workers = {}
+
+        def spawn(index):
+            pid = os.fork()
+            if pid:
+                workers[pid] = (index, time.time())
+                if self.verbose: print_notice('Started worker %s (PID %s)' % (colour_text(index), colour_text(pid)))
+                return
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                for i, sock in enumerate(sockets):
+                    if i != index: sock.close()
+                code = self.run_worker(index, sockets[index])
+            except KeyboardInterrupt: code = 130
+            except Exception as e: print_exception(e, 'worker %s' % index)
+            finally: os._exit(code)
+
+        # Let a terminated supervisor clean up its workers on the way out.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            for i in range(self.workers): spawn(i)
+
+            while workers:
+                pid, status = os.wait()
+                if pid not in workers: continue
+                index, started = workers.pop(pid)
+
+                if time.time() - started < self.WORKER_STARTUP_GRACE:
+                    print_error('Worker %s (PID %s) failed to start. Shutting down.' % (colour_text(index), colour_text(pid)))
+                    return 1
+
+                print_error('Worker %s (PID %s) exited unexpectedly (status %s). Restarting.' % (colour_text(index), colour_text(pid), colour_text(status)))
+                spawn(index)
+        finally:
+            for pid in workers:
+                try: os.kill(pid, signal.SIGTERM)
+                except OSError: pass
+            for pid in workers:
+                try: os.waitpid(pid, 0)
+                except OSError: pass
+        return 0
 
-        sessions_by_addr = {}
+    def run_worker(self, index = 0, server_socket = None):
+        if not self.init_server(server_socket): return 1
+        self.access.watch()
+
+        if self.stats_port:
+            t = threading.Thread(target=lambda: self.run_stats(self.stats_port + index))
+            t.daemon = True
+            t.start()
+
+        sessions_by_addr = self.sessions
         sessions_by_fd = {}
 
-        active_sockets = []
-        backlog_server = []
+        backlog_server = UdpRelayBacklog(self, 'out')
         server_fd = self.server_socket.fileno()
+        io = self.io
+        pool = self.pool
+
+        # Descriptors that are registered with epoll
+        active_sockets = set([server_fd])
+        if pool and not self.no_reply: active_sockets.update(pool.sockets)
+
+        # Sessions ordered by when they are next due to be checked for expiry, as (time, sequence, session).
+        # Traffic does not touch the heap. Instead, a session that comes due but has seen traffic since
+        #  is pushed back in with a later time.
+        expiry = []
+        sequence = itertools.count()
+
+        def reply(session, data, addr):
+            if session.waiting:
+                # Time each target's first reply to the session, whether or not it is the first target to reply.
+                target = session.waiting.pop(addr, None)
+                if target: target.record_reply(now - session.sent)
+
+            if self.multiply and session.target_addr is None:
+                valid_sources = [t.get_addr() for t in self.targets]
+            else:
+                # Have received a response
+                valid_sources = [session.target_addr]
+
+            if addr not in valid_sources: return
+
+            if session.target_addr is None: session.target_addr = addr
+
+            backlog_server.append((data, session.addr), now, session)
+            flush[server_fd] = (self.server_socket, backlog_server)
 
         try:
             while True:
                 events = self.epoll_socket.poll(1)
+                now = time.time()
 
                 write_fds = set()
+                # Datagrams are queued up while reading, and then sent off in as few calls as possible.
+                # Keyed by file descriptor, with (socket, queue) values.
+                flush = {}
 
                 for fd, event in events:
 
@@ -625,94 +967,117 @@ class UdpRelayServer:
                             # New data from the client.
                             try:
                                 while True:
-                                    data, addr = self.server_socket.recvfrom(10240)
-                                    if not self.access.is_allowed(addr[0]): continue
-
-                                    # Get session by source tuple
-                                    session = sessions_by_addr.get(addr)
-                                    if not session:
-                                        # If a session does not exist, then create one
-                                        session = UdpRelaySession(self, addr)
-                                        sessions_by_addr[addr] = session
-                                        sessions_by_fd[session.socket.fileno()] = session
-
-                                        if not self.no_reply:
-                                            self.epoll_socket.register(session.socket.fileno(), self.FLAGS)
-                                            active_sockets.append(session.socket.fileno())
-
-                                        if self.verbose: print_notice('New session: %s' % session)
-
-                                    session.time = time.time()
-
-                                    if self.multiply and session.target_addr is None:
-                                        # Multiplier-mode, and have not yet received a response.
-                                        # Send to all targets
-                                        targets = [t.get_addr() for t in self.targets]
-                                    else:
-                                        # Target has been decided.
-                                        targets = [session.target_addr]
-
-                                    for t in targets:
-                                        try:
-                                            session.socket.sendto(data, t)
-                                        except BlockingIOError:
-                                            # Error writing a message from the relay to the target
-                                            write_fds.add(session.socket.fileno())
-                                            session.backlog.append((data, t))
-
-                                    session.running = not self.no_reply
+                                    packets = io.recv(self.server_socket)
+                                    for data, addr in packets:
+                                        if not self.access.is_allowed(addr[0]): continue
+
+                                        # Get session by source tuple
+                                        session = sessions_by_addr.get(addr)
+                                        if not session:
+                                            # If a session does not exist, then create one
+                                            session = UdpRelaySession(self, addr)
+                                            sessions_by_addr[addr] = session
+                                            self.sessions_total += 1
+
+                                            # Sessions on shared upstream sockets do not have a socket of their own.
+                                            if session.socket:
+                                                sessions_by_fd[session.socket.fileno()] = session
+                                                if not self.no_reply:
+                                                    self.epoll_socket.register(session.socket.fileno(), self.FLAGS)
+                                                    active_sockets.add(session.socket.fileno())
+
+                                            # Without replies to wait on, the session is finished as soon as its data is sent.
+                                            heapq.heappush(expiry, (now if self.no_reply else now + self.idle_timeout, next(sequence), session))
+
+                                            if self.verbose: print_notice('New session: %s' % session)
+
+                                        session.time = now
+
+                                        if self.multiply and session.target_addr is None:
+                                            # Multiplier-mode, and have not yet received a response.
+                                            # Send to all targets
+                                            targets = [t.get_addr() for t in self.targets]
+                                        else:
+                                            # Target has been decided.
+                                            targets = [session.target_addr]
+
+                                        if self.multiply and session.sent is None and not self.no_reply:
+                                            session.sent = now
+                                            session.waiting = dict([(t, self.targets_by_addr[t]) for t in targets])
+
+                                        if pool:
+                                            if session.upstream is None:
+                                                session.upstream = pool.demux.pick(pool.sockets, session, targets)
+                                                if session.upstream is None:
+                                                    if self.verbose: print_warning('No free upstream socket for session: %s' % session)
+                                                    continue
+
+                                            upstream = session.upstream
+                                            for t in targets:
+                                                out = pool.demux.outbound(upstream, t, session, data, now)
+                                                if out is not None: pool.backlogs[upstream].append((out, t), now, session)
+                                            flush[upstream] = (pool.sockets[upstream], pool.backlogs[upstream])
+                                        else:
+                                            for t in targets: session.backlog.append((data, t), now, session)
+                                            flush[session.socket.fileno()] = (session.socket, session.backlog)
+
+                                        session.running = not self.no_reply
+
+                                    # A short batch means that the socket has been drained.
+                                    # Re-arming the socket will catch anything that arrived since.
+                                    if len(packets) < io.batch_size: break
 
                             except BlockingIOError: pass
 
                         if event & EPOLLOUT:
                             # The server is able to write after previously running into troubles.
+                            flush[fd] = (self.server_socket, backlog_server)
+                    elif pool and fd in pool.sockets:
+                        # Data from a target server, on a socket shared by many sessions.
+                        if event & EPOLLIN:
                             try:
-                                while backlog_server:
-                                    self.server_socket.sendto(backlog_server[0][0], backlog_server[0][1])
-                                    del backlog_server[0]
-                            # Error handling backlog from server to client
-                            except BlockingIOError: write_fds.add(fd)
+                                while True:
+                                    packets = io.recv(pool.sockets[fd])
+                                    for data, addr in packets:
+                                        session, data = pool.demux.inbound(fd, addr, data, now)
+                                        if session is None or session.closed: continue
+                                        session.time = now
+                                        reply(session, data, addr)
+
+                                    if len(packets) < io.batch_size: break
+
+                            except BlockingIOError: pass
+
+                        if event & EPOLLOUT:
+                            flush[fd] = (pool.sockets[fd], pool.backlogs[fd])
                     else:
                         # Data from a target server
                         session = sessions_by_fd.get(fd)
-                        session.time = time.time()
+                        session.time = now
 
                         if event & EPOLLIN:
                             try:
                                 while True:
-                                    data, addr = session.socket.recvfrom(10240)
-
-                                    if self.multiply and session.target_addr is None:
-                                        valid_sources = [t.get_addr() for t in self.targets]
-                                    else:
-                                        # Have received a response
-                                        valid_sources = [session.target_addr]
-
-                                    if addr not in valid_sources:
-                                        continue
+                                    packets = io.recv(session.socket)
+                                    for data, addr in packets: reply(session, data, addr)
 
-                                    if session.target_addr is None: session.target_addr = addr
-
-                                    try:
-                                        self.server_socket.sendto(data, session.addr)
-                                    except BlockingIOError:
-                                        # Error writing a reply from the relay to the client
-                                        backlog_server.append((data, session.addr))
-                                        write_fds.add(server_fd)
+                                    if len(packets) < io.batch_size: break
 
                             except BlockingIOError: pass
 
                         if event & EPOLLOUT:
-                            try:
-                                while session.backlog:
-                                    session.socket.sendto(session.backlog[0][0], session.backlog[0][1])
-                                    del session.backlog[0]
-                            # Error handling session backlog
-                            except BlockingIOError: write_fds.add(fd)
+                            flush[fd] = (session.socket, session.backlog)
 
                     # Re-arm socket
                     self.epoll_socket.modify(fd, self.FLAGS)
 
+                for fd, (sock, queue) in flush.items():
+                    try:
+                        queue.expire(now)
+                        while queue: queue.consume(io.send(sock, queue))
+                    # Error writing to a client or a target. Pick up where we left off once the socket is ready.
+                    except BlockingIOError: write_fds.add(fd)
+
                 # Cleanup
 
                 # Specifically arm anything that ran into a send error to also listen for EPOLLOUT
@@ -721,33 +1086,76 @@ class UdpRelayServer:
                         self.epoll_socket.modify(fd, self.FLAGS | EPOLLOUT)
                     else:
                         self.epoll_socket.register(fd, self.FLAGS | EPOLLOUT)
-
-                # Look for expired sessions and clean them up.
-                for session in [s for s in [sessions_by_fd[_fd] for _fd in sessions_by_fd.keys()] if s.is_closing()]:
-                    if self.verbose: print_notice('Closing session: %s' % session)
+                        active_sockets.add(fd)
+
+                # Clean up sessions that are due to expire.
+                while expiry and expiry[0][0] <= now:
+                    session = heapq.heappop(expiry)[2]
+                    # A backlog on a socket that has stalled will not be flushed, but can still age out.
+                    session.backlog.expire(now)
+                    if not session.is_closing(now):
+                        heapq.heappush(expiry, (session.get_expiry(now), next(sequence), session))
+                        continue
+
+                    if self.verbose:
+                        if any(session.dropped.values()): print_notice('Closing session: %s (Dropped datagrams: %s in, %s out)' % (session, colour_text(session.dropped['in']), colour_text(session.dropped['out'])))
+                        else: print_notice('Closing session: %s' % session)
                     del sessions_by_addr[session.addr]
+                    session.closed = True
+                    for target in session.waiting.values(): target.record_failure()
+
+                    if pool:
+                        # The upstream socket stays open for other sessions.
+                        if session.upstream is not None: pool.demux.release(session, [t.get_addr() for t in self.targets] if self.multiply else [session.target_addr])
+                        continue
+
                     del sessions_by_fd[session.socket.fileno()]
 
                     if session.socket.fileno() in active_sockets:
                         self.epoll_socket.unregister(session.socket.fileno())
-                        active_sockets.remove(session.socket.fileno())
+                        active_sockets.discard(session.socket.fileno())
 
                     session.socket.close()
 
         finally: self.shutdown()
         return 0
 
+    def run_stats(self, port):
+        server = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    content = server.get_stats_prometheus()
+                    content_type = 'text/plain; version=0.0.4'
+                else:
+                    content = json.dumps(server.get_stats(), indent=2)
+                    content_type = 'application/json'
+
+                content = content.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', len(content))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args): pass
+
+        HTTPServer((self.args[TITLE_STATS_BIND], port), StatsHandler).serve_forever()
+
     def shutdown(s):
         #for i in list(s.active_fds): s.(i)
         s.epoll_socket.close()
         s.server_socket.close()
+        if s.pool:
+            for sock in s.pool.sockets.values(): sock.close()
 
     def validate_access(self, args):
         a = self.access
         for i in args[TITLE_ALLOW]: a.add_whitelist(i)
         for i in args[TITLE_ALLOW_FILE]: a.load_whitelist_file(i)
         for i in args[TITLE_DENY]: a.add_blacklist(i)
-        for i in args[TITLE_DENY_FILE]: a.load_whitelist_file(i)
+        for i in args[TITLE_DENY_FILE]: a.load_blacklist_file(i)
         return a.errors
 
     def validate_common_arguments(self, args):
@@ -759,6 +1167,47 @@ class UdpRelayServer:
         self.port, port_error = self.resolve_port(args[TITLE_PORT], 'Bind port')
         if port_error: errors.append(port_error)
 
+        self.idle_timeout = args[TITLE_IDLE_TIMEOUT]
+        if self.idle_timeout is not None and self.idle_timeout <= 0:
+            errors.append('Idle timeout must be a positive number of seconds. Given: %s' % colour_text(self.idle_timeout))
+
+        self.upstream_sockets = args[TITLE_UPSTREAM_SOCKETS]
+        if self.upstream_sockets is not None and self.upstream_sockets < 0:
+            errors.append('Number of upstream sockets cannot be negative. Given: %s' % colour_text(self.upstream_sockets))
+        self.demux = args[TITLE_DEMUX]
+        if self.demux not in [DEMUX_PORT, DEMUX_DNS]:
+            errors.append('Unknown demux method: %s (Options: %s, %s)' % (colour_text(self.demux), colour_text(DEMUX_PORT), colour_text(DEMUX_DNS)))
+
+        self.backlog_size = args[TITLE_BACKLOG_SIZE]
+        if self.backlog_size is not None and self.backlog_size < 1:
+            errors.append('Backlog size must be at least 1. Given: %s' % colour_text(self.backlog_size))
+        self.drop_policy = args[TITLE_DROP_POLICY]
+        if self.drop_policy not in [DROP_NEWEST, DROP_OLDEST, DROP_AGE]:
+            errors.append('Unknown drop policy: %s (Options: %s, %s, %s)' % (colour_text(self.drop_policy), colour_text(DROP_NEWEST), colour_text(DROP_OLDEST), colour_text(DROP_AGE)))
+        self.backlog_max_age = args[TITLE_BACKLOG_MAX_AGE]
+        if self.backlog_max_age is not None and self.backlog_max_age <= 0:
+            errors.append('Backlog age limit must be a positive number of seconds. Given: %s' % colour_text(self.backlog_max_age))
+
+        self.workers = args[TITLE_WORKERS]
+        if self.workers is not None:
+            if self.workers < 1:
+                errors.append('Must have at least one worker. Given: %s' % colour_text(self.workers))
+            elif self.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+                errors.append('Multiple workers require SO_REUSEPORT, which is not available on this system.')
+
+        self.stats_port, port_error = self.resolve_port(args[TITLE_STATS_PORT], 'Statistics port')
+        if port_error: errors.append(port_error)
+        elif self.stats_port and self.workers and self.stats_port + self.workers - 1 > 65535:
+            errors.append('Not enough ports above %s for each worker to serve statistics.' % colour_text(self.stats_port))
+
+        self.race_fraction = args[TITLE_RACE_FRACTION]
+        if self.race_fraction is not None and not 0 <= self.race_fraction <= 1:
+            errors.append('Race fraction must be from 0 to 1. Given: %s' % colour_text(self.race_fraction))
+
+        self.batch_size = args[TITLE_BATCH_SIZE]
+        if self.batch_size is not None and self.batch_size < 1:
+            errors.append('Batch size must be at least 1. Given: %s' % colour_text(self.batch_size))
+
         for target_items in [t.split(':') for t in self.args.operands]:
 
             target_ip, target_addr, target_err = self.resolve_target_address(target_items[0])
@@ -781,6 +1230,8 @@ class UdpRelayServer:
             # On account of the errors, this instance of the script won't survive past argument handling.
             self.targets.append(UdpRelayTarget(target_ip, target_port, target_addr))
 
+        self.targets_by_addr = dict([(t.get_addr(), t) for t in self.targets])
+
         if not self.targets: errors.append('No relay target specified.')
         else:
 
@@ -800,20 +1251,66 @@ class UdpRelayServer:
     def validate_version(self, args):
         if sys.version_info.major == 2: return 'This script currently only supports Python 3.'
 
+def attach_reuseport_hash(sock, workers):
+    # Have the kernel pick a worker's socket by hashing the client's address and port, with a classic BPF
+    #  program attached to the SO_REUSEPORT group. The index that it returns is the order in which the sockets were bound.
+    # The same client goes to the same worker from one run of the relay to the next, where the kernel's own hash
+    #  is only stable until reboot. Falls back on the kernel's hash if the program cannot be attached.
+    #
+    # Equivalent to:
+    #   h = ((ip ^ port) * 2654435761) % 2**32
+    #   worker = (h ^ (h >> 16)) % workers
+    import ctypes
+    net = 0xfff00000 # SKF_NET_OFF: Offsets relative to the IP header, rather than the UDP payload.
+    program = [
+        (0xb1, 0, 0, net),          # ldxb 4*([net]&0xf)    X = IP header length
+        (0x48, 0, 0, net),          # ldh [x + net]         A = source port
+        (0x07, 0, 0, 0),            # tax
+        (0x20, 0, 0, net + 12),     # ld [net + 12]         A = source address
+        (0xac, 0, 0, 0),            # xor x
+        (0x24, 0, 0, 2654435761),   # mul #2654435761
+        (0x07, 0, 0, 0),            # tax
+        (0x74, 0, 0, 16),           # rsh #16
+        (0xac, 0, 0, 0),            # xor x
+        (0x94, 0, 0, workers),      # mod #workers
+        (0x16, 0, 0, 0)             # ret a
+    ]
+
+    instructions = ctypes.create_string_buffer(b''.join([struct.pack('HBBI', *i) for i in program]))
+    fprog = struct.pack('HP', len(program), ctypes.addressof(instructions))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51), fprog)
+        return True
+    except OSError as e:
+        print_warning('Unable to hash clients to workers by address, leaving it to the kernel: %s' % e)
+        return False
+
 class UdpRelaySession:
 
     def __init__(s, srv, addr):
         s.running = True
 
         s.addr = addr
-        if srv.multiply:
-            s.target = s.target_addr = None
-        else:
-            s.target = srv.get_target()
-            s.target_addr = s.target.get_addr()
-
-        s.socket = srv.new_socket()
-        s.backlog = []
+        if srv.multiply: s.target = srv.get_quickest_target()
+        else: s.target = srv.get_target()
+        # Without a target address, datagrams go to all targets until one of them replies.
+        s.target_addr = s.target.get_addr() if s.target else None
+
+        # Time of the first datagram, and the targets that have yet to reply to it (multiply mode only)
+        s.sent = None
+        s.waiting = {}
+
+        # With shared upstream sockets, the session is handed one of them once it has been accepted.
+        s.socket = None
+        s.upstream = None
+        if not srv.upstream_sockets: s.socket = srv.new_socket()
+        s.backlog = UdpRelayBacklog(srv, 'in')
+        s.closed = False
+        s.timeout = srv.idle_timeout
+        s.started = time.time()
+
+        # Datagrams dropped from backlogs ('in': client to target, 'out': target to client)
+        s.dropped = {'in': 0, 'out': 0}
 
     def __str__(s):
 
@@ -822,17 +1319,319 @@ class UdpRelaySession:
 
         return '%s->%s' % (colour_addr(s.addr[0], s.addr[1]), ts)
 
-    def is_closing(s):
-        return not s.backlog and (not s.running or time.time() - s.time > 60)
+    def get_expiry(s, now):
+        # Next time to check on a session that is not closing yet.
+        if s.backlog: return now + 1 # Wait on the backlog to be sent.
+        return s.time + s.timeout
+
+    def get_stats(s, now):
+        return {
+            'client': '%s:%d' % s.addr,
+            'target': '%s:%d' % s.target_addr if s.target_addr else None,
+            'age': now - s.started,
+            'backlog': len(s.backlog),
+            'dropped': dict(s.dropped)
+        }
+
+    def is_closing(s, now):
+        return not s.backlog and (not s.running or now - s.time >= s.timeout)
+
+class UdpRelayBacklog(object):
+    # Datagrams waiting on a socket to be ready to send them, as (data, address) tuples.
+    # Holds at most --backlog-size datagrams. Past that, datagrams are dropped according to
+    #  the drop policy and counted against the session that they belong to.
+    # Indexing and len() work as on a list, which is all that UdpRelayIO.send() asks for.
+
+    def __init__(s, srv, direction):
+        s.srv = srv
+        s.direction = direction
+        s.size = srv.backlog_size
+        s.policy = srv.drop_policy
+        s.max_age = srv.backlog_max_age
+        s.items = collections.deque()
+        s.queued = collections.deque() # (time queued, session) for each item
+
+    def __getitem__(s, index): return s.items[index]
+
+    def __len__(s): return len(s.items)
+
+    def append(s, item, now, session):
+        if len(s.items) >= s.size:
+            if s.policy == DROP_NEWEST: return s.drop(session)
+            s.expire(now)
+            if len(s.items) >= s.size: s.drop(s.pop())
+
+        s.items.append(item)
+        s.queued.append((now, session))
+
+    def consume(s, count):
+        # Remove datagrams that have been sent.
+        for i in range(count): s.pop()
+
+    def drop(s, session):
+        s.srv.dropped[s.direction] += 1
+        session.dropped[s.direction] += 1
+
+    def expire(s, now):
+        if s.policy != DROP_AGE: return
+        while s.queued and now - s.queued[0][0] >= s.max_age: s.drop(s.pop())
+
+    def pop(s):
+        # Remove the longest-waiting datagram, returning the session that it belonged to.
+        s.items.popleft()
+        return s.queued.popleft()[1]
+
+class UdpRelayUpstreamPool(object):
+    # Sockets shared between all clients for talking to targets, so that the relay does not have to
+    #  open a socket (and an ephemeral port) for each client. A demux object keeps track of
+    #  which client is waiting on which reply, much like the table kept by a NAT.
+
+    def __init__(s, srv, sockets, demux):
+        s.sockets = dict([(sock.fileno(), sock) for sock in sockets])
+        s.backlogs = dict([(fd, UdpRelayBacklog(srv, 'in')) for fd in s.sockets])
+        s.demux = demux
+
+class UdpRelayDemux(object):
+    # Replies are told apart only by the upstream socket that they arrive on, and the target that they come from.
+    # Without knowing anything about the protocol, a socket can carry only one client to a given target at a time.
+
+    def __init__(s):
+        s.flows = {} # (upstream fd, target address): session
+
+    def inbound(s, fd, source, data, now):
+        # Returns (session, data) for a reply, with the session being None if the reply has nowhere to go.
+        return s.flows.get((fd, source)), data
+
+    def outbound(s, fd, target, session, data, now):
+        # Returns data to send to the target, or None if it cannot be sent.
+        s.flows[(fd, target)] = session
+        return data
+
+    def pick(s, sockets, session, targets):
+        # Choose an upstream socket for a new session, or return None if none are free.
+        for fd in sockets:
+            if all(s.is_free(fd, t, session) for t in targets): return fd
+        return None
+
+    def is_free(s, fd, target, session):
+        flow = s.flows.get((fd, target))
+        return flow is None or flow is session or flow.closed
+
+    def release(s, session, targets):
+        for t in targets:
+            key = (session.upstream, t)
+            if s.flows.get(key) is session: del s.flows[key]
+
+class UdpRelayDnsDemux(UdpRelayDemux):
+    # Clients are told apart by the DNS transaction ID at the start of each message.
+    # Each query is given a new ID that is unique to its upstream socket and target, and the
+    #  client's own ID is put back on the reply. Any number of clients can share a socket.
+    # IDs are random, since a shared socket no longer has a random source port to make replies hard to spoof.
+
+    # Attempts at finding an unused ID before giving up on a query
+    ID_ATTEMPTS = 8
+
+    def __init__(s, timeout):
+        s.timeout = timeout
+        s.queries = {} # (upstream fd, target address, ID): (session, client ID, time sent)
+        s.pruned = time.time()
+        s.random = random.SystemRandom()
+
+    def inbound(s, fd, source, data, now):
+        query = s.queries.pop((fd, source, data[:2]), None)
+        if not query: return None, data
+        return query[0], query[1] + data[2:]
+
+    def outbound(s, fd, target, session, data, now):
+        if len(data) < 12: return None # Too short to be a DNS message.
+
+        if now - s.pruned >= s.timeout:
+            # Forget queries that were never answered.
+            s.pruned = now
+            for key in [k for k, q in s.queries.items() if now - q[2] >= s.timeout]: del s.queries[key]
+
+        for i in range(s.ID_ATTEMPTS):
+            query_id = struct.pack('!H', s.random.getrandbits(16))
+            key = (fd, target, query_id)
+            query = s.queries.get(key)
+            if not query or now - query[2] >= s.timeout: break
+        else: return None
+
+        s.queries[key] = (session, data[:2], now)
+        return query_id + data[2:]
+
+    def pick(s, sockets, session, targets):
+        # Any socket will do. Spread clients across them.
+        return list(sockets)[hash(session.addr) % len(sockets)]
+
+    # Queries from a closed session are left to be answered (and ignored) or to expire.
+    def release(s, session, targets): pass
+
+class UdpRelayIO(object):
+    # One datagram per system call, with recvfrom(2) and sendto(2).
+    # UdpRelayBatchIO has the same interface.
+
+    batch_size = 1
+
+    def __init__(s, buffer_size):
+        s.buffer_size = buffer_size
+
+    def recv(s, sock):
+        # Returns a list of (data, address) tuples, or raises BlockingIOError if there is nothing to read.
+        return [sock.recvfrom(s.buffer_size)]
+
+    def send(s, sock, items):
+        # Send from a list (or backlog) of (data, address) tuples. Returns how many were sent,
+        #  or raises BlockingIOError if none of them could be.
+        sock.sendto(*items[0])
+        return 1
+
+class UdpRelayBatchIO(UdpRelayIO):
+    # Many datagrams per system call, with recvmmsg(2) and sendmmsg(2) called through ctypes.
+    # Buffers and message headers are allocated once, up front, and reused for every call.
+    # Going through ctypes for each field is slow enough to undo the savings, so the per-datagram
+    #  work is done on memoryviews of the same memory instead.
+    # Only handles AF_INET sockets, which are the only kind that the relay opens.
+
+    SOCKADDR_SIZE = 16 # sizeof(struct sockaddr_in)
+
+    def __init__(s, batch_size, buffer_size):
+        import ctypes, ctypes.util # Raises ImportError if ctypes is not available.
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        s.recvmmsg = libc.recvmmsg # Raises AttributeError outside of Linux.
+        s.sendmmsg = libc.sendmmsg
+        s.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        s.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        s.get_errno = ctypes.get_errno
+
+        class IoVec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+        class MsgHdr(ctypes.Structure):
+            _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32), ('msg_iov', ctypes.c_void_p), ('msg_iovlen', ctypes.c_size_t),
+                        ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t), ('msg_flags', ctypes.c_int)]
+
+        class MMsgHdr(ctypes.Structure):
+            _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+        s.batch_size = batch_size
+        s.buffer_size = buffer_size
+        name_size = s.SOCKADDR_SIZE
+
+        # Datagrams sit back-to-back in one buffer for each direction, as do their addresses.
+        s.recv_buffer = ctypes.create_string_buffer(batch_size * buffer_size)
+        s.recv_names = ctypes.create_string_buffer(batch_size * name_size)
+        s.recv_iov = (IoVec * batch_size)()
+        s.recv_msgs = (MMsgHdr * batch_size)()
+
+        s.send_buffer = ctypes.create_string_buffer(batch_size * buffer_size)
+        s.send_names = ctypes.create_string_buffer(batch_size * name_size)
+        s.send_iov = (IoVec * batch_size)()
+        s.send_msgs = (MMsgHdr * batch_size)()
+
+        for buffer, names, iov, msgs in [(s.recv_buffer, s.recv_names, s.recv_iov, s.recv_msgs), (s.send_buffer, s.send_names, s.send_iov, s.send_msgs)]:
+            for i in range(batch_size):
+                iov[i].iov_base = ctypes.addressof(buffer) + i * buffer_size
+                iov[i].iov_len = buffer_size
+                hdr = msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(names) + i * name_size
+                hdr.msg_namelen = name_size
+                hdr.msg_iov = ctypes.addressof(iov[i])
+                hdr.msg_iovlen = 1
+
+        s.recv_view = memoryview(s.recv_buffer).cast('B')
+        s.recv_names_view = memoryview(s.recv_names).cast('B')
+        s.recv_msgs_view = memoryview(s.recv_msgs).cast('B')
+        s.send_view = memoryview(s.send_buffer).cast('B')
+        s.send_names_view = memoryview(s.send_names).cast('B')
+        s.send_iov_view = memoryview(s.send_iov).cast('B')
+
+        # Offsets of the fields that change with each datagram
+        s.msg_len_offset = MMsgHdr.msg_len.offset
+        s.msg_size = ctypes.sizeof(MMsgHdr)
+        s.iov_len_offset = IoVec.iov_len.offset
+        s.iov_size = ctypes.sizeof(IoVec)
+
+        # Converting between address tuples and sockaddr_in structures is a large part of the cost
+        #  of each datagram, and the same few addresses come up over and over.
+        s.addresses = {}
+        s.names = {}
+
+    def get_error(s):
+        # OSError picks the matching subclass (such as BlockingIOError) for the error number.
+        error = s.get_errno()
+        return OSError(error, os.strerror(error))
+
+    def recv(s, sock):
+        count = s.recvmmsg(sock.fileno(), s.recv_msgs, s.batch_size, 0, None)
+        if count < 0: raise s.get_error()
+
+        if len(s.addresses) > 65536: s.addresses.clear()
+        names = s.recv_names_view
+        packets = []
+        for i in range(count):
+            offset = i * s.SOCKADDR_SIZE
+            name = names[offset + 2:offset + 8].tobytes() # Port and address
+            addr = s.addresses.get(name)
+            if not addr: addr = s.addresses[name] = (socket.inet_ntoa(name[2:]), struct.unpack('!H', name[:2])[0])
+
+            start = i * s.buffer_size
+            length = struct.unpack_from('I', s.recv_msgs_view, i * s.msg_size + s.msg_len_offset)[0]
+            packets.append((s.recv_view[start:start + length].tobytes(), addr))
+        return packets
+
+    def send(s, sock, items):
+        count = min(len(items), s.batch_size)
+
+        if len(s.names) > 65536: s.names.clear()
+        for i in range(count):
+            data, addr = items[i]
+            name = s.names.get(addr)
+            if not name: name = s.names[addr] = struct.pack('=H', socket.AF_INET) + struct.pack('!H', addr[1]) + socket.inet_aton(addr[0]) + bytes(8)
+
+            start = i * s.buffer_size
+            s.send_view[start:start + len(data)] = data
+            struct.pack_into('N', s.send_iov_view, i * s.iov_size + s.iov_len_offset, len(data))
+            s.send_names_view[i * s.SOCKADDR_SIZE:(i + 1) * s.SOCKADDR_SIZE] = name
+
+        sent = s.sendmmsg(sock.fileno(), s.send_msgs, count, 0)
+        if sent < 0: raise s.get_error()
+        return sent
 
 class UdpRelayTarget(object):
+
+    # Weight of each new sample in the moving average of reply latency
+    LATENCY_WEIGHT = 0.2
+    # Sessions in a row that a target can fail to reply to before it is passed over.
+    # Racing sessions still go to the target, and it is back in rotation as soon as it replies to one of them.
+    MAX_FAILURES = 3
+
     def __init__(s, t_ip, t_port, t_host):
         s.ip = t_ip
         s.port = t_port
         s.hostname = t_host
+        s.latency = None
+        s.failures = 0
     __str__ = lambda s: colour_addr(s.ip, s.port, s.hostname)
     get_addr = lambda s: (s.ip, s.port)
 
+    def get_stats(s):
+        return {
+            'address': '%s:%d' % (s.ip, s.port),
+            'latency': s.latency,
+            'failures': s.failures,
+            'healthy': s.is_healthy()
+        }
+
+    def is_healthy(s): return s.failures < s.MAX_FAILURES
+
+    def record_failure(s): s.failures += 1
+
+    def record_reply(s, latency):
+        s.failures = 0
+        if s.latency is None: s.latency = latency
+        else: s.latency += s.LATENCY_WEIGHT * (latency - s.latency)
+
 # Run
 if __name__ == '__main__':
     try: exit(UdpRelayServer().run())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Measure verbose_share response sizes and times with and without compression.
+# A temporary directory is shared holding a directory with many files (for a large listing page)
+#  and a text file, and the server itself is run as a subprocess.
+#
+# Usage: ./http_compress_benchmark.py [--modes identity,gzip,gzip-nocache] [--entries 20000] [--requests 10]
+
+from __future__ import print_function
+import argparse, gzip, http.client, os, shutil, socket, subprocess, sys, tempfile, time
+
+SERVER = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'networking', 'http-servers', 'verbose_share.py'))
+
+# Mode: (Accept-Encoding header, server arguments)
+MODES = {
+    'identity': ('identity', []),
+    'gzip': ('gzip', []),
+    'gzip-nocache': ('gzip', ['--compress-cache', '0'])
+}
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout = 10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return True
+        except socket.error: time.sleep(0.1)
+    return False
+
+def fetch(port, path, encoding, requests):
+    # Make requests over one keep-alive connection. Returns the size on the wire, the decoded size, and the mean time.
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    elapsed = 0
+    for i in range(requests):
+        start = time.time()
+        conn.request('GET', path, headers={'Accept-Encoding': encoding})
+        response = conn.getresponse()
+        body = response.read()
+        elapsed += time.time() - start
+    conn.close()
+
+    wire = len(body)
+    if response.getheader('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return wire, len(body), elapsed / requests
+
+def main():
+    parser = argparse.ArgumentParser(description='verbose_share compression benchmark')
+    parser.add_argument('--modes', default='identity,gzip,gzip-nocache', help='Comma-separated modes to compare (%s).' % ', '.join(sorted(MODES)))
+    parser.add_argument('--entries', type=int, default=20000, help='Number of files in the listed directory.')
+    parser.add_argument('--text-size', type=int, default=10, help='Size in megabytes of the text file.')
+    parser.add_argument('--requests', type=int, default=10, help='Number of times to request each page.')
+    parser.add_argument('--server-args', default='', help='Additional arguments for the server.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        os.mkdir(os.path.join(directory, 'listing'))
+        for i in range(args.entries):
+            open(os.path.join(directory, 'listing', 'file-%06d.txt' % i), 'w').close()
+        with open(os.path.join(directory, 'file.txt'), 'w') as f:
+            line = 'The quick brown fox jumps over the lazy dog. %d\n'
+            for i in range(args.text_size * 1000000 // len(line)): f.write(line % (i % 10))
+
+        for mode in args.modes.split(','):
+            encoding, server_args = MODES[mode]
+            port = free_port()
+            cmd = [sys.executable, SERVER, '-b', '127.0.0.1', '-p', str(port)] + server_args + args.server_args.split()
+
+            server = subprocess.Popen(cmd, cwd=directory, stdout=subprocess.DEVNULL)
+            try:
+                if not wait_for_port(port):
+                    print('Server in %s mode did not start.' % mode)
+                    continue
+                for label, path in [('listing', '/listing/'), ('text', '/file.txt')]:
+                    results.append((mode, label) + fetch(port, path, encoding, args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(directory)
+
+    print('%-14s %-8s %12s %12s %10s' % ('Mode', 'Page', 'Wire bytes', 'Bytes', 'ms/req'))
+    for mode, label, wire, size, elapsed in results:
+        print('%-14s %-8s %12d %12d %10.1f' % (mode, label, wire, size, elapsed * 1000))
+
+if __name__ == '__main__':
+    main()
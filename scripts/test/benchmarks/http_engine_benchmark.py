@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# Compare CoreHttpServer engines for concurrent-connection capacity and request latency.
+# verbose_share is run as a subprocess, sharing a temporary directory that holds one small file.
+#
+# First, a crowd of clients each make one request and then hold their keep-alive connection open.
+# This counts how many of them were answered, turned away (503), or left waiting.
+# Then, with the crowd still connected, a few active clients make requests back to back,
+#  and the latency percentiles of their requests are reported.
+#
+# Usage: ./http_engine_benchmark.py [--engines threads,selector] [--idle 1000] [--window 64] [--clients 8] [--duration 5] [--threads 32]
+
+from __future__ import print_function
+import argparse, http.client, os, resource, selectors, shutil, socket, subprocess, sys, tempfile, threading, time
+
+SERVER = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'networking', 'http-servers', 'verbose_share.py'))
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout = 10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return True
+        except socket.error: time.sleep(0.1)
+    return False
+
+def percentile(values, p):
+    if not values: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def crowd(port, count, window, timeout):
+    # Open 'count' connections and send one request on each, and sort them by how (or if) they were answered.
+    # At most 'window' connections are left waiting for an answer at a time, so that this measures
+    #  how many connections the server can hold rather than how it copes with a burst.
+    # Returns the counts along with the sockets, which are to be held open.
+    request = b'GET /file.bin HTTP/1.1\r\nHost: localhost\r\n\r\n'
+    selector = selectors.DefaultSelector()
+    socks = []
+    results = {'answered': 0, 'rejected': 0, 'waiting': 0, 'failed': 0}
+
+    opened = 0
+    outstanding = 0
+    end = time.time() + timeout
+    while time.time() < end and (opened < count or outstanding):
+        while opened < count and outstanding < window:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(False)
+            s.connect_ex(('127.0.0.1', port))
+            selector.register(s, selectors.EVENT_WRITE, [b''])
+            socks.append(s)
+            opened += 1
+            outstanding += 1
+
+        for key, mask in selector.select(max(0, min(1, end - time.time()))):
+            s = key.fileobj
+            if mask & selectors.EVENT_WRITE:
+                # Connected (or failed to).
+                try:
+                    s.send(request)
+                    selector.modify(s, selectors.EVENT_READ, key.data)
+                except socket.error:
+                    results['failed'] += 1
+                    selector.unregister(s)
+                    outstanding -= 1
+                continue
+
+            try:
+                data = s.recv(65536)
+            except socket.error:
+                data = b''
+            key.data[0] += data
+            if data and b'\r\n' not in key.data[0]: continue
+
+            status = key.data[0].split(b' ', 2)[1:2]
+            if status == [b'200']: results['answered'] += 1
+            elif status == [b'503']: results['rejected'] += 1
+            else: results['failed'] += 1
+            selector.unregister(s)
+            outstanding -= 1
+            if time.time() < end and opened < count:
+                # Making progress, so give the rest of the crowd time to get through.
+                end = max(end, time.time() + 1)
+
+    results['waiting'] = outstanding + count - opened
+    return results, socks
+
+def active(port, clients, duration):
+    # Each client makes requests back to back over a keep-alive connection, reconnecting whenever it has to.
+    latencies = []
+    errors = [0]
+    end = time.time() + duration
+
+    def work():
+        conn = None
+        while time.time() < end:
+            start = time.time()
+            try:
+                if not conn:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/file.bin')
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+                    conn.close()
+                    conn = None
+                    continue
+                latencies.append(time.time() - start)
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (socket.error, http.client.HTTPException):
+                errors[0] += 1
+                if conn: conn.close()
+                conn = None
+        if conn: conn.close()
+
+    threads = [threading.Thread(target=work) for i in range(clients)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return latencies, errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description='CoreHttpServer engine capacity and latency benchmark')
+    parser.add_argument('--engines', default='threads,selector', help='Comma-separated engines to compare.')
+    parser.add_argument('--idle', type=int, default=1000, help='Number of keep-alive connections to hold open.')
+    parser.add_argument('--window', type=int, default=64, help='Connections in the crowd that may be waiting for an answer at a time.')
+    parser.add_argument('--clients', type=int, default=8, help='Number of active clients.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run the active clients for.')
+    parser.add_argument('--threads', type=int, default=32, help='Server worker threads.')
+    parser.add_argument('--size', type=int, default=10000, help='Size in bytes of the file to request.')
+    parser.add_argument('--timeout', type=float, default=5, help='Seconds to wait for the crowd of connections to be answered.')
+    parser.add_argument('--server-args', default='', help='Additional arguments for the server.')
+    args = parser.parse_args()
+
+    # Each held connection is a descriptor on both sides.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, args.idle * 2 + 256))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        with open(os.path.join(directory, 'file.bin'), 'wb') as f:
+            f.write(os.urandom(args.size))
+
+        for engine in args.engines.split(','):
+            port = free_port()
+            # Keep idle connections around for the whole test.
+            cmd = [sys.executable, SERVER, '-b', '127.0.0.1', '-p', str(port), '--engine', engine, '--threads', str(args.threads), '--keep-alive-timeout', '600', '--keep-alive-requests', '0'] + args.server_args.split()
+
+            server = subprocess.Popen(cmd, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            socks = []
+            try:
+                if not wait_for_port(port):
+                    print('Server with the %s engine did not start.' % engine)
+                    continue
+                held, socks = crowd(port, args.idle, args.window, args.timeout)
+                latencies, errors = active(port, args.clients, args.duration)
+            finally:
+                for s in socks: s.close()
+                server.terminate()
+                server.wait()
+
+            results.append((engine, held, len(latencies) / args.duration, errors, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+    print('%-10s %9s %9s %9s %10s %8s %9s %9s' % ('Engine', 'Answered', 'Rejected', 'Waiting', 'Req/s', 'Errors', 'p50 ms', 'p99 ms'))
+    for engine, held, rps, errors, p50, p99 in results:
+        print('%-10s %9d %9d %9d %10.1f %8d %9.2f %9.2f' % (engine, held['answered'], held['rejected'], held['waiting'] + held['failed'], rps, errors, p50, p99))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Measure verbose_share file download throughput with and without sendfile(2).
+# A temporary directory holding one file is shared, and the server itself is run as a subprocess.
+# The server's own CPU time per megabyte is reported as well, since on a machine with few cores
+#  the clients will compete with the server and hold down the overall rate.
+#
+# Usage: ./http_share_benchmark.py [--modes sendfile,buffered] [--size 200] [--requests 10] [--concurrency 2] [--range] [--ssl-cert cert.pem]
+
+from __future__ import print_function
+import argparse, os, shutil, socket, ssl, subprocess, sys, tempfile, threading, time
+
+SERVER = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'networking', 'http-servers', 'verbose_share.py'))
+
+MODES = {
+    'sendfile': [],
+    'buffered': ['--no-sendfile']
+}
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout = 10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return True
+        except socket.error: time.sleep(0.1)
+    return False
+
+class Client:
+    def __init__(self, port, cert):
+        self.port = port
+        self.ctx = None
+        if cert:
+            self.ctx = ssl.create_default_context()
+            self.ctx.check_hostname = False
+            self.ctx.verify_mode = ssl.CERT_NONE
+
+    def download(self, path, headers = ''):
+        # One request per connection, read until the server closes it. Returns the body length.
+        c = socket.create_connection(('127.0.0.1', self.port))
+        if self.ctx: c = self.ctx.wrap_socket(c)
+        c.sendall(('GET %s HTTP/1.0\r\n%s\r\n' % (path, headers)).encode())
+
+        received = 0
+        header = b''
+        while True:
+            data = c.recv(1 << 20)
+            if not data: break
+            if header is not None:
+                header += data
+                if b'\r\n\r\n' not in header: continue
+                header, data = header.split(b'\r\n\r\n', 1)
+                header = None
+            received += len(data)
+        c.close()
+        return received
+
+    def throughput(self, path, requests, concurrency, headers = ''):
+        counts = [0] * concurrency
+
+        def work(i):
+            for r in range(i, requests, concurrency):
+                counts[i] += self.download(path, headers)
+
+        start = time.time()
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return sum(counts), time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='verbose_share download throughput benchmark')
+    parser.add_argument('--modes', default='sendfile,buffered', help='Comma-separated modes to compare (%s).' % ', '.join(sorted(MODES)))
+    parser.add_argument('--size', type=int, default=200, help='Size in megabytes of the file to download.')
+    parser.add_argument('--requests', type=int, default=10, help='Number of times to download the file.')
+    parser.add_argument('--concurrency', type=int, default=2, help='Number of concurrent clients.')
+    parser.add_argument('--range', action='store_true', help='Request the second half of the file with a Range header rather than the whole file.')
+    parser.add_argument('--ssl-cert', help='Have the server SSL-encrypt connections with this certificate (PEM, including key).')
+    parser.add_argument('--server-args', default='', help='Additional arguments for the server.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        with open(os.path.join(directory, 'file.bin'), 'wb') as f:
+            chunk = os.urandom(1000000)
+            for i in range(args.size): f.write(chunk)
+
+        headers = ''
+        if args.range:
+            headers = 'Range: bytes=%d-\r\n' % (args.size * 1000000 // 2)
+
+        for mode in args.modes.split(','):
+            port = free_port()
+            cmd = [sys.executable, SERVER, '-b', '127.0.0.1', '-p', str(port)] + MODES[mode] + args.server_args.split()
+            if args.ssl_cert: cmd += ['-c', args.ssl_cert]
+
+            server = subprocess.Popen(cmd, cwd=directory, stdout=subprocess.DEVNULL)
+            received = 0
+            try:
+                if not wait_for_port(port):
+                    print('Server in %s mode did not start.' % mode)
+                    continue
+                client = Client(port, args.ssl_cert)
+                received, elapsed = client.throughput('/file.bin', args.requests, args.concurrency, headers)
+            finally:
+                server.terminate()
+                pid, server.returncode, usage = os.wait4(server.pid, 0)
+
+            if received:
+                cpu = (usage.ru_utime + usage.ru_stime) / (received / 1e6) * 1e3
+                results.append((mode, received / elapsed / 1e6, cpu))
+    finally:
+        shutil.rmtree(directory)
+
+    print('%-10s %10s %20s' % ('Mode', 'MB/s', 'Server CPU ms/MB'))
+    for mode, mbps, cpu in results: print('%-10s %10.1f %20.3f' % (mode, mbps, cpu))
+
+if __name__ == '__main__':
+    main()
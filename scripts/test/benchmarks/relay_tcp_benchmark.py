@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Compare relay_tcp engines for connections per second and throughput.
+# A local echo server is used as the relay target, and the relay itself is run as a subprocess.
+#
+# Usage: ./relay_tcp_benchmark.py [--engines epoll,asyncio] [--duration 5] [--size 200] [--concurrency 8] [--ssl-cert cert.pem]
+
+from __future__ import print_function
+import argparse, multiprocessing, os, socket, ssl, subprocess, sys, threading, time
+
+RELAY = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'networking', 'relay_tcp.py'))
+
+def echo_server(port):
+    def handle(c):
+        try:
+            while True:
+                data = c.recv(65536)
+                if not data: break
+                c.sendall(data)
+        except socket.error: pass
+        c.close()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('127.0.0.1', port))
+    s.listen(128)
+    while True:
+        c, addr = s.accept()
+        t = threading.Thread(target=handle, args=(c,))
+        t.daemon = True
+        t.start()
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout = 10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return True
+        except socket.error: time.sleep(0.1)
+    return False
+
+class Client:
+    def __init__(self, port, cert):
+        self.port = port
+        self.ctx = None
+        if cert:
+            self.ctx = ssl.create_default_context()
+            self.ctx.check_hostname = False
+            self.ctx.verify_mode = ssl.CERT_NONE
+
+    def connect(self):
+        c = socket.create_connection(('127.0.0.1', self.port))
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ctx: c = self.ctx.wrap_socket(c)
+        return c
+
+    def connections_per_second(self, duration, concurrency):
+        # Open a connection, make one round trip through the relay, and close it. Repeat.
+        counts = [0] * concurrency
+        end = time.time() + duration
+
+        def work(i):
+            while time.time() < end:
+                c = self.connect()
+                c.sendall(b'ping')
+                c.recv(4)
+                c.close()
+                counts[i] += 1
+
+        self.run_threads(work, concurrency)
+        return sum(counts) / duration
+
+    def throughput(self, size, concurrency):
+        # Push 'size' bytes through the relay split across 'concurrency' connections, and read the echo back.
+        per_connection = size // concurrency
+        chunk = os.urandom(65536)
+
+        def work(i):
+            c = self.connect()
+
+            def reader():
+                remaining = per_connection
+                while remaining > 0:
+                    data = c.recv(1 << 20)
+                    if not data: break
+                    remaining -= len(data)
+            t = threading.Thread(target=reader)
+            t.start()
+
+            sent = 0
+            while sent < per_connection:
+                view = chunk[:per_connection - sent]
+                c.sendall(view)
+                sent += len(view)
+            t.join()
+            c.close()
+
+        start = time.time()
+        self.run_threads(work, concurrency)
+        return per_connection * concurrency / (time.time() - start) / 1e6
+
+    def run_threads(self, fn, count):
+        threads = [threading.Thread(target=fn, args=(i,)) for i in range(count)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='relay_tcp engine benchmark')
+    parser.add_argument('--engines', default='epoll,asyncio', help='Comma-separated engines to compare.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run the connection rate test for.')
+    parser.add_argument('--size', type=int, default=200, help='Megabytes to push through the relay for the throughput test.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients.')
+    parser.add_argument('--ssl-cert', help='Have the relay SSL-encrypt client connections with this certificate (PEM, including key).')
+    parser.add_argument('--relay-args', default='', help='Additional arguments for the relay.')
+    args = parser.parse_args()
+
+    target_port = free_port()
+    target = multiprocessing.Process(target=echo_server, args=(target_port,))
+    target.daemon = True
+    target.start()
+    wait_for_port(target_port)
+
+    results = []
+    for engine in args.engines.split(','):
+        port = free_port()
+        cmd = [sys.executable, RELAY, '-b', '127.0.0.1', '-p', str(port), '--engine', engine] + args.relay_args.split()
+        if args.ssl_cert: cmd += ['-c', args.ssl_cert]
+        cmd.append('127.0.0.1:%d' % target_port)
+
+        relay = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        try:
+            if not wait_for_port(port):
+                print('Relay with the %s engine did not start.' % engine)
+                continue
+            client = Client(port, args.ssl_cert)
+            cps = client.connections_per_second(args.duration, args.concurrency)
+            mbps = client.throughput(args.size * 1000000, args.concurrency)
+            results.append((engine, cps, mbps))
+        finally:
+            relay.terminate()
+            relay.wait()
+
+    print('%-10s %12s %10s' % ('Engine', 'Conn/s', 'MB/s'))
+    for engine, cps, mbps in results: print('%-10s %12.1f %10.1f' % (engine, cps, mbps))
+
+if __name__ == '__main__':
+    main()
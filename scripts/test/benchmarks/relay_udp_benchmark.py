@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Measure relay_udp in datagrams per second at different batch sizes.
+# Local echo servers are used as the relay target, and the relay itself is run as a subprocess.
+# Each client process keeps a window of datagrams in flight through the relay, topping it back up as echoes return.
+# The relay's own CPU time per datagram is reported as well, since on a machine with few cores
+#  the clients and echo servers will compete with the relay and hold down the overall rate.
+#
+# Usage: ./relay_udp_benchmark.py [--batch-sizes 1,32] [--duration 5] [--clients 4] [--window 64] [--size 64]
+
+from __future__ import print_function
+import argparse, multiprocessing, os, socket, subprocess, sys, time
+
+RELAY = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'networking', 'relay_udp.py'))
+
+def echo_server(port):
+    # Several of these share the port, and the kernel spreads the relay's session sockets across them.
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(('127.0.0.1', port))
+    while True:
+        data, addr = s.recvfrom(65536)
+        s.sendto(data, addr)
+
+def client(port, duration, window, size, results):
+    c = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    c.connect(('127.0.0.1', port))
+    c.settimeout(0.2)
+    payload = os.urandom(size)
+
+    received = 0
+    in_flight = 0
+    end = time.time() + duration
+    while time.time() < end:
+        while in_flight < window:
+            c.send(payload)
+            in_flight += 1
+        try:
+            c.recv(65536)
+            received += 1
+            in_flight -= 1
+        except socket.timeout:
+            # Assume that whatever is still in flight has been dropped.
+            in_flight = 0
+    results.put(received)
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_relay(port, timeout = 10):
+    c = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    c.settimeout(0.2)
+    end = time.time() + timeout
+    while time.time() < end:
+        c.sendto(b'ping', ('127.0.0.1', port))
+        try:
+            c.recv(16)
+            return True
+        except socket.timeout: pass
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description='relay_udp datagram rate benchmark')
+    parser.add_argument('--batch-sizes', default='1,32', help='Comma-separated relay batch sizes to compare.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run each test for.')
+    parser.add_argument('--clients', type=int, default=4, help='Number of client processes (each one is a relay session).')
+    parser.add_argument('--window', type=int, default=64, help='Datagrams that each client keeps in flight.')
+    parser.add_argument('--size', type=int, default=64, help='Datagram size in bytes.')
+    parser.add_argument('--echo-servers', type=int, default=2, help='Number of echo server processes.')
+    parser.add_argument('--relay-args', default='', help='Additional arguments for the relay.')
+    args = parser.parse_args()
+
+    target_port = free_port()
+    for i in range(args.echo_servers):
+        target = multiprocessing.Process(target=echo_server, args=(target_port,))
+        target.daemon = True
+        target.start()
+
+    results = []
+    for batch_size in args.batch_sizes.split(','):
+        port = free_port()
+        cmd = [sys.executable, RELAY, '-b', '127.0.0.1', '-p', str(port), '--batch-size', batch_size] + args.relay_args.split()
+        cmd.append('127.0.0.1:%d' % target_port)
+
+        relay = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        received = 0
+        try:
+            if not wait_for_relay(port):
+                print('Relay with a batch size of %s did not start.' % batch_size)
+                continue
+
+            queue = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=client, args=(port, args.duration, args.window, args.size, queue)) for i in range(args.clients)]
+            for c in clients: c.start()
+            received = sum([queue.get() for c in clients])
+            for c in clients: c.join()
+
+        finally:
+            relay.terminate()
+            pid, relay.returncode, usage = os.wait4(relay.pid, 0)
+
+        if received:
+            # Each echo is two datagrams through the relay: one to the target, and one back to the client.
+            cpu = (usage.ru_utime + usage.ru_stime) / (received * 2) * 1e6
+            results.append((batch_size, received / args.duration, received * 2 / args.duration, cpu))
+
+    print('%-10s %14s %16s %18s' % ('Batch', 'Round trips/s', 'Datagrams/s', 'Relay CPU us/dgram'))
+    for batch_size, rtps, pps, cpu in results: print('%-10s %14.0f %16.0f %18.2f' % (batch_size, rtps, pps, cpu))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import common, os, sys, tempfile
+
+class NetworkAccessTests(common.TestCase):
+
+    def setUp(self):
+        self.mod = common.load('network_access', common.TOOLS_DIR + '/scripts/clipboard/python/network_access.py')
+        self.access = self.mod.NetAccess()
+
+        self.warnings = []
+        self.print_warning = self.mod.print_warning
+        self.mod.print_warning = lambda m: self.warnings.append(m)
+
+    def test_allow_all_by_default(self):
+        for address in ['127.0.0.1', '10.11.12.13', '255.255.255.255', '::1']:
+            self.assertTrue(self.access.is_allowed(address))
+
+    def test_blacklist_address(self):
+        self.assertTrue(self.access.add_blacklist('10.11.12.13'))
+
+        self.assertFalse(self.access.is_allowed('10.11.12.13'))
+        self.assertTrue(self.access.is_allowed('10.11.12.12'))
+        self.assertTrue(self.access.is_allowed('10.11.12.14'))
+
+    def test_blacklist_network(self):
+        self.assertTrue(self.access.add_blacklist('10.11.12.0/24'))
+
+        self.assertFalse(self.access.is_allowed('10.11.12.0'))
+        self.assertFalse(self.access.is_allowed('10.11.12.255'))
+        self.assertTrue(self.access.is_allowed('10.11.11.255'))
+        self.assertTrue(self.access.is_allowed('10.11.13.0'))
+
+    def test_blacklist_network_unaligned(self):
+        # Host bits in a network are ignored.
+        self.assertTrue(self.access.add_blacklist('10.11.12.13/16'))
+
+        self.assertFalse(self.access.is_allowed('10.11.0.0'))
+        self.assertFalse(self.access.is_allowed('10.11.255.255'))
+        self.assertTrue(self.access.is_allowed('10.12.0.0'))
+
+    def test_blacklist_overlapping(self):
+        for candidate in ['10.0.0.0/8', '10.11.12.0/24', '10.255.255.255', '11.0.0.0/32', '11.0.0.1']:
+            self.assertTrue(self.access.add_blacklist(candidate))
+
+        for address in ['10.0.0.0', '10.11.12.13', '10.255.255.255', '11.0.0.0', '11.0.0.1']:
+            self.assertFalse(self.access.is_allowed(address))
+        for address in ['9.255.255.255', '11.0.0.2']:
+            self.assertTrue(self.access.is_allowed(address))
+
+    def test_blacklist_all(self):
+        self.assertTrue(self.access.add_blacklist('0.0.0.0/0'))
+
+        self.assertFalse(self.access.is_allowed('0.0.0.0'))
+        self.assertFalse(self.access.is_allowed('255.255.255.255'))
+
+    def test_blacklist_over_whitelist(self):
+        self.assertTrue(self.access.add_whitelist('10.11.12.0/24'))
+        self.assertTrue(self.access.add_blacklist('10.11.12.13'))
+
+        self.assertTrue(self.access.is_allowed('10.11.12.12'))
+        self.assertFalse(self.access.is_allowed('10.11.12.13'))
+        self.assertFalse(self.access.is_allowed('10.11.13.1'))
+
+    def test_whitelist(self):
+        self.assertTrue(self.access.add_whitelist('127.0.0.1'))
+        self.assertTrue(self.access.add_whitelist('192.168.0.0/16'))
+
+        self.assertTrue(self.access.is_allowed('127.0.0.1'))
+        self.assertTrue(self.access.is_allowed('192.168.100.1'))
+        self.assertFalse(self.access.is_allowed('127.0.0.2'))
+        self.assertFalse(self.access.is_allowed('192.169.0.0'))
+        self.assertFalse(self.access.is_allowed('::1'))
+
+    def test_cache_cleared_on_change(self):
+        self.assertTrue(self.access.add_blacklist('10.0.0.0/8'))
+        self.assertTrue(self.access.is_allowed('11.0.0.1'))
+
+        self.assertTrue(self.access.add_blacklist('11.0.0.0/8'))
+        self.assertFalse(self.access.is_allowed('11.0.0.1'))
+
+    def test_cache_size(self):
+        self.access.CACHE_SIZE = 10
+        self.assertTrue(self.access.add_blacklist('10.0.0.0/8'))
+
+        for i in range(50):
+            self.assertFalse(self.access.is_allowed('10.0.0.%d' % i))
+            self.assertTrue(self.access.is_allowed('11.0.0.%d' % i))
+        self.assertEqual(10, len(self.access.compiled[2]))
+
+    def test_invalid(self):
+        self.assertFalse(self.access.add_blacklist('10.0.0.0/33'))
+        self.assertSingle(self.access.errors)
+        self.assertEmpty(self.access.denied_networks)
+        self.assertTrue(self.access.is_allowed('10.0.0.0'))
+
+    def test_literal_addresses_skip_dns(self):
+        def lookup(name):
+            raise Exception('Looked up: %s' % name)
+        original = self.mod.socket.gethostbyname
+        self.mod.socket.gethostbyname = lookup
+        try:
+            self.assertTrue(self.access.add_blacklist('10.11.12.13'))
+            self.assertTrue(self.access.add_blacklist('10.11.12.0/24'))
+            self.assertFalse(self.access.add_blacklist('300.11.12.13'))
+        finally:
+            self.mod.socket.gethostbyname = original
+
+        self.assertSingle(self.access.errors)
+        self.assertFalse(self.access.is_allowed('10.11.12.1'))
+
+    def test_load_file(self):
+        handle, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write('10.0.0.0/8\n172.16.0.1\n')
+            self.access.load_blacklist_file(path)
+        finally:
+            os.remove(path)
+
+        self.assertEmpty(self.access.errors)
+        self.assertFalse(self.access.is_allowed('10.1.2.3'))
+        self.assertFalse(self.access.is_allowed('172.16.0.1'))
+        self.assertTrue(self.access.is_allowed('172.16.0.2'))
+
+    def test_load_file_comments(self):
+        handle, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write('# Comment\n\n10.0.0.0/8\n')
+            self.access.load_blacklist_file(path)
+        finally:
+            os.remove(path)
+
+        self.assertEmpty(self.access.errors)
+        self.assertSingle(self.access.denied_networks)
+        self.assertTrue(self.access.is_allowed('0.0.0.0'))
+
+    def test_reload(self):
+        handle, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write('10.0.0.0/8\n')
+            self.access.add_blacklist('12.0.0.1')
+            self.access.load_blacklist_file(path)
+            self.assertFalse(self.access.is_allowed('10.0.0.1'))
+            self.assertTrue(self.access.is_allowed('11.0.0.1'))
+
+            with open(path, 'w') as f:
+                f.write('11.0.0.0/8\n')
+            self.assertTrue(self.access.reload())
+        finally:
+            os.remove(path)
+
+        self.assertTrue(self.access.is_allowed('10.0.0.1'))
+        self.assertFalse(self.access.is_allowed('11.0.0.1'))
+        self.assertFalse(self.access.is_allowed('12.0.0.1'))
+        self.assertEmpty(self.warnings)
+
+    def test_reload_missing_file(self):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as f:
+            f.write('10.0.0.0/8\n')
+        self.access.load_blacklist_file(path)
+        os.remove(path)
+
+        # Keep the old lists rather than dropping them.
+        self.assertFalse(self.access.reload())
+        self.assertFalse(self.access.is_allowed('10.0.0.1'))
+
+    def test_reload_errors(self):
+        self.access.add_blacklist('10.0.0.0/40')
+        self.assertTrue(self.access.reload())
+        self.assertSingle(self.warnings)
+
+    def test_print_warning(self):
+        # The copy kept here has to stand on its own, with no other script to supply its messages.
+        output = []
+        original = sys.stdout
+        sys.stdout = type('Output', (object,), {'write': lambda s, m: output.append(m), 'flush': lambda s: None})()
+        try:
+            self.print_warning('Message')
+        finally:
+            sys.stdout = original
+        self.assertEndsWith('Message\n', ''.join(output))
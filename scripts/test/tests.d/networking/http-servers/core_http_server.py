@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import common, json, socket, threading
+
+class CoreHttpServerTests(common.TestCase):
+
+    def setUp(self):
+        self.mod = common.load('CoreHttpServer', common.TOOLS_DIR + '/scripts/networking/http-servers/CoreHttpServer.py')
+        self.assertTrue(self.mod.args.process(['--threads', '2'], exit_on_error = False, print_errors = False))
+
+        seen = self.seen = []
+        class Handler(self.mod.CoreHttpServer):
+            def do_GET(self):
+                seen.append(self.requestline)
+                if self.path == '/plain.txt':
+                    return self.serve_content('hello', mimetype = 'text/plain')
+                return self.send_error(404)
+
+            def log_message(self, fmt, *values):
+                pass
+
+        self.handler = Handler
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.kill_requests()
+            if not isinstance(server, self.mod.SelectorHTTPServer):
+                server.shutdown()
+            server.server_close()
+
+    def get_engines(self):
+        engines = [self.mod.ThreadedHTTPServer]
+        if self.mod.selectors:
+            engines.append(self.mod.SelectorHTTPServer)
+        return engines
+
+    def start(self, engine):
+        server = engine(('127.0.0.1', 0), self.handler)
+        self.servers.append(server)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server.server_address[1]
+
+    def exchange(self, port, requests):
+        # Pipeline all requests over one connection, then read each response in turn.
+        # Requests are given as a request line, optionally followed by extra headers and a body.
+        s = socket.create_connection(('127.0.0.1', port), timeout = 5)
+        try:
+            data = ''
+            for r in requests:
+                line, _, rest = r.partition('\r\n')
+                data += '%s HTTP/1.1\r\nHost: localhost\r\n%s' % (line, rest or '\r\n')
+            s.sendall(data.encode())
+
+            f = s.makefile('rb')
+            responses = []
+            for r in requests:
+                status = f.readline().decode().split(' ', 2)
+                if len(status) < 2:
+                    # Connection closed.
+                    break
+                headers = {}
+                while True:
+                    line = f.readline().decode().strip()
+                    if not line:
+                        break
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = b''
+                if not r.startswith('HEAD '):
+                    body = f.read(int(headers.get('content-length', 0)))
+                responses.append((status[1], headers, body))
+            return responses
+        finally:
+            s.close()
+
+    def test_head_error_has_no_body(self):
+        for engine in self.get_engines():
+            responses = self.exchange(self.start(engine), ['HEAD /', 'GET /plain.txt'])
+
+            self.assertEqual('501', responses[0][0])
+            self.assertNotEqual('close', responses[0][1].get('connection'))
+            self.assertEqual('200', responses[1][0])
+            self.assertEqual(b'hello', responses[1][2])
+
+    def test_error_then_request(self):
+        for engine in self.get_engines():
+            responses = self.exchange(self.start(engine), ['GET /missing', 'GET /plain.txt', 'GET /plain.txt'])
+
+            self.assertEqual(['404', '200', '200'], [r[0] for r in responses])
+            self.assertStartsWith(b'<html>', responses[0][2])
+            self.assertEqual(b'hello', responses[2][2])
+
+    def test_unread_body_is_not_a_request(self):
+        for engine in self.get_engines():
+            del self.seen[:]
+            body = 'GET /plain.txt?smuggled=1 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            request = 'GET /plain.txt\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+            responses = self.exchange(self.start(engine), [request, 'GET /plain.txt'])
+
+            self.assertEqual(['200', '200'], [r[0] for r in responses])
+            self.assertEqual(['GET /plain.txt HTTP/1.1'] * 2, self.seen)
+
+    def get_stats(self, port):
+        s = socket.create_connection(('127.0.0.1', port), timeout = 5)
+        try:
+            s.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            data = b''
+            while True:
+                buf = s.recv(4096)
+                if not buf:
+                    return data
+                data += buf
+        finally:
+            s.close()
+
+    def test_stats_access(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+
+        # Never serving, so only needs to be closed.
+        server = self.mod.ThreadedHTTPServer(('127.0.0.1', 0), self.handler)
+        try:
+            server.serve_stats(('127.0.0.1', port))
+
+            data = self.get_stats(port)
+            self.assertStartsWith(b'HTTP/1.0 200', data)
+            self.assertEqual(0, json.loads(data.split(b'\r\n\r\n', 1)[1].decode())['busy'])
+
+            # Denied clients are turned away before they get any statistics.
+            self.assertTrue(self.mod.access.add_blacklist('127.0.0.1'))
+            self.assertEqual(b'', self.get_stats(port))
+        finally:
+            server.kill_requests()
+            server.server_close()
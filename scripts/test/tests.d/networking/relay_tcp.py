@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import common, json
+
+class RelayTcpTests(common.TestCase):
+
+    def setUp(self):
+        self.mod = common.load('relay_tcp', common.TOOLS_DIR + '/scripts/networking/relay_tcp.py')
+        self.server = self.mod.TcpRelayServer()
+        self.assertTrue(self.server.args.process(['127.0.0.1:81', '127.0.0.2:82', '127.0.0.3:83'], exit_on_error = False, print_errors = False))
+        self.targets = self.server.targets
+
+        self.errors = []
+        self.mod.log_error = lambda m: self.errors.append(m)
+        self.mod.log_notice = lambda m: None
+
+    # Target selection
+
+    def test_least_connections(self):
+        self.targets[0].active = 2
+        self.targets[1].active = 1
+        self.targets[2].active = 3
+        self.assertEqual(self.targets[1], self.server.get_target_least_connections())
+        self.assertEqual(self.targets[0], self.server.get_target_least_connections([self.targets[1]]))
+
+    def test_least_connections_skips_unhealthy(self):
+        self.targets[1].healthy = False
+        self.targets[0].active = 1
+        self.targets[2].active = 1
+        self.assertEqual(self.targets[0], self.server.get_target_least_connections())
+
+    def test_all_unhealthy(self):
+        # Trying an ejected target beats turning the client away.
+        for t in self.targets:
+            t.healthy = False
+        self.assertEqual(self.targets[0], self.server.get_target_least_connections())
+        self.assertNone(self.server.get_target_least_connections(self.targets))
+
+    def test_latency_unmeasured_first(self):
+        self.targets[0].record_latency(0.01)
+        self.targets[2].record_latency(0.01)
+        self.assertEqual(self.targets[1], self.server.get_target_latency())
+
+    def test_latency_weighted_by_sessions(self):
+        self.targets[0].record_latency(0.01)
+        self.targets[1].record_latency(0.02)
+        self.targets[2].record_latency(0.05)
+        self.assertEqual(self.targets[0], self.server.get_target_latency())
+
+        self.targets[0].active = 2
+        self.assertEqual(self.targets[1], self.server.get_target_latency())
+
+    def test_latency_moving_average(self):
+        target = self.targets[0]
+        target.record_latency(1.0)
+        self.assertEqual(1.0, target.latency)
+        target.record_latency(2.0)
+        self.assertAlmostEqual(1.0 + target.LATENCY_WEIGHT, target.latency)
+
+    def test_failures_eject(self):
+        target = self.targets[0]
+        for i in range(target.FAILURE_THRESHOLD - 1):
+            target.record_failure(True)
+        self.assertTrue(target.healthy)
+        target.record_failure(True)
+        self.assertFalse(target.healthy)
+        self.assertSingle(self.errors)
+
+    def test_failures_without_health_checks(self):
+        # Nothing would restore an ejected target.
+        target = self.targets[0]
+        for i in range(target.FAILURE_THRESHOLD * 2):
+            target.record_failure(False)
+        self.assertTrue(target.healthy)
+
+    # Statistics
+
+    def test_stats(self):
+        self.server.init_ssl()
+        self.targets[0].connect_histogram.observe(0.003)
+        self.targets[0].connect_histogram.observe(10)
+        self.targets[1].active = 2
+
+        stats = json.loads(json.dumps(self.server.get_stats()))
+        self.assertEqual({'active': 0, 'total': 0}, stats['sessions'])
+        self.assertEqual(['127.0.0.1:81', '127.0.0.2:82', '127.0.0.3:83'], [t['address'] for t in stats['targets']])
+        self.assertEqual(2, stats['targets'][1]['sessions_active'])
+
+        histogram = stats['targets'][0]['connect_seconds']
+        self.assertEqual(2, histogram['count'])
+        self.assertEqual(['0.001', 0], histogram['buckets'][0])
+        self.assertEqual(['0.005', 1], histogram['buckets'][2])
+        self.assertEqual(['+Inf', 2], histogram['buckets'][-1])
+
+    def test_stats_prometheus(self):
+        self.server.init_ssl()
+        self.targets[0].connect_histogram.observe(0.003)
+        self.targets[2].healthy = False
+
+        lines = self.server.get_stats_prometheus().splitlines()
+        self.assertContains('# TYPE relay_tcp_sessions_total counter', lines)
+        self.assertContains('relay_tcp_bytes_total{direction="in"} 0', lines)
+        self.assertContains('relay_tcp_target_up{target="127.0.0.1:81"} 1', lines)
+        self.assertContains('relay_tcp_target_up{target="127.0.0.3:83"} 0', lines)
+        self.assertContains('# TYPE relay_tcp_target_connect_seconds histogram', lines)
+        self.assertContains('relay_tcp_target_connect_seconds_bucket{target="127.0.0.1:81",le="0.0025"} 0', lines)
+        self.assertContains('relay_tcp_target_connect_seconds_bucket{target="127.0.0.1:81",le="0.005"} 1', lines)
+        self.assertContains('relay_tcp_target_connect_seconds_count{target="127.0.0.1:81"} 1', lines)
+
+    # Timer wheel
+
+    def get_wheel(self):
+        # 4 slots over 3 levels: level 0 reaches 4 ticks, level 1 reaches 16, and level 2 reaches 64.
+        return self.mod.TcpRelayTimerWheel(0, resolution = 1, slots = 4, levels = 3)
+
+    def test_timer_expiry(self):
+        wheel = self.get_wheel()
+        timers = dict([(deadline, self.mod.TcpRelayTimer(None)) for deadline in [2, 10, 40]])
+        for deadline, timer in timers.items():
+            wheel.schedule(timer, deadline)
+        self.assertEqual(3, wheel.count)
+
+        # Each timer goes off on the tick of its deadline, whichever level it started out on.
+        for now in range(1, 50):
+            expired = wheel.advance(now)
+            if now in timers:
+                self.assertEqual([timers[now]], expired)
+            else:
+                self.assertEmpty(expired)
+        self.assertEqual(0, wheel.count)
+
+    def test_timer_skipping_ahead(self):
+        wheel = self.get_wheel()
+        timers = [self.mod.TcpRelayTimer(None) for i in range(3)]
+        for timer, deadline in zip(timers, [3, 17, 33]):
+            wheel.schedule(timer, deadline)
+
+        self.assertEqual([timers[0]], wheel.advance(16))
+        self.assertEqual(set(timers[1:]), set(wheel.advance(40)))
+
+    def test_timer_fractional_deadline(self):
+        wheel = self.mod.TcpRelayTimerWheel(0, resolution = 0.1)
+        timer = self.mod.TcpRelayTimer(None)
+        wheel.schedule(timer, 0.25)
+        self.assertEmpty(wheel.advance(0.25))
+        self.assertEqual([timer], wheel.advance(0.35))
+
+    def test_timer_beyond_span(self):
+        # Timers beyond the reach of the wheel go off early, on the last tick that it can reach.
+        wheel = self.get_wheel()
+        timer = self.mod.TcpRelayTimer(None)
+        wheel.schedule(timer, 1000)
+        self.assertEmpty(wheel.advance(62))
+        self.assertEqual([timer], wheel.advance(63))
+
+    def test_timer_cancel(self):
+        wheel = self.get_wheel()
+        timers = [self.mod.TcpRelayTimer(None) for i in range(2)]
+        wheel.schedule(timers[0], 20)
+        wheel.schedule(timers[1], 20)
+        wheel.cancel(timers[0])
+        wheel.cancel(timers[0]) # Cancelling twice is harmless.
+
+        self.assertEqual(1, wheel.count)
+        self.assertEqual([timers[1]], wheel.advance(20))
+        self.assertEqual(0, wheel.count)
+
+    def test_timer_reschedule(self):
+        wheel = self.get_wheel()
+        timer = self.mod.TcpRelayTimer(None)
+        wheel.schedule(timer, 5)
+        wheel.schedule(timer, 30)
+
+        self.assertEqual(1, wheel.count)
+        self.assertEmpty(wheel.advance(29))
+        self.assertEqual([timer], wheel.advance(30))
+
+    # PROXY protocol
+
+    def test_proxy_v1(self):
+        header = self.mod.build_proxy_header(1, ('10.0.0.1', 1234), ('10.0.0.2', 80))
+        self.assertEqual(b'PROXY TCP4 10.0.0.1 10.0.0.2 1234 80\r\n', header)
+        self.assertEqual((len(header), ('10.0.0.1', 1234)), self.mod.parse_proxy_header(header + b'GET / HTTP/1.0\r\n'))
+
+    def test_proxy_v1_ipv6(self):
+        header = self.mod.build_proxy_header(1, ('::1', 1234), ('::2', 80))
+        self.assertEqual(b'PROXY TCP6 ::1 ::2 1234 80\r\n', header)
+        self.assertEqual((len(header), ('::1', 1234)), self.mod.parse_proxy_header(header))
+
+    def test_proxy_v1_unknown(self):
+        header = self.mod.build_proxy_header(1, ('10.0.0.1', 1234), ('::2', 80))
+        self.assertEqual(b'PROXY UNKNOWN\r\n', header)
+        self.assertEqual((len(header), None), self.mod.parse_proxy_header(header))
+
+    def test_proxy_v2(self):
+        header = self.mod.build_proxy_header(2, ('10.0.0.1', 1234), ('10.0.0.2', 80))
+        self.assertEqual(28, len(header))
+        self.assertEqual((28, ('10.0.0.1', 1234)), self.mod.parse_proxy_header(header + b'data'))
+
+    def test_proxy_v2_ipv6(self):
+        header = self.mod.build_proxy_header(2, ('fe80::1', 1234), ('fe80::2', 80))
+        self.assertEqual(52, len(header))
+        self.assertEqual((52, ('fe80::1', 1234)), self.mod.parse_proxy_header(header))
+
+    def test_proxy_v2_local(self):
+        header = self.mod.PROXY_V2_SIGNATURE + b'\x20\x00\x00\x00'
+        self.assertEqual((16, None), self.mod.parse_proxy_header(header))
+
+    def test_proxy_v2_unspecified(self):
+        header = self.mod.build_proxy_header(2, ('10.0.0.1', 1234), ('::2', 80))
+        self.assertEqual((16, None), self.mod.parse_proxy_header(header))
+
+    def test_proxy_truncated(self):
+        # Headers that have not been read in full ask for more data, rather than being rejected.
+        v1 = self.mod.build_proxy_header(1, ('10.0.0.1', 1234), ('10.0.0.2', 80))
+        for i in range(1, len(v1) - 1):
+            length, addr = self.mod.parse_proxy_header(v1[:i])
+            self.assertTrue(length > i)
+            self.assertNone(addr)
+
+        v2 = self.mod.build_proxy_header(2, ('10.0.0.1', 1234), ('10.0.0.2', 80))
+        self.assertEqual((16, None), self.mod.parse_proxy_header(v2[:5]))
+        self.assertEqual((28, None), self.mod.parse_proxy_header(v2[:20]))
+
+    def test_proxy_garbage(self):
+        for data in [b'GET / HTTP/1.1\r\n', b'PROXY TCP4 10.0.0.1\r\n', b'PROXY TCP5 10.0.0.1 10.0.0.2 1 2\r\n', b'PROXY TCP4 10.0.0.300 10.0.0.2 1 2\r\n', b'PROXY ' + b'1' * 200]:
+            self.assertRaises(ValueError, self.mod.parse_proxy_header, data)
+
+    def test_proxy_v2_bad_version(self):
+        header = self.mod.PROXY_V2_SIGNATURE + b'\x11\x11\x00\x0c' + b'\x00' * 12
+        self.assertRaises(ValueError, self.mod.parse_proxy_header, header)
+
+    # Accept rate limits
+
+    def test_token_bucket_burst(self):
+        bucket = self.mod.TcpRelayTokenBucket(5, 100)
+        self.assertEqual([True] * 5 + [False], [bucket.take(100) for i in range(6)])
+        self.assertAlmostEqual(0.2, bucket.get_wait())
+
+    def test_token_bucket_refill(self):
+        bucket = self.mod.TcpRelayTokenBucket(5, 100)
+        for i in range(5):
+            bucket.take(100)
+        self.assertFalse(bucket.take(100.1))
+        self.assertTrue(bucket.take(100.3))
+        self.assertFalse(bucket.take(100.3))
+
+        # Refills stop at a second's worth.
+        self.assertTrue(bucket.is_full(200))
+        self.assertEqual(5, bucket.tokens)
+
+    def test_token_bucket_slow_rate(self):
+        # Rates under one per second still allow a single event.
+        bucket = self.mod.TcpRelayTokenBucket(0.5, 100)
+        self.assertTrue(bucket.take(100))
+        self.assertFalse(bucket.take(101))
+        self.assertTrue(bucket.take(102))
+
+    def test_token_bucket_refund(self):
+        bucket = self.mod.TcpRelayTokenBucket(1, 100)
+        self.assertTrue(bucket.take(100))
+        bucket.refund()
+        self.assertTrue(bucket.take(100))
+
+    def init_rate_limits(self, now):
+        self.server.accept_rate_per_ip = 2
+        self.server.ip_buckets = {}
+        self.server.rate_pruned = now
+
+    def test_admit_per_ip(self):
+        self.init_rate_limits(100)
+        self.assertEqual([True, True, False], [self.server.admit('10.0.0.1', 100) for i in range(3)])
+        self.assertTrue(self.server.admit('10.0.0.2', 100))
+        self.assertTrue(self.server.admit('10.0.0.1', 100.5))
+
+    def test_admit_prunes_quiet_addresses(self):
+        self.init_rate_limits(100)
+        self.server.admit('10.0.0.1', 100)
+        self.server.admit('10.0.0.2', 100 + self.server.RATE_PRUNE_INTERVAL - 0.1)
+        self.server.admit('10.0.0.3', 100 + self.server.RATE_PRUNE_INTERVAL)
+        self.assertEqual(['10.0.0.2', '10.0.0.3'], sorted(self.server.ip_buckets))
+
+    def test_admit_access_list(self):
+        self.server.access.add_blacklist('10.0.0.1')
+        self.assertFalse(self.server.admit('10.0.0.1', 100))
+        self.assertTrue(self.server.admit('10.0.0.2', 100))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+import common, json, socket
+
+class Session(object):
+    # Stands in for a UdpRelaySession, with only what backlogs and demux objects look at.
+    def __init__(self, addr = ('10.0.0.1', 1000)):
+        self.addr = addr
+        self.closed = False
+        self.upstream = None
+        self.dropped = {'in': 0, 'out': 0}
+
+class RelayUdpTests(common.TestCase):
+
+    def setUp(self):
+        self.mod = common.load('relay_udp', common.TOOLS_DIR + '/scripts/networking/relay_udp.py')
+        self.server = self.mod.UdpRelayServer()
+        self.assertTrue(self.server.args.process(['127.0.0.1:81', '127.0.0.2:82'], exit_on_error = False, print_errors = False))
+        self.targets = [t.get_addr() for t in self.server.targets]
+
+    # Backlogs
+
+    def get_backlog(self, policy, size = 2):
+        self.server.drop_policy = policy
+        self.server.backlog_size = size
+        self.server.backlog_max_age = 1
+        return self.mod.UdpRelayBacklog(self.server, 'in')
+
+    def test_backlog_drop_newest(self):
+        backlog = self.get_backlog(self.mod.DROP_NEWEST)
+        session = Session()
+        for i in range(3):
+            backlog.append(i, 100, session)
+
+        self.assertEqual([0, 1], list(backlog))
+        self.assertEqual({'in': 1, 'out': 0}, session.dropped)
+        self.assertEqual({'in': 1, 'out': 0}, self.server.dropped)
+
+    def test_backlog_drop_oldest(self):
+        backlog = self.get_backlog(self.mod.DROP_OLDEST)
+        sessions = [Session(), Session()]
+        for i in range(3):
+            backlog.append(i, 100, sessions[i % 2])
+
+        # The dropped datagram counts against the session that it belonged to.
+        self.assertEqual([1, 2], list(backlog))
+        self.assertEqual(1, sessions[0].dropped['in'])
+        self.assertEqual(0, sessions[1].dropped['in'])
+        self.assertEqual(1, self.server.dropped['in'])
+
+    def test_backlog_drop_age(self):
+        backlog = self.get_backlog(self.mod.DROP_AGE, size = 3)
+        session = Session()
+        backlog.append(0, 100, session)
+        backlog.append(1, 100.5, session)
+        backlog.append(2, 100.9, session)
+
+        # Stale datagrams make way first.
+        backlog.append(3, 101.2, session)
+        self.assertEqual([1, 2, 3], list(backlog))
+
+        # Failing that, the longest-waiting datagram goes.
+        backlog.append(4, 101.3, session)
+        self.assertEqual([2, 3, 4], list(backlog))
+        self.assertEqual(2, session.dropped['in'])
+
+    def test_backlog_consume(self):
+        backlog = self.get_backlog(self.mod.DROP_NEWEST, size = 4)
+        session = Session()
+        for i in range(3):
+            backlog.append(i, 100, session)
+        backlog.consume(2)
+
+        self.assertEqual(1, len(backlog))
+        self.assertEqual(2, backlog[0])
+        self.assertEqual(0, session.dropped['in'])
+
+    # Shared upstream sockets
+
+    def test_demux_port(self):
+        demux = self.mod.UdpRelayDemux()
+        a, b = Session(('10.0.0.1', 1000)), Session(('10.0.0.2', 1000))
+
+        a.upstream = demux.pick([5, 6], a, self.targets)
+        self.assertEqual(5, a.upstream)
+        self.assertEqual(b'query', demux.outbound(5, self.targets[0], a, b'query', 100))
+
+        # A socket carries only one client to each target.
+        b.upstream = demux.pick([5, 6], b, self.targets)
+        self.assertEqual(6, b.upstream)
+        demux.outbound(6, self.targets[0], b, b'query', 100)
+
+        self.assertEqual((a, b'reply'), demux.inbound(5, self.targets[0], b'reply', 100))
+        self.assertEqual((b, b'reply'), demux.inbound(6, self.targets[0], b'reply', 100))
+        self.assertEqual((None, b'reply'), demux.inbound(5, self.targets[1], b'reply', 100))
+
+    def test_demux_port_full(self):
+        demux = self.mod.UdpRelayDemux()
+        a, b = Session(), Session()
+        a.upstream = demux.pick([5], a, self.targets)
+        demux.outbound(5, self.targets[1], a, b'query', 100)
+        self.assertNone(demux.pick([5], b, self.targets))
+
+    def test_demux_port_release(self):
+        demux = self.mod.UdpRelayDemux()
+        a, b = Session(), Session()
+        a.upstream = demux.pick([5], a, self.targets)
+        demux.outbound(5, self.targets[0], a, b'query', 100)
+
+        demux.release(a, self.targets)
+        self.assertEmpty(demux.flows)
+        self.assertEqual(5, demux.pick([5], b, self.targets))
+
+    def test_demux_port_closed(self):
+        # Closed sessions give up their socket even before they are released.
+        demux = self.mod.UdpRelayDemux()
+        a, b = Session(), Session()
+        a.upstream = demux.pick([5], a, self.targets)
+        demux.outbound(5, self.targets[0], a, b'query', 100)
+
+        a.closed = True
+        self.assertEqual(5, demux.pick([5], b, self.targets))
+
+    def get_dns_query(self, query_id):
+        return query_id + b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'
+
+    def test_demux_dns(self):
+        demux = self.mod.UdpRelayDnsDemux(5)
+        a, b = Session(('10.0.0.1', 1000)), Session(('10.0.0.2', 1000))
+
+        # Clients that happen to pick the same ID are still told apart.
+        queries = [(session, demux.outbound(5, self.targets[0], session, self.get_dns_query(b'\x12\x34'), 100)) for session in [a, b]]
+        self.assertNotEqual(queries[0][1][:2], queries[1][1][:2])
+
+        for session, query in reversed(queries):
+            self.assertEqual(self.get_dns_query(b'\x12\x34')[2:], query[2:])
+            self.assertEqual((session, self.get_dns_query(b'\x12\x34')), demux.inbound(5, self.targets[0], query, 100))
+
+        # Each ID is answered once.
+        self.assertEqual((None, queries[0][1]), demux.inbound(5, self.targets[0], queries[0][1], 100))
+        self.assertEmpty(demux.queries)
+
+    def test_demux_dns_other_target(self):
+        demux = self.mod.UdpRelayDnsDemux(5)
+        query = demux.outbound(5, self.targets[0], Session(), self.get_dns_query(b'\x12\x34'), 100)
+        self.assertNone(demux.inbound(5, self.targets[1], query, 100)[0])
+        self.assertNone(demux.inbound(6, self.targets[0], query, 100)[0])
+
+    def test_demux_dns_short(self):
+        demux = self.mod.UdpRelayDnsDemux(5)
+        self.assertNone(demux.outbound(5, self.targets[0], Session(), b'\x12\x34', 100))
+        self.assertEmpty(demux.queries)
+
+    def test_demux_dns_expiry(self):
+        demux = self.mod.UdpRelayDnsDemux(5)
+        demux.pruned = 100
+        session = Session()
+        demux.outbound(5, self.targets[0], session, self.get_dns_query(b'\x00\x01'), 100)
+        demux.outbound(5, self.targets[0], session, self.get_dns_query(b'\x00\x02'), 103)
+        self.assertEqual(2, len(demux.queries))
+
+        # Release leaves queries to be answered or to expire.
+        demux.release(session, self.targets)
+        demux.outbound(5, self.targets[0], session, self.get_dns_query(b'\x00\x03'), 105)
+        self.assertEqual(2, len(demux.queries))
+        self.assertEqual([103, 105], sorted([q[2] for q in demux.queries.values()]))
+
+    def test_demux_dns_spread(self):
+        demux = self.mod.UdpRelayDnsDemux(5)
+        picks = set([demux.pick([5, 6, 7], Session(('10.0.0.%d' % i, 1000)), self.targets) for i in range(64)])
+        self.assertEqual(set([5, 6, 7]), picks)
+
+    # Datagram I/O
+
+    def test_batch_io(self):
+        try:
+            io = self.mod.UdpRelayBatchIO(4, 64)
+        except (ImportError, OSError, AttributeError):
+            return # Not available on this platform.
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', 0))
+            receiver.settimeout(5)
+            sender.bind(('127.0.0.1', 0))
+            addr = receiver.getsockname()
+            items = [(b'datagram %d' % i, addr) for i in range(6)]
+
+            # Only one batch goes out in one call.
+            self.assertEqual(4, io.send(sender, items))
+            self.assertEqual(2, io.send(sender, items[4:]))
+
+            # Wait for the first datagram to arrive, then read without blocking.
+            receiver.recv(64, socket.MSG_PEEK)
+            received = io.recv(receiver)
+            while len(received) < 6:
+                received += io.recv(receiver)
+            self.assertEqual([(data, sender.getsockname()) for data, a in items], received)
+        finally:
+            receiver.close()
+            sender.close()
+
+    # Target selection
+
+    def test_quickest_target(self):
+        self.server.race_fraction = 0
+        self.server.no_reply = False
+        targets = self.server.targets
+        self.assertNone(self.server.get_quickest_target())
+
+        targets[0].record_reply(0.05)
+        targets[1].record_reply(0.02)
+        self.assertEqual(targets[1], self.server.get_quickest_target())
+
+        for i in range(targets[1].MAX_FAILURES):
+            targets[1].record_failure()
+        self.assertEqual(targets[0], self.server.get_quickest_target())
+
+    def test_quickest_target_race(self):
+        self.server.race_fraction = 1
+        self.server.no_reply = False
+        self.server.targets[0].record_reply(0.05)
+        self.assertNone(self.server.get_quickest_target())
+
+    def test_reply_moving_average(self):
+        target = self.server.targets[0]
+        target.record_reply(1.0)
+        target.record_reply(2.0)
+        self.assertAlmostEqual(1.0 + target.LATENCY_WEIGHT, target.latency)
+
+    # Statistics
+
+    def add_session(self):
+        self.server.upstream_sockets = 1 # Keeps the session from opening a socket of its own.
+        self.server.get_target = self.server.get_target_round_robin
+        session = self.mod.UdpRelaySession(self.server, ('10.0.0.1', 1000))
+        session.backlog.append((b'data', self.targets[0]), 100, session)
+        session.dropped['out'] = 2
+        self.server.sessions[session.addr] = session
+        self.server.sessions_total = 3
+        self.server.dropped['out'] = 5
+        return session
+
+    def test_stats(self):
+        self.add_session()
+        self.server.targets[1].record_reply(0.5)
+
+        stats = json.loads(json.dumps(self.server.get_stats()))
+        self.assertEqual({'active': 1, 'total': 3}, stats['sessions'])
+        self.assertEqual({'in': 0, 'out': 5}, stats['dropped'])
+        self.assertEqual(['127.0.0.1:81', '127.0.0.2:82'], [t['address'] for t in stats['targets']])
+        self.assertEqual(0.5, stats['targets'][1]['latency'])
+
+        session = self.assertSingle(stats['active_sessions'])
+        self.assertEqual('10.0.0.1:1000', session['client'])
+        self.assertEqual('127.0.0.1:81', session['target'])
+        self.assertEqual(1, session['backlog'])
+        self.assertEqual({'in': 0, 'out': 2}, session['dropped'])
+
+    def test_stats_prometheus(self):
+        self.add_session()
+        self.server.targets[1].record_reply(0.5)
+
+        lines = self.server.get_stats_prometheus().splitlines()
+        self.assertContains('# TYPE relay_udp_sessions_total counter', lines)
+        self.assertContains('relay_udp_sessions_active 1', lines)
+        self.assertContains('relay_udp_dropped_total{direction="out"} 5', lines)
+        self.assertContains('relay_udp_session_dropped_total{client="10.0.0.1:1000",direction="out"} 2', lines)
+        self.assertContains('relay_udp_session_backlog{client="10.0.0.1:1000"} 1', lines)
+        self.assertContains('relay_udp_target_up{target="127.0.0.1:81"} 1', lines)
+        self.assertContains('relay_udp_target_latency_seconds{target="127.0.0.2:82"} 0.5', lines)
+        # Targets that have never replied have no latency to report.
+        self.assertEmpty([l for l in lines if l.startswith('relay_udp_target_latency_seconds{target="127.0.0.1:81"}')])